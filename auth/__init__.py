@@ -6,40 +6,37 @@ Create app
 from __future__ import absolute_import
 
 import datetime
+import gc
 import os
-import pytz
 import uuid
 
 import six
 
 from auth import constants
+from auth.fragments import FragmentCacheExtension
 
-from auth.models import User, Role, db, users
-from auth.resources import GatewayResource, \
-        NetworkResource, \
-        UserResource, \
-        VoucherResource, \
-        api, \
-        logos
-from auth.services import login_manager, mail, menu, security
-from auth.views import bp
-
-from dateutil.tz import tzlocal
+from auth.models import db
+from auth.money import money, moneys
+from auth.services import coordination, counters, logos, profiling, revocations, tokens
+from auth.timezones import local_datetime, local_datetimes
 
 from flask import Flask
 from flask_uploads import configure_uploads
-from flask_principal import \
-        AnonymousIdentity, \
-        Identity, \
-        Principal, \
-        RoleNeed, \
-        UserNeed, \
-        identity_loaded
-from flask_security import current_user
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy.exc import SQLAlchemyError
+
+MODES = ('full', 'gateway', 'admin', 'cli')
+
 
+def create_app(config=None, mode=None):
+    """
+    Create app
 
-def create_app(config=None):
-    """ Create app """
+    The mode picks which parts are loaded: ``gateway`` only serves the WifiDog
+    protocol and captive portal, ``admin`` only the admin interface and API,
+    ``cli`` only what manage.py commands need, and ``full`` everything.
+    Heavy modules are only imported by the modes that use them.
+    """
 
     app = Flask(__name__)
 
@@ -48,18 +45,155 @@ def create_app(config=None):
     if config is not None:
         app.config.update(**config)
 
+    mode = mode or app.config.get('APP_MODE', 'full')
+
+    if mode not in MODES:
+        raise ValueError('Unknown app mode: %s' % mode)
+
+    app.config['APP_MODE'] = mode
+
+    init_core(app)
+
+    if mode in ('full', 'cli'):
+        init_security(app)
+
+    if mode in ('full', 'admin'):
+        init_admin(app)
+
+    if mode in ('full', 'gateway'):
+        init_gateway(app)
+
+    return app
+
+
+def preload(app):
+    """
+    Do the work each worker would otherwise repeat, before forking
+
+    Compiles templates, configures mappers, runs the first request hooks
+    (which register the menus and build the revocation bitmap), drops any
+    database connections so that none are shared with the workers, and
+    moves everything built so far out of the garbage collector's reach so
+    its pages stay shared after fork.
+    """
+    from sqlalchemy.orm import configure_mappers
+
+    configure_mappers()
+
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+
+    with app.test_request_context():
+        app.try_trigger_before_first_request_functions()
+
+    with app.app_context():
+        db.engine.dispose()
+
+    gc.collect()
+
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+
+def after_fork(app):
+    """Make sure a forked worker opens its own database connections"""
+    with app.app_context():
+        db.engine.dispose()
+
+
+def before_exit(app):
+    """Write what a worker still holds in memory before it exits"""
+    counters.flush_app(app)
+
+
+def init_core(app):
+    # Registers the listeners that invalidate cached select options and catalogs
+    import auth.catalog
+    import auth.options
+
     db.init_app(app)
-    api.init_app(app)
+    coordination.init_app(app)
+    counters.init_app(app)
+    profiling.init_app(app)
+
+    configure_uploads(app, (logos,))
+
+    cache_dir = app.config.get('TEMPLATE_CACHE_DIR')
+
+    if cache_dir:
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+    app.jinja_env.add_extension(FragmentCacheExtension)
+
+    @app.after_request
+    def security_measures(response):
+        response.headers["X-Content-Type-Options"] = "nosniff"
+        response.headers["X-Frame-Options"] = "DENY"
+        response.headers["X-XSS-Protection"] = "1"
+        if 'Cache-Control' not in response.headers:
+            response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+        response.headers["Pragma"] = "no-cache"
+        return response
+
+    app.add_template_filter(local_datetime)
+    app.add_template_filter(local_datetimes)
+    app.add_template_filter(money)
+    app.add_template_filter(moneys)
+
+    @app.context_processor
+    def context_processor():
+        """Context processors for use in templates"""
+        return dict(constants=constants, six=six)
+
+
+def init_security(app):
+    from auth.admin_services import mail, security
+    from auth.models import Role, User
+    from auth.passwords import init_passwords
+    from auth.services import login_manager
+
+    from flask_security import SQLAlchemyUserDatastore
+
     login_manager.init_app(app)
     mail.init_app(app)
-    menu.init_app(app)
+    security.init_app(app, SQLAlchemyUserDatastore(db, User, Role))
+
+    init_passwords(app)
+
+
+def init_admin(app):
+    from auth.orders import orders
+    from auth.resources import api
+    from auth.admin_services import menu, probes
+    from auth.views import bp
+
+    from flask_principal import \
+            AnonymousIdentity, \
+            Identity, \
+            Principal, \
+            RoleNeed, \
+            UserNeed, \
+            identity_loaded
+    from flask import request
+    from flask_security import current_user
+
+    if 'security' not in app.extensions:
+        init_security(app)
 
-    security.init_app(app, users)
+    api.init_app(app)
+    menu.init_app(app)
+    orders.init_app(app)
+    probes.init_app(app)
 
     principal = Principal()
     principal.init_app(app)
 
-    configure_uploads(app, (logos,))
     app.register_blueprint(bp)
 
     @identity_loaded.connect_via(app)
@@ -71,6 +205,14 @@ def create_app(config=None):
             for role in current_user.roles:
                 identity.provides.add(RoleNeed(role.name))
 
+    @app.context_processor
+    def menu_context_processor():
+        def menu_cache_key():
+            """The menu only varies by the user's roles and the current page"""
+            roles = sorted(role.name for role in getattr(current_user, 'roles', []))
+            return '%s:%s' % (','.join(roles), request.endpoint)
+        return dict(menu_cache_key=menu_cache_key)
+
     @principal.identity_loader
     def read_identity_from_flask_login():
         """Convert flask login to identity"""
@@ -78,27 +220,29 @@ def create_app(config=None):
             return Identity(current_user.id)
         return AnonymousIdentity()
 
-    @app.after_request
-    def security_measures(response):
-        response.headers["X-Content-Type-Options"] = "nosniff"
-        response.headers["X-Frame-Options"] = "DENY"
-        response.headers["X-XSS-Protection"] = "1"
-        if 'Cache-Control' not in response.headers:
-            response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-        response.headers["Pragma"] = "no-cache"
-        return response
 
-    @app.template_filter()
-    def local_datetime(value, format="%I:%M %p"):
-        tz = tzlocal()
-        utc = pytz.timezone('UTC')
-        value = utc.localize(value, is_dst=None).astimezone(pytz.utc)
-        local_dt = value.astimezone(tz)
-        return local_dt.strftime(format)
+def init_gateway(app):
+    from auth.wifidog import bp
 
-    @app.context_processor
-    def context_processor():
-        """Context processors for use in templates"""
-        return dict(constants=constants, six=six)
+    from flask_login import AnonymousUserMixin
 
-    return app
+    app.register_blueprint(bp)
+    tokens.init_app(app)
+    revocations.init_app(app)
+
+    @app.before_first_request
+    def rebuild_revocations():
+        """Build the revocation bitmap up front, and before forking when preloaded"""
+        if tokens.enabled:
+            try:
+                revocations.rebuild()
+            except SQLAlchemyError:
+                app.logger.exception('Could not rebuild revoked vouchers, will retry on first use')
+
+    if app.config['APP_MODE'] == 'gateway':
+        anonymous = AnonymousUserMixin()
+
+        @app.context_processor
+        def gateway_context_processor():
+            """The shared layout expects current_user, normally set up by Flask-Login"""
+            return dict(current_user=anonymous)
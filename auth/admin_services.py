@@ -0,0 +1,22 @@
+"""
+Extensions only the admin and CLI modes use
+
+They live here rather than in auth.services so that the gateway mode
+doesn't import Flask-Security, Mail, Menu or the healthcheck package.
+"""
+
+from __future__ import absolute_import
+
+from auth.health import PROBES, Probes
+from flask_mail import Mail
+from flask_menu import Menu
+from flask_security import Security
+from healthcheck import HealthCheck, EnvironmentDump
+
+# Probes cache their own results, see HEALTHCHECK_TTL
+healthcheck = HealthCheck(success_ttl=0, failed_ttl=0)
+environment_dump = EnvironmentDump()
+mail = Mail()
+menu = Menu()
+probes = Probes(healthcheck, PROBES)
+security = Security()
@@ -0,0 +1,150 @@
+"""
+Cached category trees and products, as sold by a network or gateway
+
+The categories visible at a gateway (its own and its network's) are read
+with one recursive query from the roots down, and their products with one
+more. The assembled tree is kept in the shared cache under the network's
+generation, which commits that change a category or product of the network
+bump, so a page showing the catalog costs one cache hit.
+"""
+
+from __future__ import absolute_import
+
+import itertools
+
+from auth.models import Category, Product, db, product_categories
+from auth.services import coordination
+from flask import current_app
+from sqlalchemy import and_, event, inspect, literal, or_, select
+from sqlalchemy.orm import Session
+
+PRODUCT_COLUMNS = ('id', 'code', 'title', 'description', 'currency_id', 'price', 'minutes', 'megabytes')
+CATEGORY_COLUMNS = ('id', 'parent_id', 'code', 'title', 'description')
+
+
+def in_scope(table, network_id, gateway_id):
+    return and_(table.c.network_id == network_id,
+                or_(table.c.gateway_id == None, table.c.gateway_id == gateway_id))
+
+
+def category_rows(network_id, gateway_id):
+    """The visible categories, parents before their children"""
+    categories = Category.__table__
+    scoped = in_scope(categories, network_id, gateway_id)
+
+    tree = select([categories.c.id, literal(0).label('depth')]) \
+        .where(scoped) \
+        .where(categories.c.parent_id == None) \
+        .cte('tree', recursive=True)
+
+    parents = tree.alias('parents')
+
+    tree = tree.union_all(
+        select([categories.c.id, parents.c.depth + 1])
+            .where(scoped)
+            .where(categories.c.parent_id == parents.c.id)
+    )
+
+    query = select([categories.c[name] for name in CATEGORY_COLUMNS]) \
+        .select_from(categories.join(tree, tree.c.id == categories.c.id)) \
+        .order_by(tree.c.depth, categories.c.title)
+
+    return db.session.execute(query).fetchall()
+
+
+def product_rows(network_id, gateway_id):
+    """The products for sale, with the id of each of their categories (or None)"""
+    products = Product.__table__
+
+    query = select([products.c[name] for name in PRODUCT_COLUMNS] + [product_categories.c.category_id]) \
+        .select_from(products.outerjoin(product_categories, product_categories.c.product_id == products.c.id)) \
+        .where(in_scope(products, network_id, gateway_id)) \
+        .where(products.c.price != None) \
+        .order_by(products.c.title, products.c.id)
+
+    return db.session.execute(query).fetchall()
+
+
+def build_catalog(network_id, gateway_id=None):
+    """
+    The category tree and products of a network, or of a gateway and its network
+
+    Returns a dict of root categories, each with its products and children,
+    and products outside any visible category.
+    """
+    categories = {}
+    roots = []
+
+    for row in category_rows(network_id, gateway_id):
+        category = dict((name, row[name]) for name in CATEGORY_COLUMNS)
+        category['children'] = []
+        category['products'] = []
+        categories[category['id']] = category
+
+        parent = categories.get(category['parent_id'])
+        (parent['children'] if parent else roots).append(category)
+
+    uncategorized = []
+    placed = set()
+
+    for (id, rows) in itertools.groupby(product_rows(network_id, gateway_id), lambda row: row['id']):
+        rows = list(rows)
+        product = dict((name, rows[0][name]) for name in PRODUCT_COLUMNS)
+
+        for row in rows:
+            if row['category_id'] in categories:
+                categories[row['category_id']]['products'].append(product)
+                placed.add(id)
+
+        if id not in placed:
+            uncategorized.append(product)
+
+    return {
+        'categories': roots,
+        'products': uncategorized,
+    }
+
+
+def catalog(network_id, gateway_id=None):
+    """The catalog from the shared cache, built when missing or out of date"""
+    cache = coordination.cache
+    generation = cache.get_counter('catalog:%s:generation' % network_id)
+    key = 'catalog:%s:%s:%s' % (network_id, gateway_id, generation)
+
+    value = cache.get(key)
+
+    if value is None:
+        value = build_catalog(network_id, gateway_id)
+        cache.set(key, value, current_app.config.get('CATALOG_CACHE_TIMEOUT', 300))
+
+    return value
+
+
+def changed_network_ids(instance):
+    """The networks whose catalogs show the instance, before and after the change"""
+    history = inspect(instance).attrs.network_id.history
+    return set(history.added or ()) | set(history.deleted or ()) | set(history.unchanged or ())
+
+
+@event.listens_for(Session, 'after_flush')
+def track_catalog_changes(session, flush_context):
+    changed = session.info.setdefault('changed_catalogs', set())
+
+    for instance in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(instance, (Category, Product)):
+            changed.update(changed_network_ids(instance))
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_catalogs(session):
+    changed = session.info.pop('changed_catalogs', ())
+
+    if coordination.backend is not None:
+        for network_id in changed:
+            if network_id is not None:
+                coordination.cache.incr('catalog:%s:generation' % network_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_catalog_changes(session):
+    session.info.pop('changed_catalogs', None)
@@ -4,16 +4,22 @@ from __future__ import absolute_import
 
 import csv
 import datetime
+import gzip
 import json
+import os
 import six
+import subprocess
+import sys
+import time
 
+from auth import constants
 from auth.constants import ROLES
-from auth.models import Role, Network, Gateway, Voucher, Country, Currency, Product, db, users
-from auth.services import manager
+from auth.models import Role, Network, Gateway, Voucher, Auth, AuthSummary, Change, Country, Currency, GatewayUsage, Product, User, db, roles_users, users
+from auth.services import coordination, manager
 from flask import current_app
 from flask_script import prompt, prompt_pass
 from flask_security.utils import encrypt_password
-from sqlalchemy import func
+from sqlalchemy import func, inspect, select
 
 
 @manager.command
@@ -23,10 +29,7 @@ def bootstrap_instance(users_csv=None):
     create_roles()
 
     if users_csv:
-        with open(users_csv) as f:
-            for user in csv.reader(f):
-                email, password, role = user
-                create_user(email, password, role)
+        import_users(users_csv)
 
 
 @manager.command
@@ -65,11 +68,21 @@ def bootstrap_tests():
     create_country(u'ZA', u'South Africa')
     create_currency(u'ZA', u'ZAR', u'South Africa', u'R')
 
-    create_product(u'main-network', None, u'90MIN', u'90 Minute Voucher', 'ZAR', 3000, 'available')
-
-
-@manager.command
-def create_product(network_id, gateway_id, code, title, currency_id, price, status='new', quiet=True):
+    create_product(u'main-network', None, u'90MIN', u'90 Minute Voucher', 'ZAR', 3000, 'available', minutes=90)
+
+
+# Spelled out, since minutes and megabytes would both be -m. Options are
+# added bottom up, so the arguments are listed last first.
+@manager.option('--megabytes', dest='megabytes', type=int)
+@manager.option('--minutes', dest='minutes', type=int)
+@manager.option('-s', '--status', dest='status', default='new')
+@manager.option('price', type=int, help='In cents')
+@manager.option('currency_id')
+@manager.option('title')
+@manager.option('code')
+@manager.option('gateway_id')
+@manager.option('network_id')
+def create_product(network_id, gateway_id, code, title, currency_id, price, status='new', minutes=None, megabytes=None, quiet=True):
     product = Product()
 
     product.network_id = network_id
@@ -78,6 +91,8 @@ def create_product(network_id, gateway_id, code, title, currency_id, price, stat
     product.title = title
     product.currency_id = currency_id
     product.price = price
+    product.minutes = minutes
+    product.megabytes = megabytes
     product.status = status
 
     db.session.add(product)
@@ -218,6 +233,192 @@ def create_user(email, password, role, network=None, gateway=None, confirmed=Tru
         print('User created')
 
 
+@manager.command
+def import_users(users_csv, batch_size=1000, processes=None, quiet=False):
+    """
+    Import users from a CSV of email, password, role and optionally network and gateway
+
+    Rows are read as a stream and handled in batches: passwords are hashed on
+    a pool of processes (or in this one, with --processes 0), then users and
+    their roles are inserted in bulk and committed. Rows that fail validation
+    are reported by line and skipped.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    roles = dict(Role.query.with_entities(Role.name, Role.id))
+    networks = set(id for (id,) in Network.query.with_entities(Network.id))
+    gateways = dict(Gateway.query.with_entities(Gateway.id, Gateway.network_id))
+    processes = None if processes is None else int(processes)
+    pool = ProcessPoolExecutor(processes) if processes != 0 else None
+
+    config = dict((key, value) for (key, value) in current_app.config.items()
+                  if key.startswith('SECURITY_') or key == 'SQLALCHEMY_DATABASE_URI')
+
+    imported = 0
+    errors = 0
+
+    try:
+        with open(users_csv) as f:
+            reader = csv.reader(f)
+            batch = []
+
+            while True:
+                row = next(reader, None)
+
+                if row is not None:
+                    batch.append((reader.line_num, row))
+
+                if len(batch) == int(batch_size) or (row is None and batch):
+                    (count, failed) = _import_users_batch(batch, roles, networks, gateways, pool, config)
+
+                    for (line, message) in failed:
+                        print('Line %s: %s' % (line, message))
+
+                    imported += count
+                    errors += len(failed)
+                    batch = []
+
+                    if not quiet:
+                        print('Users imported: %s, errors: %s' % (imported, errors))
+
+                if row is None:
+                    break
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    return imported, errors
+
+
+def _validate_user_row(row, roles, networks, gateways):
+    if len(row) < 3 or len(row) > 5:
+        return 'Expected email, password, role, network and gateway'
+
+    (email, password, role) = row[:3]
+    network = row[3] if len(row) > 3 and row[3] else None
+    gateway = row[4] if len(row) > 4 and row[4] else None
+
+    if not email or not password:
+        return 'Email and password are required'
+
+    if role not in roles:
+        return 'Unknown role: %s' % role
+
+    # Checked here, a foreign key failure would lose the whole batch
+    if network is not None and network not in networks:
+        return 'Unknown network: %s' % network
+
+    if gateway is not None and gateway not in gateways:
+        return 'Unknown gateway: %s' % gateway
+
+    if gateway is not None and gateways[gateway] != network:
+        return 'Gateway %s is not in network %s' % (gateway, network)
+
+    if role == 'network-admin' and (network is None or gateway is not None):
+        return 'A network admin needs a network and no gateway'
+
+    if role == 'gateway-admin' and (network is None or gateway is None):
+        return 'A gateway admin needs a network and a gateway'
+
+
+def _import_users_batch(batch, roles, networks, gateways, pool, config):
+    from auth.passwords import hash_passwords
+
+    failed = []
+    valid = []
+    seen = set()
+
+    for (line, row) in batch:
+        message = _validate_user_row(row, roles, networks, gateways)
+
+        if message is None:
+            key = (row[3] if len(row) > 3 and row[3] else None, row[0])
+
+            if key in seen:
+                message = 'Duplicate user: %s' % row[0]
+            else:
+                seen.add(key)
+                valid.append((line, row, key))
+
+        if message is not None:
+            failed.append((line, message))
+
+    if valid:
+        emails = [key[1] for (_, _, key) in valid]
+        existing = set(User.query.filter(User.email.in_(emails)).with_entities(User.network_id, User.email))
+
+        for item in list(valid):
+            if item[2] in existing:
+                failed.append((item[0], 'User already exists: %s' % item[2][1]))
+                valid.remove(item)
+
+    if not valid:
+        return 0, failed
+
+    passwords = [row[1] for (_, row, _) in valid]
+
+    if pool is None:
+        hashes = [encrypt_password(password) for password in passwords]
+    else:
+        chunks = [passwords[i:i + 100] for i in range(0, len(passwords), 100)]
+        hashes = [h for chunk in pool.map(hash_passwords, [config] * len(chunks), chunks) for h in chunk]
+
+    now = datetime.datetime.now()
+
+    db.session.execute(User.__table__.insert(), [{
+        'email': row[0],
+        'password': password,
+        'network_id': key[0],
+        'gateway_id': row[4] if len(row) > 4 and row[4] else None,
+        'active': True,
+        'confirmed_at': now,
+    } for ((_, row, key), password) in zip(valid, hashes)])
+
+    ids = dict(((network_id, email), id) for (id, network_id, email) in
+               User.query.filter(User.email.in_(emails)).with_entities(User.id, User.network_id, User.email))
+
+    db.session.execute(roles_users.insert(), [{
+        'user_id': ids[key],
+        'role_id': roles[row[2]],
+    } for (_, row, key) in valid])
+
+    db.session.commit()
+
+    return len(valid), sorted(failed)
+
+
+# Spelled out, since `--since` and `--status` would both be -s
+@manager.option('resource', help='auths, changes or vouchers')
+@manager.option('-f', '--format', dest='format', default='csv', help='csv or ndjson')
+@manager.option('-o', '--output', dest='output', help='File to write, stdout by default')
+@manager.option('--since', dest='since', help='YYYY-MM-DD')
+@manager.option('--until', dest='until', help='YYYY-MM-DD')
+@manager.option('-n', '--network', dest='network')
+@manager.option('-g', '--gateway', dest='gateway')
+@manager.option('--status', dest='status')
+@manager.option('-c', '--compress', dest='compress', action='store_true', default=False, help='Gzip the output')
+def export(resource, format='csv', output=None, since=None, until=None, network=None, gateway=None, status=None, compress=False):
+    """Stream auths, changes or vouchers as CSV or NDJSON, to a file or stdout"""
+    from auth.exports import export_filters, export_query, export_rows, gzip_chunks
+
+    model = {'auths': Auth, 'changes': Change, 'vouchers': Voucher}[resource]
+    filters = export_filters(dict(since=since, until=until, network=network, gateway=gateway, status=status))
+
+    chunks = export_rows(resource, export_query(resource, model.query, **filters), format)
+
+    if compress:
+        chunks = gzip_chunks(chunks)
+
+    f = open(output, 'wb') if output else getattr(sys.stdout, 'buffer', sys.stdout)
+
+    try:
+        for chunk in chunks:
+            f.write(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8'))
+    finally:
+        if output:
+            f.close()
+
+
 @manager.command
 def auth_token(email):
     return users.get_user(email).get_auth_token()
@@ -241,14 +442,89 @@ def create_role(name, description, quiet=True):
         print('Role created')
 
 
+@manager.command
+def schedule(interval=None):
+    """Run periodic jobs on whichever node holds the scheduler lease"""
+    interval = int(interval or current_app.config.get('SCHEDULER_INTERVAL', 60))
+    leader = coordination.leader('scheduler', ttl=interval * 2)
+
+    while True:
+        try:
+            coordination.cache.set('scheduler:heartbeat', time.time(), interval * 3)
+            if leader.is_leader():
+                _run_jobs(leader)
+        except Exception:
+            # The coordination backend may be back by the next tick
+            current_app.logger.exception('Scheduler tick failed')
+        time.sleep(interval)
+
+
+def _run_jobs(leader):
+    """Run each periodic job, one failing doesn't keep the rest or the next tick from running"""
+    failed = False
+
+    for job in (process_vouchers, process_transactions):
+        try:
+            job()
+        except Exception:
+            current_app.logger.exception('Scheduled %s failed', job.__name__)
+            db.session.rollback()
+            failed = True
+
+    if failed:
+        # Give another node the chance to take over
+        leader.resign()
+
+
 @manager.command
 def process_vouchers():
+    lock = coordination.lock('process_vouchers', timeout=300)
+
+    if not lock.acquire(blocking=False):
+        print('Vouchers are being processed by another node')
+        return
+
+    # Renewed as the run goes, so a long one keeps other nodes out
+    try:
+        _process_vouchers(lock)
+    finally:
+        lock.release()
+
+
+@manager.command
+def process_transactions(quiet=True):
+    """Settle pending payments with PayU and issue the vouchers of paid orders"""
+    from auth.orders import orders, process_transactions as _process_transactions
+
+    if 'orders' not in current_app.extensions:
+        orders.init_app(current_app)
+
+    lock = coordination.lock('process_transactions', timeout=300)
+
+    if not lock.acquire(blocking=False):
+        print('Transactions are being processed by another node')
+        return
+
+    try:
+        totals = _process_transactions()
+    finally:
+        lock.release()
+
+    if not quiet:
+        for (status, count) in sorted(totals.items()):
+            print('%s: %s' % (status, count))
+
+    return totals
+
+
+def _process_vouchers(lock):
     # Active vouchers that should end
     vouchers = Voucher.query \
                 .filter(Voucher.status == 'active') \
                 .all()
 
     for voucher in vouchers:
+        lock.renew()
         if voucher.should_end():
             voucher.end()
             db.session.add(voucher)
@@ -260,6 +536,7 @@ def process_vouchers():
                 .all()
 
     for voucher in vouchers:
+        lock.renew()
         if voucher.should_expire():
             voucher.expire()
             db.session.add(voucher)
@@ -271,12 +548,378 @@ def process_vouchers():
                 .all()
 
     for voucher in vouchers:
+        lock.renew()
         voucher.archive()
         db.session.add(voucher)
 
+    lock.renew()
     db.session.commit()
 
 
+# Columns added to existing tables since they were first created
+SCHEMA_UPGRADES = (
+    ('vouchers', 'network_id', 'VARCHAR(20) REFERENCES networks (id) ON UPDATE cascade'),
+    ('auths', 'network_id', 'VARCHAR(20) REFERENCES networks (id) ON UPDATE cascade'),
+    ('vouchers', 'version', 'INTEGER NOT NULL DEFAULT 1'),
+    ('gateways', 'updated_at', 'DATETIME'),
+    ('gateways', 'timezone', 'VARCHAR(40)'),
+    ('networks', 'timezone', 'VARCHAR(40)'),
+    ('products', 'minutes', 'INTEGER'),
+    ('products', 'megabytes', 'BIGINT'),
+    ('order_items', 'order_id', 'INTEGER REFERENCES orders (id) ON UPDATE cascade'),
+    ('vouchers', 'order_id', 'INTEGER REFERENCES orders (id) ON UPDATE cascade'),
+)
+
+
+@manager.command
+def upgrade_schema(quiet=True):
+    """Add missing columns, tables and indexes to an existing database"""
+    db.create_all()
+
+    inspector = inspect(db.engine)
+
+    for table, column, ddl in SCHEMA_UPGRADES:
+        if column not in [c['name'] for c in inspector.get_columns(table)]:
+            db.engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, ddl))
+
+            if not quiet:
+                print('Column added: %s.%s' % (table, column))
+
+    for table in db.metadata.sorted_tables:
+        existing = [i['name'] for i in inspector.get_indexes(table.name)]
+
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db.engine)
+
+                if not quiet:
+                    print('Index added: %s' % index.name)
+
+
+@manager.command
+def rebuild_usage(quiet=True):
+    """Recompute the daily gateway usage totals from vouchers and their changes"""
+    upgrade_schema(quiet)
+
+    vouchers = Voucher.__table__
+    changes = Change.__table__
+    started_day = func.date(func.coalesce(vouchers.c.started_at, vouchers.c.created_at))
+
+    queries = (
+        (('vouchers_created',),
+         select([vouchers.c.gateway_id, vouchers.c.network_id, func.date(vouchers.c.created_at),
+                 func.count()])
+            .group_by(vouchers.c.gateway_id, vouchers.c.network_id, func.date(vouchers.c.created_at))),
+        (('vouchers_started',),
+         select([vouchers.c.gateway_id, vouchers.c.network_id, func.date(vouchers.c.started_at),
+                 func.count()])
+            .where(vouchers.c.started_at != None)
+            .group_by(vouchers.c.gateway_id, vouchers.c.network_id, func.date(vouchers.c.started_at))),
+        (('incoming', 'outgoing'),
+         select([vouchers.c.gateway_id, vouchers.c.network_id, started_day,
+                 func.sum(vouchers.c.incoming), func.sum(vouchers.c.outgoing)])
+            .group_by(vouchers.c.gateway_id, vouchers.c.network_id, started_day)),
+        (('vouchers_ended',),
+         select([vouchers.c.gateway_id, vouchers.c.network_id, func.date(changes.c.created_at),
+                 func.count()])
+            .select_from(changes.join(vouchers, vouchers.c.id == changes.c.changed_id))
+            .where(changes.c.changed_type == 'Voucher')
+            .where(changes.c.event == 'end')
+            .group_by(vouchers.c.gateway_id, vouchers.c.network_id, func.date(changes.c.created_at))),
+    )
+
+    totals = {}
+
+    # The lock keeps rebuilds apart. Writers adding to the totals meanwhile
+    # wait on the deleted rows, so their events are counted once: by the
+    # queries below if committed before them, or on top of the rebuilt rows.
+    with coordination.lock('rebuild_usage', timeout=300):
+        db.session.execute(GatewayUsage.__table__.delete())
+
+        for (names, query) in queries:
+            for row in db.session.execute(query):
+                day = row[2]
+
+                # SQLite hands back dates as strings
+                if isinstance(day, six.string_types):
+                    day = datetime.datetime.strptime(day, '%Y-%m-%d').date()
+
+                total = totals.setdefault((row[0], day), {'gateway_id': row[0], 'network_id': row[1], 'day': day})
+                total.update(zip(names, [value or 0 for value in row[3:]]))
+
+        if totals:
+            db.session.execute(GatewayUsage.__table__.insert(), [
+                dict(dict.fromkeys(('vouchers_created', 'vouchers_started', 'vouchers_ended',
+                                    'incoming', 'outgoing'), 0), **total)
+                for total in totals.values()
+            ])
+
+        db.session.commit()
+
+    if not quiet:
+        print('Usage rebuilt: %s gateway days' % len(totals))
+
+
+@manager.command
+def generate(networks=2, gateways=100, vouchers=10000, days=30, seed=0, until=None, prefix=u'synthetic',
+             batch_size=5000, auth_interval=15, quiet=False):
+    """
+    Generate synthetic networks, gateways, vouchers, auths and changes for benchmarking
+
+    Vouchers are created over the days before until (YYYY-MM-DD, today by
+    default) and taken through the voucher state machine. The same seed and
+    until give the same data. Usage totals are rebuilt afterwards.
+    """
+    from auth.synthetic import generate_data
+
+    if until is not None:
+        until = datetime.datetime.strptime(until, '%Y-%m-%d')
+
+    def progress(totals):
+        if not quiet:
+            print('Vouchers: %(vouchers)s, auths: %(auths)s, changes: %(changes)s' % totals)
+
+    try:
+        totals = generate_data(int(networks), int(gateways), int(vouchers), int(days), int(seed), until, prefix,
+                               int(batch_size), int(auth_interval), current_app.config.get('VOUCHER_MAXAGE'), progress)
+    except ValueError as e:
+        print(e)
+        return
+
+    rebuild_usage(quiet)
+
+    return totals
+
+
+@manager.command
+def backfill_network_ids(quiet=True):
+    """Populate the denormalized network_id on vouchers and auths"""
+    upgrade_schema(quiet)
+
+    gateways = Gateway.__table__
+
+    for model in (Voucher, Auth):
+        table = model.__table__
+
+        network_id = select([gateways.c.network_id]) \
+                        .where(gateways.c.id == table.c.gateway_id) \
+                        .as_scalar()
+
+        result = db.engine.execute(
+            table.update()
+                 .where(table.c.network_id.is_(None))
+                 .values(network_id=network_id)
+        )
+
+        if not quiet:
+            print('%s backfilled: %s' % (table.name, result.rowcount))
+
+
+AUTH_ARCHIVE_COLUMNS = (
+    'id',
+    'created_at',
+    'network_id',
+    'gateway_id',
+    'voucher_id',
+    'stage',
+    'status',
+    'ip',
+    'mac',
+    'token',
+    'incoming',
+    'outgoing',
+    'user_agent',
+    'messages',
+)
+
+
+@manager.command
+def prune_auths(days=None, batch_size=500, archive_dir=None, quiet=True):
+    """Archive, roll up and delete auths older than the retention period"""
+    days = int(days or current_app.config.get('AUTHS_RETENTION_DAYS', 30))
+    archive_dir = archive_dir or current_app.config.get('AUTHS_ARCHIVE_DIR')
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+
+    lock = coordination.lock('prune_auths', timeout=300)
+
+    if not lock.acquire(blocking=False):
+        print('Auths are being pruned by another node')
+        return
+
+    try:
+        total = 0
+
+        # Each batch commits on its own, so an interrupted run picks up where it stopped
+        while True:
+            count = _prune_auths_batch(cutoff, int(batch_size), archive_dir)
+
+            if count == 0:
+                break
+
+            total += count
+            lock.extend()
+
+            if not quiet:
+                print('Auths pruned: %s' % total)
+    finally:
+        lock.release()
+
+
+def _prune_auths_batch(cutoff, batch_size, archive_dir):
+    table = Auth.__table__
+
+    rows = db.session.execute(
+        select([table.c[name] for name in AUTH_ARCHIVE_COLUMNS])
+            .where(table.c.created_at < cutoff)
+            .order_by(table.c.id)
+            .limit(batch_size)
+    ).fetchall()
+
+    if not rows:
+        return 0
+
+    if archive_dir:
+        _archive_auths(archive_dir, rows)
+
+    _rollup_auths(rows)
+
+    # The batch is exactly the old rows up to its last id
+    db.session.execute(
+        table.delete()
+             .where(table.c.id <= rows[-1].id)
+             .where(table.c.created_at < cutoff)
+    )
+    db.session.commit()
+
+    return len(rows)
+
+
+def _archive_auths(archive_dir, rows):
+    if not os.path.isdir(archive_dir):
+        os.makedirs(archive_dir)
+
+    filename = os.path.join(archive_dir, 'auths-%010d-%010d.csv.gz' % (rows[0].id, rows[-1].id))
+
+    if six.PY3:
+        f = gzip.open(filename + '.tmp', 'wt', newline='')
+    else:
+        f = gzip.open(filename + '.tmp', 'wb')
+
+    with f:
+        writer = csv.writer(f)
+        writer.writerow(AUTH_ARCHIVE_COLUMNS)
+        writer.writerows(rows)
+
+    os.rename(filename + '.tmp', filename)
+
+
+def _max(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
+
+
+def _rollup_auths(rows):
+    summaries = {}
+
+    for row in rows:
+        hour = row.created_at.replace(minute=0, second=0, microsecond=0)
+        key = (row.gateway_id, row.voucher_id, hour)
+
+        if key not in summaries:
+            summaries[key] = AuthSummary(
+                network_id=row.network_id,
+                gateway_id=row.gateway_id,
+                voucher_id=row.voucher_id,
+                hour=hour,
+                requests=0,
+                allowed=0,
+                denied=0,
+                first_at=row.created_at,
+                last_at=row.created_at
+            )
+
+        summary = summaries[key]
+        summary.requests += 1
+        summary.allowed += int(row.status == constants.AUTH_ALLOWED)
+        summary.denied += int(row.status == constants.AUTH_DENIED)
+        summary.incoming = _max(summary.incoming, row.incoming)
+        summary.outgoing = _max(summary.outgoing, row.outgoing)
+        summary.last_at = row.created_at
+
+    hours = [key[2] for key in summaries]
+
+    existing = dict(
+        ((s.gateway_id, s.voucher_id, s.hour), s)
+        for s in AuthSummary.query
+                    .filter(AuthSummary.hour.between(min(hours), max(hours)))
+                    .filter(AuthSummary.gateway_id.in_(set(key[0] for key in summaries)))
+    )
+
+    for key, summary in six.iteritems(summaries):
+        if key in existing:
+            current = existing[key]
+            current.requests += summary.requests
+            current.allowed += summary.allowed
+            current.denied += summary.denied
+            current.incoming = _max(current.incoming, summary.incoming)
+            current.outgoing = _max(current.outgoing, summary.outgoing)
+            current.first_at = min(current.first_at, summary.first_at)
+            current.last_at = max(current.last_at, summary.last_at)
+        else:
+            db.session.add(summary)
+
+
+STARTUP_BENCHMARK = '''
+import resource, time
+start = time.time()
+from auth import create_app
+create_app(mode=%r)
+print('%%f %%d' %% (time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+'''
+
+
+@manager.command
+def benchmark_startup(runs=5):
+    """Measure cold import and app creation time, and peak RSS, for each app mode"""
+    from auth import MODES
+
+    root = os.path.dirname(current_app.root_path)
+
+    for mode in MODES:
+        timings = []
+        rss = []
+
+        for run in range(int(runs)):
+            output = subprocess.check_output([sys.executable, '-c', STARTUP_BENCHMARK % mode], cwd=root)
+            (seconds, kilobytes) = output.decode().split()[-2:]
+            timings.append(float(seconds))
+            rss.append(int(kilobytes))
+
+        print('%-8s best %.3fs  median %.3fs  max RSS %.1f MB' % (
+            mode,
+            min(timings),
+            sorted(timings)[len(timings) // 2],
+            max(rss) / 1024.0
+        ))
+
+
+@manager.command
+def benchmark_passwords(target_ms=250, scheme=None):
+    """Suggest SECURITY_PASSWORD_ROUNDS for hashing within a target time on this machine"""
+    from auth.passwords import benchmark
+
+    scheme = scheme or current_app.config['SECURITY_PASSWORD_HASH']
+    (best, results) = benchmark(scheme, int(target_ms) / 1000.0)
+
+    for (rounds, seconds) in results:
+        print('%-14s rounds %-8s %.1f ms' % (scheme, rounds, seconds * 1000))
+
+    print('SECURITY_PASSWORD_ROUNDS=%s' % best[0])
+
+
 @manager.command
 def measurements():
     (incoming, outgoing) = db.session.query(func.sum(Voucher.incoming), func.sum(Voucher.outgoing)).filter(Voucher.status == 'active').first()
@@ -0,0 +1,258 @@
+"""
+Shared cache, lock and leader election backends for running several nodes
+"""
+
+from __future__ import absolute_import
+
+import os
+import socket
+import threading
+import time
+import uuid
+
+from six.moves import cPickle as pickle
+from six.moves.urllib.parse import urlparse
+
+
+class LockError(Exception):
+    pass
+
+
+class MemoryBackend(object):
+    """In-process stand-in for the subset of the StrictRedis API we use"""
+
+    def __init__(self):
+        self._data = {}
+        self._mutex = threading.RLock()
+
+    def _get(self, key):
+        item = self._data.get(key)
+        if item is not None:
+            value, expires_at = item
+            if expires_at is None or expires_at > time.time():
+                return value
+            del self._data[key]
+
+    def get(self, key):
+        with self._mutex:
+            return self._get(key)
+
+    def set(self, key, value, ex=None, px=None, nx=False):
+        with self._mutex:
+            if nx and self._get(key) is not None:
+                return None
+            if px is None and ex is not None:
+                px = ex * 1000
+            expires_at = None if px is None else time.time() + px / 1000.0
+            self._data[key] = (value, expires_at)
+            return True
+
+    def delete(self, *keys):
+        with self._mutex:
+            return len([self._data.pop(key) for key in keys if self._get(key) is not None])
+
+    def incr(self, key, amount=1):
+        with self._mutex:
+            item = self._data.get(key)
+            expires_at = item[1] if item is not None else None
+            value = int(self._get(key) or 0) + amount
+            self._data[key] = (value, expires_at)
+            return value
+
+    def delete_if(self, key, value):
+        with self._mutex:
+            if self._get(key) == value:
+                del self._data[key]
+                return True
+            return False
+
+    def expire_if(self, key, value, px):
+        with self._mutex:
+            if self._get(key) == value:
+                self._data[key] = (value, time.time() + px / 1000.0)
+                return True
+            return False
+
+
+class RedisBackend(object):
+    """Thin wrapper over StrictRedis adding atomic compare-and-delete/expire"""
+
+    DELETE_IF = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+    EXPIRE_IF = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+    def __init__(self, url):
+        from redis import StrictRedis
+
+        self.redis = StrictRedis.from_url(url)
+        self._delete_if = self.redis.register_script(self.DELETE_IF)
+        self._expire_if = self.redis.register_script(self.EXPIRE_IF)
+
+    def get(self, key):
+        return self.redis.get(key)
+
+    def set(self, key, value, ex=None, px=None, nx=False):
+        return self.redis.set(key, value, ex=ex, px=px, nx=nx)
+
+    def delete(self, *keys):
+        return self.redis.delete(*keys)
+
+    def incr(self, key, amount=1):
+        return self.redis.incr(key, amount)
+
+    def delete_if(self, key, value):
+        return bool(self._delete_if(keys=[key], args=[value]))
+
+    def expire_if(self, key, value, px):
+        return bool(self._expire_if(keys=[key], args=[value, px]))
+
+
+def create_backend(url):
+    scheme = urlparse(url).scheme
+
+    if scheme == 'memory':
+        return MemoryBackend()
+
+    if scheme in ('redis', 'rediss', 'unix'):
+        return RedisBackend(url)
+
+    raise ValueError('Unknown coordination backend: %s' % url)
+
+
+def node_id():
+    return '%s:%s:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+class Cache(object):
+    def __init__(self, backend, prefix):
+        self.backend = backend
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.backend.get(self.prefix + key)
+        if value is not None:
+            return pickle.loads(value)
+
+    def set(self, key, value, timeout=None):
+        self.backend.set(self.prefix + key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), ex=timeout)
+
+    def delete(self, *keys):
+        if keys:
+            self.backend.delete(*[self.prefix + key for key in keys])
+
+    def incr(self, key, amount=1):
+        return self.backend.incr(self.prefix + key, amount)
+
+    def get_counter(self, key):
+        """Read a value maintained by incr, which is stored unpickled"""
+        return int(self.backend.get(self.prefix + key) or 0)
+
+
+class Lock(object):
+    """Expiring lock, safe to release only by the holder"""
+
+    def __init__(self, backend, name, timeout=60, blocking_timeout=10, sleep=0.05):
+        self.backend = backend
+        self.name = name
+        self.timeout = timeout
+        self.blocking_timeout = blocking_timeout
+        self.sleep = sleep
+        self.token = None
+        self.extended_at = None
+
+    def acquire(self, blocking=True):
+        token = uuid.uuid4().hex
+        deadline = time.time() + (self.blocking_timeout or 0)
+
+        while True:
+            if self.backend.set(self.name, token, px=int(self.timeout * 1000), nx=True):
+                self.token = token
+                self.extended_at = time.time()
+                return True
+
+            if not blocking or time.time() >= deadline:
+                return False
+
+            time.sleep(self.sleep)
+
+    def extend(self):
+        """Push the expiry out by another timeout, if still held"""
+        if self.token is not None and self.backend.expire_if(self.name, self.token, int(self.timeout * 1000)):
+            self.extended_at = time.time()
+            return True
+        return False
+
+    def renew(self):
+        """
+        Extend the lock once half its timeout has passed, for work that may
+        outlast it, raising LockError if it expired and was lost meanwhile
+        """
+        if self.extended_at is not None and time.time() - self.extended_at < self.timeout / 2.0:
+            return
+
+        if not self.extend():
+            raise LockError('Lost lock: %s' % self.name)
+
+    def release(self):
+        if self.token is not None:
+            self.backend.delete_if(self.name, self.token)
+            self.token = None
+
+    def __enter__(self):
+        if not self.acquire():
+            raise LockError('Could not acquire lock: %s' % self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class Leader(object):
+    """Lease based leader election, renewed each time is_leader is called"""
+
+    def __init__(self, backend, name, ttl=30):
+        self.backend = backend
+        self.name = name
+        self.ttl = ttl
+        self.token = node_id()
+
+    def is_leader(self):
+        px = int(self.ttl * 1000)
+        return bool(self.backend.set(self.name, self.token, px=px, nx=True)
+                    or self.backend.expire_if(self.name, self.token, px))
+
+    def resign(self):
+        self.backend.delete_if(self.name, self.token)
+
+
+class Coordination(object):
+    def __init__(self, app=None):
+        self.backend = None
+        self.prefix = ''
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.backend = create_backend(app.config.get('COORDINATION_URL', 'memory://'))
+        self.prefix = app.config.get('COORDINATION_PREFIX', 'auth:')
+        app.extensions['coordination'] = self
+
+    @property
+    def cache(self):
+        return Cache(self.backend, self.prefix + 'cache:')
+
+    def lock(self, name, **kwargs):
+        return Lock(self.backend, self.prefix + 'lock:' + name, **kwargs)
+
+    def leader(self, name, ttl=30):
+        return Leader(self.backend, self.prefix + 'leader:' + name, ttl)
@@ -0,0 +1,118 @@
+"""
+Coalesce voucher counter updates in process between flushes
+
+Counters are flushed by the auths of the process once an interval has
+passed, by a thread of its own when no auths come in, and on exit.
+"""
+
+from __future__ import absolute_import
+
+import atexit
+import os
+import threading
+import time
+
+from flask import current_app
+
+
+class CounterBuffer(object):
+    def __init__(self, app=None):
+        self.app = None
+        self.window = 0
+        self._pending = {}
+        self._mutex = threading.Lock()
+        self._flushed_at = time.time()
+        self._pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.window = app.config.get('COUNTERS_FLUSH_INTERVAL', 0)
+        app.extensions['counters'] = self
+
+    @property
+    def enabled(self):
+        return self.window > 0
+
+    def add(self, voucher_id, incoming, outgoing):
+        """Record the newest counters, returning the highest seen since the last flush"""
+        with self._mutex:
+            (pending_incoming, pending_outgoing) = self._pending.get(voucher_id, (0, 0))
+            value = (max(pending_incoming, incoming), max(pending_outgoing, outgoing))
+            self._pending[voucher_id] = value
+
+            # Started in each process on first use, threads don't survive a fork
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._start()
+
+            return value
+
+    def pop(self, voucher_id):
+        with self._mutex:
+            return self._pending.pop(voucher_id, None)
+
+    def due(self):
+        return bool(self._pending) and time.time() - self._flushed_at >= self.window
+
+    def drain(self):
+        with self._mutex:
+            pending, self._pending = self._pending, {}
+            self._flushed_at = time.time()
+        return [(voucher_id, incoming, outgoing) for voucher_id, (incoming, outgoing) in pending.items()]
+
+    def restore(self, values):
+        for (voucher_id, incoming, outgoing) in values:
+            self.add(voucher_id, incoming, outgoing)
+
+    def flush(self):
+        """Write the pending counters, keeping them for the next flush if that fails"""
+        from auth.models import Voucher, db
+
+        pending = self.drain()
+
+        if not pending:
+            return
+
+        try:
+            Voucher.write_counters(pending)
+            db.session.commit()
+        except Exception:
+            current_app.logger.exception('Could not flush voucher counters')
+            db.session.rollback()
+            self.restore(pending)
+
+    def flush_app(self, app=None):
+        """Flush in an app context of its own, off any request"""
+        from auth.models import db
+
+        app = app or self.app
+
+        if app is None or not self._pending:
+            return
+
+        with app.app_context():
+            try:
+                self.flush()
+            finally:
+                db.session.remove()
+
+    def _start(self):
+        thread = threading.Thread(target=self._run, name='counters-flush')
+        thread.daemon = True
+        thread.start()
+
+        atexit.register(self.flush_app)
+
+    def _run(self):
+        while True:
+            # Checked at least every second, the interval may be changed meanwhile
+            time.sleep(min(self.window, 1) or 1)
+
+            if self.enabled and self.due():
+                try:
+                    self.flush_app()
+                except Exception:
+                    # Keep the thread going, the next tick tries again
+                    self.app.logger.exception('Could not flush voucher counters')
@@ -0,0 +1,152 @@
+"""
+Stream vouchers, auths and changes as CSV or NDJSON
+"""
+
+from __future__ import absolute_import
+
+import csv
+import datetime
+import json
+import zlib
+
+import six
+
+from auth.models import Auth, Change, Voucher
+
+EXPORTS = {
+    'auths': (Auth, (
+        'id', 'created_at', 'network_id', 'gateway_id', 'voucher_id', 'stage',
+        'ip', 'mac', 'token', 'incoming', 'outgoing', 'status', 'messages', 'user_agent',
+    )),
+    'changes': (Change, (
+        'id', 'created_at', 'changed_type', 'changed_id', 'event', 'source',
+        'destination', 'args', 'user_id',
+    )),
+    'vouchers': (Voucher, (
+        'id', 'created_at', 'updated_at', 'started_at', 'network_id', 'gateway_id',
+        'code', 'status', 'minutes', 'megabytes', 'incoming', 'outgoing',
+        'mac', 'ip', 'name', 'email',
+    )),
+}
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+CHUNK_SIZE = 64 * 1024
+
+
+def export_query(resource, query, since=None, until=None, network=None, gateway=None, status=None, batch_size=1000):
+    """
+    Filter a (scoped) query for export and have it stream its rows
+
+    Only the exported columns are loaded, as plain tuples, and rows are
+    fetched from a server-side cursor in batches.
+    """
+    (model, columns) = EXPORTS[resource]
+
+    if since is not None:
+        query = query.filter(model.created_at >= since)
+
+    if until is not None:
+        query = query.filter(model.created_at < until)
+
+    if network is not None and hasattr(model, 'network_id'):
+        query = query.filter(model.network_id == network)
+
+    if gateway is not None and hasattr(model, 'gateway_id'):
+        query = query.filter(model.gateway_id == gateway)
+
+    if status is not None and hasattr(model, 'status'):
+        query = query.filter(model.status == status)
+
+    return (query.with_entities(*[getattr(model, column) for column in columns])
+                 .order_by(model.id)
+                 .execution_options(stream_results=True)
+                 .yield_per(batch_size))
+
+
+def _value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def _csv_value(value):
+    value = _value(value)
+    if six.PY2 and isinstance(value, six.text_type):
+        return value.encode('utf-8')
+    return value
+
+
+class _Buffer(object):
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        self.parts.append(data)
+        self.size += len(data)
+
+    def flush(self):
+        data = ''.join(self.parts)
+        self.parts = []
+        self.size = 0
+        return data
+
+
+def export_rows(resource, rows, format='csv'):
+    """Yield the rows in the given format, in chunks of about CHUNK_SIZE"""
+    (model, columns) = EXPORTS[resource]
+    buf = _Buffer()
+
+    if format == 'csv':
+        writer = csv.writer(buf)
+        writer.writerow(columns)
+
+        for row in rows:
+            writer.writerow([_csv_value(value) for value in row])
+            if buf.size >= CHUNK_SIZE:
+                yield buf.flush()
+    elif format == 'ndjson':
+        for row in rows:
+            buf.write(json.dumps(dict(zip(columns, [_value(value) for value in row]))) + '\n')
+            if buf.size >= CHUNK_SIZE:
+                yield buf.flush()
+    else:
+        raise ValueError('Unknown export format: %s' % format)
+
+    if buf.size:
+        yield buf.flush()
+
+
+def gzip_chunks(chunks):
+    """Compress a stream of text chunks into a gzip stream"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    for chunk in chunks:
+        if isinstance(chunk, six.text_type):
+            chunk = chunk.encode('utf-8')
+
+        data = compressor.compress(chunk)
+
+        if data:
+            yield data
+
+    yield compressor.flush()
+
+
+def export_filters(args):
+    """Read export filters from request args or command options, dates as YYYY-MM-DD"""
+    filters = {}
+
+    for key in ('since', 'until'):
+        if args.get(key):
+            filters[key] = datetime.datetime.strptime(args[key], '%Y-%m-%d')
+
+    for key in ('network', 'gateway', 'status'):
+        if args.get(key):
+            filters[key] = args[key]
+
+    return filters
@@ -1,14 +1,17 @@
 from __future__ import absolute_import
 
+import pytz
+
+from auth.options import resource_options, role_options
 from auth.utils import args_get
-from flask_security import current_user
+from flask_login import current_user
 from flask_wtf import FlaskForm
+from six import text_type
 from wtforms import BooleanField, HiddenField, PasswordField, StringField, IntegerField, SelectField, fields as f, validators
 from wtforms.ext.sqlalchemy.fields import QuerySelectField, QuerySelectMultipleField
 from wtforms.ext.sqlalchemy.orm import converts, model_form, ModelConverter
 
 from auth.models import db, Category, Country, Currency, Gateway, Network, Product, Voucher, Role
-from auth.resources import api
 
 def default_megabytes():
     if current_user.gateway is not None:
@@ -18,17 +21,98 @@ def default_minutes():
     if current_user.gateway is not None:
         return current_user.gateway.default_minutes
 
-def instances(resource):
-    def func():
-        return api.resources[resource].manager.instances()
-    return func
+def validate_timezone(form, field):
+    if field.data and field.data not in pytz.all_timezones_set:
+        raise validators.ValidationError('Unknown timezone, use a name like Africa/Johannesburg')
+
+class OptionsMixin(object):
+    """
+    Renders choices from cached (id, label) options, and only loads the
+    selected instances from the database
+    """
+    def __init__(self, label=None, validators=None, model=None, options=None, **kwargs):
+        kwargs.pop('query_factory', None)
+        super(OptionsMixin, self).__init__(
+            label,
+            validators,
+            get_pk=lambda option: option[0],
+            get_label=lambda option: option[1],
+            **kwargs
+        )
+        self.model = model
+        self.options = options
+
+    def _get_object_list(self):
+        if self._object_list is None:
+            self._object_list = [(text_type(option[0]), option) for option in self.options()]
+        return self._object_list
+
+    def _option_ids(self):
+        return set(option[0] for pk, option in self._get_object_list())
+
+class OptionSelectField(OptionsMixin, QuerySelectField):
+    def _get_data(self):
+        if self._formdata is not None:
+            for pk, option in self._get_object_list():
+                if pk == self._formdata:
+                    self._set_data(db.session.query(self.model).get(option[0]))
+                    break
+        return self._data
+
+    data = property(_get_data, QuerySelectField._set_data)
+
+    def iter_choices(self):
+        if self.allow_blank:
+            yield ('__None', self.blank_text, self.data is None)
+
+        selected = getattr(self.data, 'id', None)
+
+        for pk, option in self._get_object_list():
+            yield (pk, option[1], option[0] == selected)
+
+    def pre_validate(self, form):
+        data = self.data
+        if data is not None:
+            if data.id not in self._option_ids():
+                raise validators.ValidationError(self.gettext('Not a valid choice'))
+        elif self._formdata or not self.allow_blank:
+            raise validators.ValidationError(self.gettext('Not a valid choice'))
+
+class OptionSelectMultipleField(OptionsMixin, QuerySelectMultipleField):
+    def _get_data(self):
+        formdata = self._formdata
+        if formdata is not None:
+            ids = [option[0] for pk, option in self._get_object_list() if pk in formdata]
+            self._invalid_formdata = len(ids) < len(formdata)
+            if ids:
+                self._set_data(db.session.query(self.model).filter(self.model.id.in_(ids)).all())
+            else:
+                self._set_data([])
+        return self._data
+
+    data = property(_get_data, QuerySelectMultipleField._set_data)
+
+    def iter_choices(self):
+        selected = set(instance.id for instance in self.data)
+
+        for pk, option in self._get_object_list():
+            yield (pk, option[1], option[0] in selected)
+
+    def pre_validate(self, form):
+        if self._invalid_formdata:
+            raise validators.ValidationError(self.gettext('Not a valid choice'))
+        elif self.data:
+            ids = self._option_ids()
+            for instance in self.data:
+                if instance.id not in ids:
+                    raise validators.ValidationError(self.gettext('Not a valid choice'))
 
-def roles():
-    if current_user.has_role(u'super-admin'):
-        return db.session.query(Role).all()
-    if current_user.has_role(u'network-admin'):
-        return db.session.query(Role).filter(Role.name == u'gateway-admin').all()
-    return []
+class OptionsConverter(ModelConverter):
+    @converts('MANYTOONE')
+    def conv_ManyToOne(self, field_args, **extra):
+        if 'options' in field_args:
+            return OptionSelectField(model=extra['prop'].mapper.class_, **field_args)
+        return ModelConverter.conv_ManyToOne(self, field_args, **extra)
 
 CategoryForm = model_form(
     Category,
@@ -45,13 +129,14 @@ CategoryForm = model_form(
     field_args={
         'gateway': {
             'default': lambda: current_user.gateway,
-            'query_factory': instances('gateways'),
+            'options': resource_options('gateways'),
         },
         'network': {
             'default': lambda: current_user.network,
-            'query_factory': instances('networks'),
+            'options': resource_options('networks'),
         }
-    }
+    },
+    converter=OptionsConverter()
 )
 CountryForm = model_form(
     Country,
@@ -77,13 +162,13 @@ CurrencyForm = model_form(
 )
 
 
-class GatewayConverter(ModelConverter):
+class GatewayConverter(OptionsConverter):
     @converts('String', 'Unicode')
     def conv_String(self, field_args, **extra):
         if extra['column'].name == 'logo':
             return f.FileField(**field_args)
         else:
-            return ModelConverter.conv_String(self, field_args, **extra)
+            return OptionsConverter.conv_String(self, field_args, **extra)
 
 
 GatewayForm = model_form(
@@ -97,6 +182,7 @@ GatewayForm = model_form(
         'orders',
         'products',
         'updated_at',
+        'usage',
         'users',
         'vouchers',
     ],
@@ -107,8 +193,12 @@ GatewayForm = model_form(
         },
         'network': {
             'default': lambda: current_user.network,
-            'query_factory': instances('networks'),
-        }
+            'options': resource_options('networks'),
+        },
+        'timezone': {
+            'description': 'Leave empty to use the network timezone.',
+            'validators': [validate_timezone],
+        },
     },
     converter=GatewayConverter()
 )
@@ -117,15 +207,23 @@ NetworkForm = model_form(
     db.session,
     FlaskForm,
     exclude=[
+        'auths',
         'categories',
         'created_at',
         'gateways',
         'orders',
         'products',
         'updated_at',
+        'usage',
         'users',
+        'vouchers',
     ],
-    exclude_pk=False
+    exclude_pk=False,
+    field_args={
+        'timezone': {
+            'validators': [validate_timezone],
+        },
+    }
 )
 ProductForm = model_form(
     Product,
@@ -138,20 +236,24 @@ ProductForm = model_form(
         'updated_at',
     ],
     field_args={
+        'currency': {
+            'options': resource_options('currencies'),
+        },
         'gateway': {
             'default': lambda: current_user.gateway,
-            'query_factory': instances('gateways'),
+            'options': resource_options('gateways'),
         },
         'network': {
             'default': lambda: current_user.network,
-            'query_factory': instances('networks'),
+            'options': resource_options('networks'),
         }
-    }
+    },
+    converter=OptionsConverter()
 )
 
 class UserForm(FlaskForm):
-    network = QuerySelectField('Network', allow_blank=True, default=lambda: current_user.network, query_factory=instances('networks'))
-    gateway = QuerySelectField('Gateway', allow_blank=True, default=lambda: current_user.gateway, query_factory=instances('gateways'))
+    network = OptionSelectField('Network', model=Network, allow_blank=True, default=lambda: current_user.network, options=resource_options('networks'))
+    gateway = OptionSelectField('Gateway', model=Gateway, allow_blank=True, default=lambda: current_user.gateway, options=resource_options('gateways'))
     email = StringField('Email')
     password = PasswordField(
         'Password',
@@ -163,7 +265,7 @@ class UserForm(FlaskForm):
     )
     confirm = PasswordField('Repeat Password')
     active = BooleanField('Active', default=True)
-    roles = QuerySelectMultipleField('Roles', query_factory=roles)
+    roles = OptionSelectMultipleField('Roles', model=Role, options=role_options)
 
 class MyUserForm(FlaskForm):
     email = StringField('Email')
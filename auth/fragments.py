@@ -0,0 +1,60 @@
+"""
+Cache rendered template fragments in the shared cache
+"""
+
+from __future__ import absolute_import
+
+import hashlib
+
+import six
+
+from auth.services import coordination
+from flask import current_app
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+
+class FragmentCacheExtension(Extension):
+    """
+    Adds a cache tag, caching what it encloses under a key made of its arguments:
+
+        {% cache 'portal-header', gateway.id, gateway.updated_at %}
+            ...
+        {% endcache %}
+
+    Include whatever the fragment depends on in the key, it is never invalidated
+    otherwise; entries expire after FRAGMENT_CACHE_TIMEOUT seconds (0 disables).
+    """
+
+    tags = set(['cache'])
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+
+        args = [parser.parse_expression()]
+
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+
+        return nodes.CallBlock(self.call_method('_cache', [nodes.List(args)]), [], [], body).set_lineno(lineno)
+
+    def _cache(self, parts, caller):
+        timeout = current_app.config.get('FRAGMENT_CACHE_TIMEOUT', 0)
+
+        if not timeout:
+            return caller()
+
+        key = u':'.join(six.text_type(part) for part in parts)
+        key = 'fragment:' + hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+        cache = coordination.cache
+        value = cache.get(key)
+
+        if value is None:
+            value = caller()
+            cache.set(key, six.text_type(value), timeout)
+
+        return Markup(value)
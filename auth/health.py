@@ -0,0 +1,163 @@
+"""
+Dependency probes behind /healthcheck, run concurrently and cached briefly
+"""
+
+from __future__ import absolute_import
+
+import os
+import socket
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, wait
+from flask import current_app
+from sqlalchemy.engine.url import make_url
+
+
+class Probes(object):
+    """
+    Runs every registered probe at once, each with a timeout, and keeps the
+    results for HEALTHCHECK_TTL seconds so that frequent checks by an
+    orchestrator only reach the dependencies once per interval
+    """
+
+    def __init__(self, healthcheck, probes=(), app=None):
+        self.healthcheck = healthcheck
+        self.probes = []
+        self.executor = ThreadPoolExecutor(max_workers=8)
+        self._mutex = threading.Lock()
+        for func in probes:
+            self.probe(func)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['probes'] = {'results': None, 'expires': 0}
+
+    def probe(self, func):
+        self.probes.append(func)
+        self.healthcheck.add_check(self.checker(func.__name__))
+        return func
+
+    def _run(self, app, func):
+        with app.app_context():
+            return func()
+
+    def run(self):
+        app = current_app._get_current_object()
+        timeout = app.config.get('HEALTHCHECK_TIMEOUT', 2)
+
+        futures = dict((self.executor.submit(self._run, app, func), func.__name__) for func in self.probes)
+        wait(futures, timeout)
+
+        results = {}
+
+        for (future, name) in futures.items():
+            if not future.done():
+                results[name] = (False, 'Timed out after %ss' % timeout)
+            elif future.exception() is not None:
+                results[name] = (False, '%s: %s' % (type(future.exception()).__name__, future.exception()))
+            else:
+                results[name] = future.result()
+
+        return results
+
+    def results(self):
+        state = current_app.extensions['probes']
+
+        if state['expires'] < time.time():
+            # Only one thread probes, the others wait for its results
+            with self._mutex:
+                if state['expires'] < time.time():
+                    state['results'] = self.run()
+                    state['expires'] = time.time() + current_app.config.get('HEALTHCHECK_TTL', 10)
+
+        return state['results']
+
+    def checker(self, name):
+        """A check for the healthcheck package, reading one probe's cached result"""
+        def check():
+            return self.results()[name]
+        check.__name__ = name
+        return check
+
+
+def _free_mb(path):
+    while path and not os.path.exists(path):
+        path = os.path.dirname(path)
+    stat = os.statvfs(path or '/')
+    return stat.f_bavail * stat.f_frsize / (1024 * 1024)
+
+
+def database():
+    from auth.models import db
+
+    start = time.time()
+
+    with db.engine.connect() as connection:
+        connection.execute('SELECT 1')
+
+    return True, 'Query took %.1f ms' % ((time.time() - start) * 1000)
+
+
+def disk():
+    minimum = current_app.config.get('HEALTHCHECK_MIN_FREE_MB', 100)
+    paths = [current_app.config['UPLOADS_DEFAULT_DEST']]
+
+    uri = current_app.config.get('SQLALCHEMY_DATABASE_URI')
+
+    if uri:
+        url = make_url(uri)
+
+        if url.drivername.startswith('sqlite') and url.database:
+            paths.append(os.path.dirname(os.path.abspath(url.database)))
+
+    free = [(path, _free_mb(path)) for path in paths]
+    output = ', '.join('%s: %d MB free' % item for item in free)
+
+    return all(mb >= minimum for (_, mb) in free), output
+
+
+def push():
+    if not current_app.config.get('PUSH_ENABLED'):
+        return True, 'Disabled'
+
+    from redis import StrictRedis
+
+    timeout = current_app.config.get('HEALTHCHECK_TIMEOUT', 2)
+    redis = StrictRedis.from_url(current_app.config['PUSH_REDIS_URL'], socket_timeout=timeout,
+                                 socket_connect_timeout=timeout)
+    redis.ping()
+
+    return True, 'Broker is up'
+
+
+def scheduler():
+    if not current_app.config.get('HEALTHCHECK_SCHEDULER'):
+        return True, 'Not monitored'
+
+    from auth.services import coordination
+
+    heartbeat = coordination.cache.get('scheduler:heartbeat')
+
+    if heartbeat is None:
+        return False, 'No heartbeat'
+
+    age = time.time() - heartbeat
+
+    return age < 3 * current_app.config.get('SCHEDULER_INTERVAL', 60), 'Last heartbeat %ds ago' % age
+
+
+def mail():
+    if not current_app.config.get('HEALTHCHECK_MAIL'):
+        return True, 'Not monitored'
+
+    server = current_app.config.get('MAIL_SERVER', 'localhost')
+    port = current_app.config.get('MAIL_PORT', 25)
+
+    socket.create_connection((server, port), current_app.config.get('HEALTHCHECK_TIMEOUT', 2)).close()
+
+    return True, '%s:%s is accepting connections' % (server, port)
+
+
+PROBES = (database, disk, push, scheduler, mail)
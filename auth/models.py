@@ -11,15 +11,20 @@ import flask
 
 from auth import constants
 from auth.graphs import available_actions
+from auth.services import counters, revocations
 from flask import current_app
-from flask_security import UserMixin, RoleMixin, current_user, SQLAlchemyUserDatastore
+from flask_login import UserMixin as BaseUserMixin, current_user
 from flask_sqlalchemy import SQLAlchemy
 from random import choice
+from six import string_types
 
-from sqlalchemy import event
+from sqlalchemy import bindparam, case, event, inspect, select
 from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import backref
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.schema import UniqueConstraint
+from werkzeug.local import LocalProxy
 
 
 @event.listens_for(Engine, 'connect')
@@ -41,6 +46,42 @@ def generate_code():
     return result
 
 
+class RoleMixin(object):
+    """Flask-Security's RoleMixin, here so that the gateway mode doesn't import Flask-Security"""
+
+    def __eq__(self, other):
+        return self.name == other or self.name == getattr(other, 'name', None)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.name)
+
+
+class UserMixin(BaseUserMixin):
+    """Flask-Security's UserMixin, here so that the gateway mode doesn't import Flask-Security"""
+
+    @property
+    def is_active(self):
+        return self.active
+
+    def get_auth_token(self):
+        from flask_security.core import _security
+        from flask_security.utils import hash_data
+
+        return _security.remember_token_serializer.dumps([str(self.id), hash_data(self.password)])
+
+    def has_role(self, role):
+        if isinstance(role, string_types):
+            return role in (role.name for role in self.roles)
+        else:
+            return role in self.roles
+
+    def get_security_payload(self):
+        return {'id': str(self.id)}
+
+
 roles_users = db.Table('roles_users',
     db.Column('user_id', db.Integer(), db.ForeignKey('users.id')),
     db.Column('role_id', db.Integer(), db.ForeignKey('roles.id'))
@@ -84,7 +125,8 @@ class User(db.Model, UserMixin):
     def __str__(self):
         return self.email
 
-users = SQLAlchemyUserDatastore(db, User, Role)
+# The user datastore of the app's Flask-Security, set up by the admin and CLI modes
+users = LocalProxy(lambda: current_app.extensions['security'].datastore)
 
 class Network(db.Model):
     __tablename__ = 'networks'
@@ -94,6 +136,7 @@ class Network(db.Model):
     title = db.Column(db.Unicode(40), nullable=False)
     description = db.Column(db.UnicodeText)
     ga_tracking_id = db.Column(db.String(20))
+    timezone = db.Column(db.String(40))
 
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
 
@@ -126,7 +169,11 @@ class Gateway(db.Model):
     default_minutes = db.Column(db.Integer)
     default_megabytes = db.Column(db.BigInteger)
 
+    # Overrides the network's timezone
+    timezone = db.Column(db.String(40))
+
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
 
     def __str__(self):
         return self.title
@@ -145,11 +192,17 @@ def record_change(f):
         change.destination = self.status
         change.args = json.dumps(kwargs)
 
-        if current_user.is_authenticated:
+        # Auths answered from signed tokens are processed outside the request,
+        # and the gateway mode has no logins
+        if flask.has_request_context() and hasattr(current_app, 'login_manager') and current_user.is_authenticated:
             change.user_id = getattr(current_user, 'id', None)
 
         db.session.add(change)
 
+        if change.changed_type == 'Voucher' and change.event in USAGE_EVENTS:
+            record_usage(db.session, self.gateway_id, self.network_id,
+                         datetime.datetime.utcnow().date(), **{USAGE_EVENTS[change.event]: 1})
+
     return func
 
 class Voucher(db.Model):
@@ -165,6 +218,9 @@ class Voucher(db.Model):
     gw_address = db.Column(db.String(15))
     gw_port = db.Column(db.String(5))
 
+    network_id = db.Column(db.Unicode(20), db.ForeignKey('networks.id', onupdate='cascade'), index=True)
+    network = db.relationship(Network, backref=backref('vouchers', lazy='dynamic'))
+
     gateway_id = db.Column(db.Unicode(20), db.ForeignKey('gateways.id', onupdate='cascade'), nullable=False)
     gateway = db.relationship(Gateway, backref=backref('vouchers', lazy='dynamic'))
 
@@ -181,10 +237,22 @@ class Voucher(db.Model):
 
     status = db.Column(db.String(20), nullable=False, default='new')
 
+    # Set on vouchers issued for a paid order
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id', onupdate='cascade'), index=True)
+    order = db.relationship('Order', backref=backref('vouchers', lazy='dynamic'))
+
+    # Every ORM update is a compare-and-set on this, so concurrent transitions
+    # fail with StaleDataError instead of silently overwriting each other
+    version = db.Column(db.Integer, nullable=False, default=1)
+
     __table_args__ = (
             UniqueConstraint('gateway_id', 'code'),
     )
 
+    __mapper_args__ = {
+        'version_id_col': version,
+    }
+
     def should_expire(self):
         return self.created_at + datetime.timedelta(minutes=current_app.config.get('VOUCHER_MAXAGE')) < datetime.datetime.utcnow()
 
@@ -209,6 +277,50 @@ class Voucher(db.Model):
         if self.started_at:
             return self.started_at + datetime.timedelta(minutes=self.minutes)
 
+    def update_counters(self, incoming, outgoing):
+        """Raise the counters monotonically, buffered in process when coalescing is enabled"""
+        if counters.enabled:
+            (incoming, outgoing) = counters.add(self.id, incoming, outgoing)
+        else:
+            Voucher.write_counters([(self.id, incoming, outgoing)], [self])
+
+        # Quotas are checked against these, so they include anything still buffered
+        set_committed_value(self, 'incoming', max(self.incoming or 0, incoming))
+        set_committed_value(self, 'outgoing', max(self.outgoing or 0, outgoing))
+
+    def flush_counters(self):
+        """Write this voucher's buffered counters now"""
+        pending = counters.pop(self.id)
+        if pending is not None:
+            Voucher.write_counters([(self.id,) + pending])
+
+    @classmethod
+    def write_counters(cls, values, vouchers=()):
+        """
+        Raise the counters of many vouchers in one statement, without a version check
+
+        Pass the vouchers already loaded with their stored counters, to
+        save reading those again for the usage totals.
+        """
+        if not values:
+            return
+
+        table = cls.__table__
+
+        record_traffic(values, vouchers)
+        incoming = bindparam('_incoming')
+        outgoing = bindparam('_outgoing')
+
+        db.session.execute(
+            table.update()
+                 .where(table.c.id == bindparam('_id'))
+                 .values(
+                     incoming=case([(table.c.incoming < incoming, incoming)], else_=table.c.incoming),
+                     outgoing=case([(table.c.outgoing < outgoing, outgoing)], else_=table.c.outgoing),
+                 ),
+            [dict(_id=voucher_id, _incoming=i, _outgoing=o) for (voucher_id, i, o) in values]
+        )
+
     @record_change
     def extend(self):
         self.minutes += 30
@@ -257,6 +369,9 @@ class Auth(db.Model):
     incoming = db.Column(db.BigInteger)
     outgoing = db.Column(db.BigInteger)
 
+    network_id = db.Column(db.Unicode(20), db.ForeignKey('networks.id', onupdate='cascade'), index=True)
+    network = db.relationship(Network, backref=backref('auths', lazy='dynamic'))
+
     gateway_id = db.Column(db.Unicode(20), db.ForeignKey('gateways.id', onupdate='cascade'), nullable=False)
     gateway = db.relationship(Gateway, backref=backref('auths', lazy='dynamic'))
 
@@ -282,7 +397,7 @@ class Auth(db.Model):
             self.voucher_id = voucher.id
 
         if voucher.ip is None:
-            voucher.ip = flask.request.args.get('ip')
+            voucher.ip = self.ip
 
         if voucher.status in ['archived', 'blocked', 'ended', 'expired']:
             return (constants.AUTH_DENIED, 'Requested token is the wrong status: %s' % self.token)
@@ -309,15 +424,13 @@ class Auth(db.Model):
             messages = ''
 
             if self.incoming is not None or self.outgoing is not None:
-                if self.incoming > voucher.incoming:
-                    voucher.incoming = self.incoming
-                else:
+                if self.incoming <= voucher.incoming:
                     messages += '| Warning: Incoming counter is smaller than stored value; counter not updated'
 
-                if self.outgoing > voucher.outgoing:
-                    voucher.outgoing = self.outgoing
-                else:
+                if self.outgoing <= voucher.outgoing:
                     messages += '| Warning: Outgoing counter is smaller than stored value; counter not updated'
+
+                voucher.update_counters(self.incoming, self.outgoing)
             else:
                 messages += '| Incoming or outgoing counter is missing; counters not updated'
 
@@ -325,12 +438,15 @@ class Auth(db.Model):
                 # Ignore this, when you login the timer starts, that's it
                 # (at least it is for this model)
                 messages += '| Logout is not implemented'
+                voucher.flush_counters()
 
             if voucher.should_end():
+                voucher.flush_counters()
                 voucher.end()
                 return (constants.AUTH_DENIED, 'Token has ended: %s' % self.token)
 
             if voucher.megabytes_are_finished():
+                voucher.flush_counters()
                 voucher.end()
                 return (constants.AUTH_DENIED, 'Token megabytes are finished: %s' % self.token)
 
@@ -338,6 +454,182 @@ class Auth(db.Model):
         else:
             return (constants.AUTH_ERROR, 'Unknown stage: %s' % self.stage)
 
+    def process_token(self, claims):
+        """
+        Answer from a signed token's claims alone, or return None to leave it to process_request
+
+        Only revoked vouchers are denied here, anything else the token can't
+        vouch for (another gateway or device, its minutes or megabytes used
+        up, logouts) goes to the database.
+        """
+        revoked = revocations.is_revoked(claims['voucher_id'])
+
+        if revoked:
+            return (constants.AUTH_DENIED, 'Requested token is the wrong status: %s' % self.token)
+
+        if revoked is None:
+            return None
+
+        if self.gateway_id != claims['gateway_id'] or (self.mac or '').lower() != claims['mac']:
+            return None
+
+        if claims['started_at'] + datetime.timedelta(minutes=claims['minutes']) <= datetime.datetime.utcnow():
+            return None
+
+        if self.stage == constants.STAGE_LOGIN:
+            return (constants.AUTH_ALLOWED, None)
+
+        if self.stage == constants.STAGE_COUNTERS and self.incoming is not None and self.outgoing is not None:
+            if claims['megabytes'] is not None and (self.incoming + self.outgoing) / (1024 * 1024) >= claims['megabytes']:
+                return None
+            return (constants.AUTH_ALLOWED, '')
+
+        return None
+
+
+class AuthSummary(db.Model):
+    """Hourly rollup of pruned auths, per voucher and gateway"""
+    __tablename__ = 'auth_summaries'
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    network_id = db.Column(db.Unicode(20), db.ForeignKey('networks.id', onupdate='cascade'), index=True)
+    gateway_id = db.Column(db.Unicode(20), db.ForeignKey('gateways.id', onupdate='cascade'), nullable=False)
+    voucher_id = db.Column(db.Integer, db.ForeignKey('vouchers.id', onupdate='cascade'))
+
+    hour = db.Column(db.DateTime, nullable=False, index=True)
+
+    requests = db.Column(db.Integer, nullable=False, default=0)
+    allowed = db.Column(db.Integer, nullable=False, default=0)
+    denied = db.Column(db.Integer, nullable=False, default=0)
+
+    incoming = db.Column(db.BigInteger)
+    outgoing = db.Column(db.BigInteger)
+
+    first_at = db.Column(db.DateTime)
+    last_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+            UniqueConstraint('gateway_id', 'voucher_id', 'hour'),
+    )
+
+class GatewayUsage(db.Model):
+    """Daily totals per gateway, kept up to date as vouchers are created, change and are used"""
+    __tablename__ = 'gateway_usage'
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    network_id = db.Column(db.Unicode(20), db.ForeignKey('networks.id', onupdate='cascade'), index=True)
+    network = db.relationship(Network, backref=backref('usage', lazy='dynamic'))
+
+    gateway_id = db.Column(db.Unicode(20), db.ForeignKey('gateways.id', onupdate='cascade'), nullable=False)
+    gateway = db.relationship(Gateway, backref=backref('usage', lazy='dynamic'))
+
+    day = db.Column(db.Date, nullable=False, index=True)
+
+    vouchers_created = db.Column(db.Integer, nullable=False, default=0)
+    vouchers_started = db.Column(db.Integer, nullable=False, default=0)
+    vouchers_ended = db.Column(db.Integer, nullable=False, default=0)
+
+    # Traffic is counted on the day its voucher started
+    incoming = db.Column(db.BigInteger, nullable=False, default=0)
+    outgoing = db.Column(db.BigInteger, nullable=False, default=0)
+
+    __table_args__ = (
+            UniqueConstraint('gateway_id', 'day'),
+    )
+
+
+USAGE_EVENTS = {
+    'login': 'vouchers_started',
+    'end': 'vouchers_ended',
+}
+
+
+def record_usage(connection, gateway_id, network_id, day, **amounts):
+    """Add to a gateway's totals for a day, in the caller's transaction"""
+    table = GatewayUsage.__table__
+
+    update = (table.update()
+                   .where(table.c.gateway_id == gateway_id)
+                   .where(table.c.day == day)
+                   .values(**dict((name, table.c[name] + amount) for (name, amount) in amounts.items())))
+
+    if connection.execute(update).rowcount == 0:
+        try:
+            with connection.begin_nested():
+                connection.execute(table.insert().values(gateway_id=gateway_id, network_id=network_id, day=day,
+                                                         **amounts))
+        except IntegrityError:
+            # Another transaction started the day's row first
+            connection.execute(update)
+
+
+def record_traffic(values, vouchers=()):
+    """
+    Add the traffic of counter updates, before they're written, to their gateways' totals
+
+    The previous counters are read from the given (loaded) vouchers, and
+    selected for the rest.
+    """
+    table = Voucher.__table__
+    counters = dict((voucher_id, (incoming, outgoing)) for (voucher_id, incoming, outgoing) in values)
+    totals = {}
+
+    rows = [voucher for voucher in vouchers if voucher.id in counters]
+    missing = set(counters) - set(row.id for row in rows)
+
+    if missing:
+        rows += db.session.execute(
+            select([table.c.id, table.c.gateway_id, table.c.network_id, table.c.started_at,
+                    table.c.created_at, table.c.incoming, table.c.outgoing])
+                .where(table.c.id.in_(list(missing)))
+        ).fetchall()
+
+    for row in rows:
+        (incoming, outgoing) = counters[row.id]
+        day = (row.started_at or row.created_at).date()
+        key = (row.gateway_id, row.network_id, day)
+        total = totals.get(key, (0, 0))
+        totals[key] = (total[0] + max(0, incoming - (row.incoming or 0)),
+                       total[1] + max(0, outgoing - (row.outgoing or 0)))
+
+    for ((gateway_id, network_id, day), (incoming, outgoing)) in totals.items():
+        if incoming or outgoing:
+            record_usage(db.session, gateway_id, network_id, day, incoming=incoming, outgoing=outgoing)
+
+
+@event.listens_for(Voucher, 'after_insert')
+def count_created_voucher(mapper, connection, target):
+    record_usage(connection, target.gateway_id, target.network_id,
+                 (target.created_at or datetime.datetime.utcnow()).date(), vouchers_created=1)
+
+
+@event.listens_for(Voucher, 'before_insert')
+@event.listens_for(Voucher, 'before_update')
+@event.listens_for(Auth, 'before_insert')
+@event.listens_for(Auth, 'before_update')
+def set_network_id(mapper, connection, target):
+    # network_id is denormalized from the gateway so that per-network queries
+    # don't have to join through gateways
+    if target.gateway_id is None:
+        return
+
+    if target.network_id is None or inspect(target).attrs.gateway_id.history.has_changes():
+        target.network_id = connection.execute(
+            select([Gateway.__table__.c.network_id]).where(Gateway.__table__.c.id == target.gateway_id)
+        ).scalar()
+
+@event.listens_for(Gateway, 'after_update')
+def cascade_network_id(mapper, connection, target):
+    if inspect(target).attrs.network_id.history.has_changes():
+        for table in (Voucher.__table__, Auth.__table__, GatewayUsage.__table__):
+            connection.execute(
+                table.update()
+                     .where(table.c.gateway_id == target.id)
+                     .values(network_id=target.network_id)
+            )
+
 class Change(db.Model):
     __tablename__ = 'changes'
 
@@ -440,6 +732,10 @@ class Product(db.Model):
 
     price = db.Column(db.Integer) # Cents
 
+    # What each voucher issued for the product is good for
+    minutes = db.Column(db.Integer)
+    megabytes = db.Column(db.BigInteger)
+
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
     updated_at = db.Column(db.DateTime, onupdate=datetime.datetime.utcnow)
 
@@ -480,6 +776,9 @@ class OrderItem(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
 
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id', onupdate='cascade'), index=True)
+    order = db.relationship(Order, backref=backref('items', lazy='dynamic'))
+
     product_id = db.Column(db.Integer, db.ForeignKey('products.id', onupdate='cascade'), nullable=False)
     product = db.relationship(Product, backref=backref('order_items', lazy='dynamic'))
 
@@ -0,0 +1,100 @@
+"""
+Format amounts of money, which are kept everywhere as integer cents
+"""
+
+from __future__ import absolute_import
+
+from auth.services import coordination
+from flask import current_app, g
+
+
+def currencies():
+    """
+    Currencies and countries by id, as plain dicts
+
+    Loaded in three small queries and kept in the process until a currency or
+    country changes (using the generations maintained for the cached options).
+    """
+    if '_money' not in g:
+        from auth.models import Country, Currency, country_currencies, db
+
+        cache = coordination.cache
+        generation = (cache.get_counter('options:currencies:generation'),
+                      cache.get_counter('options:countries:generation'))
+
+        state = current_app.extensions.setdefault('money', [None, {}])
+
+        if state[0] != generation:
+            currencies = dict((id, {'title': title, 'prefix': prefix, 'suffix': suffix}) for (id, title, prefix, suffix) in
+                              db.session.query(Currency.id, Currency.title, Currency.prefix, Currency.suffix))
+            countries = dict((id, {'title': title, 'currencies': []}) for (id, title) in
+                             db.session.query(Country.id, Country.title))
+
+            for (country_id, currency_id) in db.session.execute(country_currencies.select()):
+                if country_id in countries:
+                    countries[country_id]['currencies'].append(currency_id)
+
+            state[:] = [generation, {'currencies': currencies, 'countries': countries}]
+
+        g._money = state[1]
+
+    return g._money
+
+
+def format_cents(cents):
+    """Cents as units and two decimals, like 1,234.05, without going through a float"""
+    sign = '-' if cents < 0 else ''
+    (units, cents) = divmod(abs(int(cents)), 100)
+
+    return '%s%s.%02d' % (sign, '{:,}'.format(units), cents)
+
+
+def format_money(cents, currency):
+    """Format cents with a currency's prefix and suffix, or its id when it has neither"""
+    prefix = currency.get('prefix')
+    suffix = currency.get('suffix')
+
+    if not prefix and not suffix:
+        prefix = currency.get('id')
+
+    return u' '.join(part for part in (prefix, format_cents(cents), suffix) if part)
+
+
+def money(cents, currency_id):
+    """Format cents in a currency, as R 1,234.05"""
+    if cents is None:
+        return None
+
+    currency = currencies()['currencies'].get(currency_id, {})
+
+    return format_money(cents, dict(currency, id=currency_id))
+
+
+def moneys(rows, attributes, currency='currency_id'):
+    """
+    Format amounts of a whole page of rows (objects or dicts) at once
+
+    Each row's amounts are in the currency named by its currency attribute,
+    and returns a dict of the formatted attributes, in the same order as the rows.
+    """
+    known = currencies()['currencies']
+    formatted = []
+
+    for row in rows:
+        get = row.get if isinstance(row, dict) else lambda name: getattr(row, name)
+
+        currency_id = get(currency)
+        details = dict(known.get(currency_id, {}), id=currency_id)
+        values = {}
+
+        for attribute in attributes:
+            value = get(attribute)
+
+            if value is not None:
+                value = format_money(value, details)
+
+            values[attribute] = value
+
+        formatted.append(values)
+
+    return formatted
@@ -0,0 +1,112 @@
+"""
+Cached (id, label) option lists for select fields
+"""
+
+from __future__ import absolute_import
+
+import itertools
+
+from auth.models import Country, Currency, Gateway, Network, Role, db
+from auth.services import coordination
+from flask import current_app, g
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+LABELS = {
+    'currencies': 'title',
+    'gateways': 'title',
+    'networks': 'title',
+}
+
+MODEL_OPTIONS = {
+    Country: 'countries',
+    Currency: 'currencies',
+    Gateway: 'gateways',
+    Network: 'networks',
+    Role: 'roles',
+}
+
+
+def scope():
+    """What the current user is allowed to see decides which options they get"""
+    if current_user.has_role('super-admin'):
+        return 'super-admin'
+
+    return '%s:%s:%s' % (
+        ','.join(sorted(role.name for role in current_user.roles)),
+        current_user.network_id,
+        current_user.gateway_id,
+    )
+
+
+def cached_options(name, query_factory):
+    """Options from the request, then the shared cache, then the database"""
+    key = 'options:%s:%s' % (name, scope())
+    options = g.setdefault('_options', {})
+
+    if key not in options:
+        cache = coordination.cache
+        cache_key = '%s:%s' % (key, cache.get_counter('options:%s:generation' % name))
+
+        value = cache.get(cache_key)
+
+        if value is None:
+            value = [tuple(row) for row in query_factory()]
+            cache.set(cache_key, value, current_app.config.get('OPTIONS_CACHE_TIMEOUT', 300))
+
+        options[key] = value
+
+    return options[key]
+
+
+def resource_options(resource):
+    def query():
+        from auth.resources import api
+
+        manager = api.resources[resource].manager
+        model = manager.model
+
+        return manager.instances().with_entities(model.id, getattr(model, LABELS[resource]))
+
+    def func():
+        return cached_options(resource, query)
+
+    return func
+
+
+def role_options():
+    def query():
+        query = db.session.query(Role.id, Role.description)
+
+        if current_user.has_role(u'super-admin'):
+            return query.all()
+        if current_user.has_role(u'network-admin'):
+            return query.filter(Role.name == u'gateway-admin').all()
+        return []
+
+    return cached_options('roles', query)
+
+
+@event.listens_for(Session, 'after_flush')
+def track_option_changes(session, flush_context):
+    changed = session.info.setdefault('changed_options', set())
+
+    for instance in itertools.chain(session.new, session.dirty, session.deleted):
+        name = MODEL_OPTIONS.get(type(instance))
+        if name is not None:
+            changed.add(name)
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_options(session):
+    changed = session.info.pop('changed_options', ())
+
+    if coordination.backend is not None:
+        for name in changed:
+            coordination.cache.incr('options:%s:generation' % name)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_option_changes(session):
+    session.info.pop('changed_options', None)
@@ -0,0 +1,299 @@
+"""
+Orders of products, paid through PayU, and the vouchers they issue
+
+Starting a payment records a transaction keyed by its PayU reference. The
+views PayU sends the customer back to only queue that reference: a worker
+asks PayU how the transaction ended and, exactly once per transaction,
+issues the order's vouchers with one bulk insert. Transactions the workers
+miss are picked up by process_transactions on the scheduler.
+"""
+
+from __future__ import absolute_import
+
+import datetime
+import json
+
+from auth.models import Order, OrderItem, Transaction, Voucher, db, generate_code, record_usage
+from auth.payu import PayUError, payu
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+
+# Transaction statuses still waiting on PayU
+PENDING = ('new',)
+
+# PayU's final transaction states, the others being pending
+STATES = {
+    'SUCCESSFUL': 'successful',
+    'FAILED': 'failed',
+    'TIMEOUT': 'failed',
+    'EXPIRED': 'expired',
+}
+
+# Bound parameters per query when checking codes
+CODES_PER_QUERY = 500
+
+# Times to draw new codes when vouchers inserted meanwhile took some of them
+INSERT_ATTEMPTS = 3
+
+
+class OrderError(Exception):
+    pass
+
+
+def create_order(user, gateway, items):
+    """An order at a gateway for (product, units) pairs, priced from the products"""
+    if not items:
+        raise OrderError('Nothing was ordered')
+
+    currencies = set(product.currency_id for (product, units) in items)
+
+    if len(currencies) != 1 or None in currencies:
+        raise OrderError('Products must be priced in one currency')
+
+    order = Order(user=user, network_id=gateway.network_id, gateway=gateway, currency_id=currencies.pop(), price=0)
+    db.session.add(order)
+
+    for (product, units) in items:
+        if product.price is None:
+            raise OrderError('%s has no price' % product)
+
+        if product.network_id != gateway.network_id or product.gateway_id not in (None, gateway.id):
+            raise OrderError('%s is not sold at %s' % (product, gateway))
+
+        if units < 1:
+            raise OrderError('Order at least one %s' % product)
+
+        item = OrderItem(order=order, product=product, description=product.title, units=units,
+                         price_per_unit=product.price, price=product.price * units)
+        db.session.add(item)
+
+        order.price += item.price
+
+    db.session.flush()
+
+    return order
+
+
+def start_payment(order, return_url, cancel_url, notification_url=None):
+    """Set up the order's PayU transaction and record it, returning it"""
+    description = ', '.join('%s x %s' % (item.units, item.description) for item in order.items)
+
+    response = payu.set_transaction(order.currency_id, order.price, description, return_url, cancel_url,
+                                    merchant_reference=str(order.id), notification_url=notification_url)
+
+    if not response.successful:
+        raise PayUError(response.resultMessage)
+
+    transaction = Transaction(id=response.payUReference, user_id=order.user_id, order=order,
+                              reference=str(order.id))
+    db.session.add(transaction)
+
+    order.status = 'pending'
+    db.session.commit()
+
+    return transaction
+
+
+def unique_codes(gateway_id, count):
+    """Voucher codes not yet used at a gateway, when checked"""
+    codes = set()
+
+    while len(codes) < count:
+        candidates = list(set(generate_code() for _ in range(count - len(codes))) - codes)
+        taken = set()
+
+        for i in range(0, len(candidates), CODES_PER_QUERY):
+            taken.update(code for (code,) in db.session.query(Voucher.code)
+                                                       .filter(Voucher.gateway_id == gateway_id)
+                                                       .filter(Voucher.code.in_(candidates[i:i + CODES_PER_QUERY])))
+
+        codes.update(set(candidates) - taken)
+
+    return list(codes)
+
+
+def insert_vouchers(gateway_id, rows):
+    """
+    Insert voucher rows with codes unique at their gateway
+
+    The codes are checked before the insert, so a voucher created at the
+    gateway in between can take one. The insert is then rolled back to its
+    savepoint and tried again with new codes.
+    """
+    for attempt in range(INSERT_ATTEMPTS):
+        for (row, code) in zip(rows, unique_codes(gateway_id, len(rows))):
+            row['code'] = code
+
+        try:
+            with db.session.begin_nested():
+                db.session.execute(Voucher.__table__.insert(), rows)
+            return
+        except IntegrityError:
+            if attempt == INSERT_ATTEMPTS - 1:
+                raise
+
+            current_app.logger.info('Voucher codes at %s were taken meanwhile, drawing new ones', gateway_id)
+
+
+def issue_vouchers(order):
+    """Insert a voucher for each unit ordered, in the caller's transaction, returning how many"""
+    gateway = order.gateway
+    now = datetime.datetime.utcnow()
+
+    rows = []
+
+    for item in order.items:
+        product = item.product
+
+        for _ in range(item.units):
+            rows.append({
+                'network_id': order.network_id,
+                'gateway_id': order.gateway_id,
+                'order_id': order.id,
+                'minutes': product.minutes or gateway.default_minutes or 60,
+                'megabytes': product.megabytes or gateway.default_megabytes,
+                'status': 'new',
+                'incoming': 0,
+                'outgoing': 0,
+                'version': 1,
+                'created_at': now,
+                'updated_at': now,
+            })
+
+    if rows:
+        insert_vouchers(order.gateway_id, rows)
+        record_usage(db.session, order.gateway_id, order.network_id, now.date(), vouchers_created=len(rows))
+
+    return len(rows)
+
+
+def process_transaction(reference):
+    """
+    Settle a pending transaction from PayU's answer, returning its status
+
+    The transaction is moved out of pending with a conditional update, and
+    only the caller whose update matched issues the vouchers, so processing
+    a transaction again, or concurrently, is harmless.
+    """
+    transaction = Transaction.query.get(reference)
+
+    if transaction is None:
+        raise OrderError('Unknown transaction: %s' % reference)
+
+    if transaction.status not in PENDING:
+        return transaction.status
+
+    order = transaction.order
+    response = payu.get_transaction(reference)
+
+    status = STATES.get(response.transactionState)
+    payload = {
+        'transactionState': response.transactionState,
+        'resultCode': response.resultCode,
+        'resultMessage': response.resultMessage,
+    }
+
+    if status == 'successful':
+        basket = response.basket
+
+        if int(basket.amountInCents) != order.price or basket.currencyCode != order.currency_id:
+            status = 'failed'
+            payload['resultMessage'] = 'Paid %s %s for an order of %s %s' % (
+                    basket.currencyCode, basket.amountInCents, order.currency_id, order.price)
+
+    if status is None:
+        maxage = datetime.timedelta(minutes=current_app.config.get('ORDER_MAXAGE', 1440))
+
+        if transaction.created_at + maxage > datetime.datetime.utcnow():
+            return transaction.status
+
+        status = 'expired'
+
+    table = Transaction.__table__
+
+    result = db.session.execute(
+        table.update()
+             .where(table.c.id == reference)
+             .where(table.c.status.in_(PENDING))
+             .values(status=status, payload=json.dumps(payload))
+    )
+
+    if result.rowcount != 1:
+        db.session.rollback()
+        return db.session.query(Transaction.status).filter(Transaction.id == reference).scalar()
+
+    if status == 'successful':
+        issue_vouchers(order)
+        order.status = 'paid'
+    else:
+        order.status = 'cancelled'
+
+    db.session.commit()
+
+    return status
+
+
+def process_transactions():
+    """Process every pending transaction, returning the count of each resulting status"""
+    references = [id for (id,) in db.session.query(Transaction.id)
+                                            .filter(Transaction.status.in_(PENDING))
+                                            .order_by(Transaction.created_at)]
+    totals = {}
+
+    for reference in references:
+        # One transaction failing must not hold up the rest
+        try:
+            status = process_transaction(reference)
+        except PayUError as e:
+            current_app.logger.warning('Transaction %s could not be checked: %s', reference, e)
+            db.session.rollback()
+            status = 'error'
+        except Exception:
+            current_app.logger.exception('Transaction %s could not be processed', reference)
+            db.session.rollback()
+            status = 'error'
+
+        totals[status] = totals.get(status, 0) + 1
+
+    return totals
+
+
+class Orders(object):
+    """Processes queued transactions on a thread pool, off the request thread"""
+
+    def __init__(self, app=None):
+        self.executor = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['orders'] = self
+        payu.init_app(app)
+
+        threads = app.config.get('ORDER_THREADS', 2)
+
+        if threads and self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def queue(self, reference):
+        """Have a transaction processed, in the request when ORDER_THREADS is 0"""
+        if not current_app.config.get('ORDER_THREADS', 2) or self.executor is None:
+            try:
+                process_transaction(reference)
+            except PayUError as e:
+                current_app.logger.warning('Transaction %s could not be checked: %s', reference, e)
+        else:
+            self.executor.submit(self._process, current_app._get_current_object(), reference)
+
+    def _process(self, app, reference):
+        with app.app_context():
+            try:
+                process_transaction(reference)
+            except Exception:
+                app.logger.exception('Transaction %s could not be processed', reference)
+            finally:
+                db.session.remove()
+
+
+orders = Orders()
@@ -0,0 +1,195 @@
+"""
+Password hashing and token verification controls for Flask-Security
+"""
+
+from __future__ import absolute_import
+
+import hashlib
+import threading
+import time
+
+from passlib.context import CryptContext
+
+
+def password_context(app, schemes):
+    """
+    Build the passlib context from config
+
+    When SECURITY_PASSWORD_ROUNDS is set, hashes made with any other number of
+    rounds (or with a deprecated scheme) need updating, which Flask-Security
+    does transparently on the next successful login.
+    """
+    scheme = app.config['SECURITY_PASSWORD_HASH']
+    rounds = app.config.get('SECURITY_PASSWORD_ROUNDS')
+
+    kwargs = {}
+
+    if rounds:
+        for setting in ('default_rounds', 'min_rounds', 'max_rounds'):
+            kwargs['%s__%s' % (scheme, setting)] = rounds
+
+    if scheme not in schemes:
+        schemes = [scheme] + list(schemes)
+
+    return CryptContext(schemes=schemes, default=scheme, deprecated=['auto'], **kwargs)
+
+
+class BoundedCryptContext(object):
+    """
+    Delegates to a CryptContext, verifying at most so many hashes at once
+
+    The caller still waits for its verification, the others queue behind
+    the ones running, so a burst of logins can't take every CPU.
+    """
+
+    def __init__(self, context, concurrency):
+        self.context = context
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+
+    def verify(self, *args, **kwargs):
+        with self.semaphore:
+            return self.context.verify(*args, **kwargs)
+
+    def verify_and_update(self, *args, **kwargs):
+        with self.semaphore:
+            return self.context.verify_and_update(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.context, name)
+
+
+class TokenCache(object):
+    """
+    Remembers which user an auth token verified as, for a short time
+
+    A cached token is still honoured for up to the timeout after the user's
+    password changes, so keep it short.
+    """
+
+    def __init__(self, timeout, size=10000):
+        self.timeout = timeout
+        self.size = size
+        self._tokens = {}
+        self._mutex = threading.Lock()
+
+    def _key(self, token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def get(self, token):
+        item = self._tokens.get(self._key(token))
+        if item is not None and item[1] > time.time():
+            return item[0]
+
+    def set(self, token, user_id):
+        with self._mutex:
+            if len(self._tokens) >= self.size:
+                self._tokens.clear()
+            self._tokens[self._key(token)] = (user_id, time.time() + self.timeout)
+
+
+def cache_token_loader(app, timeout):
+    state = app.extensions['security']
+    login_manager = state.login_manager
+    load = login_manager.request_callback
+    cache = TokenCache(timeout)
+
+    def request_loader(request):
+        token = request.args.get(state.token_authentication_key,
+                                 request.headers.get(state.token_authentication_header))
+
+        if token:
+            user_id = cache.get(token)
+
+            if user_id is not None:
+                user = state.datastore.find_user(id=user_id)
+
+                if user is not None and user.active:
+                    return user
+
+        user = load(request)
+
+        if token and user is not None and user.is_authenticated:
+            cache.set(token, user.id)
+
+        return user
+
+    login_manager.request_loader(request_loader)
+
+
+def init_passwords(app):
+    """Apply the password config to an app that has Flask-Security set up"""
+    state = app.extensions['security']
+    context = password_context(app, state.password_schemes)
+
+    concurrency = app.config.get('PASSWORD_VERIFY_CONCURRENCY', 0)
+
+    if concurrency:
+        context = BoundedCryptContext(context, concurrency)
+
+    state.pwd_context = context
+
+    timeout = app.config.get('TOKEN_CACHE_TIMEOUT', 0)
+
+    if timeout:
+        cache_token_loader(app, timeout)
+
+
+def benchmark(scheme, budget, samples=3):
+    """Find the most rounds of a scheme that hash within a budget in seconds"""
+    from passlib.registry import get_crypt_handler
+
+    handler = get_crypt_handler(scheme)
+
+    if 'rounds' not in getattr(handler, 'setting_kwds', ()):
+        raise ValueError('%s does not support rounds' % scheme)
+
+    def measure(rounds):
+        hasher = handler.using(rounds=rounds)
+        start = time.time()
+        for _ in range(samples):
+            hasher.hash('benchmark password')
+        return (time.time() - start) / samples
+
+    rounds = handler.default_rounds
+    results = [(rounds, measure(rounds))]
+
+    # Rounds scale linearly, or for bcrypt and friends as a power of two
+    while True:
+        if handler.rounds_cost == 'log2':
+            rounds += 1 if results[-1][1] < budget else -1
+        else:
+            rounds = int(rounds * budget / results[-1][1])
+
+        rounds = max(handler.min_rounds, min(handler.max_rounds, rounds))
+
+        if rounds in [r for r, _ in results]:
+            break
+
+        results.append((rounds, measure(rounds)))
+
+    within = [r for r in results if r[1] <= budget]
+    best = max(within) if within else min(results)
+
+    return best, sorted(results)
+
+
+_hashing_app = None
+
+
+def hash_passwords(config, passwords):
+    """
+    Hash a batch of passwords the way Flask-Security would
+
+    Meant to run in a worker process, where it builds (once) a minimal app
+    with the given config to hash under.
+    """
+    global _hashing_app
+
+    from flask_security.utils import encrypt_password
+
+    if _hashing_app is None:
+        from auth import create_app
+        _hashing_app = create_app(config, mode='cli')
+
+    with _hashing_app.app_context():
+        return [encrypt_password(password) for password in passwords]
@@ -1,25 +1,37 @@
+"""
+Client for the PayU Redirect Payment Page SOAP API
+
+Each thread calling PayU builds its own suds client (they can't be shared
+or cloned), from a WSDL kept in PAYU_CACHE_DIR once fetched. Calls go over
+an HTTP session pooled per app, with PAYU_TIMEOUT, and run on a small
+thread pool. The caller still waits for the answer, but at most
+PAYU_TIMEOUT, whatever suds and the connection do.
+
+The instance lives here rather than in auth.services so that only the
+modes serving payments import suds.
+"""
+
 from __future__ import absolute_import
 
-import logging
-logging.basicConfig(level=logging.INFO)
+import io
+import os
+import threading
 
+import requests
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from flask import current_app
+from requests.adapters import HTTPAdapter
+from suds.cache import ObjectCache
 from suds.client import Client
 from suds.plugin import MessagePlugin
-from suds.wsse import *
+from suds.transport import Reply, Transport, TransportError
+from suds.wsse import Security, UsernameToken
 
-api = 'ONE_ZERO'
-wsdl = 'https://staging.payu.co.za/service/PayUAPI?wsdl'
-capture = 'https://staging.payu.co.za/rpp.do'
 
-additional_information = {
-    'merchantReference': '123456',
-    'supportedPaymentMethods': 'CREDITCARD',
-    'redirectChannel': 'responsive',
-}
+class PayUError(Exception):
+    pass
 
-safekey = '{CE62CE80-0EFD-4035-87C1-8824C5C46E7F}'
-username = '100032'
-password = 'PypWWegU'
 
 # Add the required attributes and namespaces for PayU to recognize the request
 class PayUPlugin(MessagePlugin):
@@ -27,37 +39,170 @@ class PayUPlugin(MessagePlugin):
         username_token = context.envelope.childAtPath('Header/wsse:Security/wsse:UsernameToken')
         username_token.getChild('wsse:Password').set('Type', 'http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-username-token-profile-1.0#PasswordText')
 
-client = None
-
-def init_client():
-    client = Client(wsdl, plugins=[PayUPlugin()])
-    security = Security()
-    token = UsernameToken(username, password)
-    security.tokens.append(token)
-    client.set_options(wsse=security)
-
-def set_transaction(currency_code, amount_in_cents, description, return_url, cancel_url):
-    additional_information['returnUrl'] = return_url
-    additional_information['cancelUrl'] = cancel_url
-    response = client.service.setTransaction(
-        Api=api,
-        Safekey=safekey,
-        TransactionType='PAYMENT',
-        AdditionalInformation=additional_information,
-        Basket=dict(
-            amountInCents=amount_in_cents,
-            currencyCode=currency_code,
-            description=description,
+
+class RequestsTransport(Transport):
+    """A suds transport keeping connections alive in a requests session"""
+
+    def __init__(self, session, timeout):
+        Transport.__init__(self)
+        self.session = session
+        self.timeout = timeout
+
+    def open(self, request):
+        if request.url.startswith('file://'):
+            return open(request.url[len('file://'):], 'rb')
+
+        try:
+            response = self.session.get(request.url, headers=request.headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise TransportError(str(e), None)
+
+        if response.status_code >= 300:
+            raise TransportError(response.reason, response.status_code, io.BytesIO(response.content))
+
+        return io.BytesIO(response.content)
+
+    def send(self, request):
+        try:
+            response = self.session.post(request.url, data=request.message, headers=request.headers,
+                                         timeout=self.timeout)
+        except requests.RequestException as e:
+            raise TransportError(str(e), None)
+
+        if response.status_code >= 300:
+            raise TransportError(response.reason, response.status_code, io.BytesIO(response.content))
+
+        return Reply(response.status_code, response.headers, response.content)
+
+
+class PayUClient(object):
+    """The suds clients of one app, one for each thread that calls PayU"""
+
+    def __init__(self, config):
+        self.config = config
+        self.session = None
+        self._local = threading.local()
+        self._mutex = threading.Lock()
+
+    def build_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.config.get('PAYU_THREADS', 4))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        return session
+
+    def build(self):
+        config = self.config
+
+        with self._mutex:
+            if self.session is None:
+                self.session = self.build_session()
+
+            cache_dir = config.get('PAYU_CACHE_DIR')
+
+            if cache_dir and not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+
+        wsdl = config['PAYU_WSDL']
+
+        if os.path.isfile(wsdl):
+            wsdl = 'file://' + os.path.abspath(wsdl)
+
+        client = Client(wsdl,
+                        cache=ObjectCache(cache_dir, days=config.get('PAYU_WSDL_CACHE_DAYS', 30)),
+                        plugins=[PayUPlugin()],
+                        transport=RequestsTransport(self.session, config.get('PAYU_TIMEOUT', 10)))
+
+        security = Security()
+        security.tokens.append(UsernameToken(config.get('PAYU_USERNAME'), config.get('PAYU_PASSWORD')))
+        client.set_options(wsse=security)
+
+        return client
+
+    @property
+    def service(self):
+        client = getattr(self._local, 'client', None)
+
+        if client is None:
+            client = self._local.client = self.build()
+
+        return client.service
+
+
+class PayU(object):
+    def __init__(self, app=None):
+        self.executor = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['payu'] = PayUClient(app.config)
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=app.config.get('PAYU_THREADS', 4))
+
+    def _call(self, client, method, kwargs):
+        return getattr(client.service, method)(**kwargs)
+
+    def submit(self, method, **kwargs):
+        """Call a PayU method on the thread pool, returning a future"""
+        client = current_app.extensions['payu']
+        return self.executor.submit(self._call, client, method, kwargs)
+
+    def result(self, future):
+        """Wait for a call, at most PAYU_TIMEOUT, raising PayUError if it failed"""
+        timeout = current_app.config.get('PAYU_TIMEOUT', 10)
+
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            future.cancel()
+            raise PayUError('PayU did not answer within %ss' % timeout)
+        except Exception as e:
+            raise PayUError('%s: %s' % (type(e).__name__, e))
+
+    def _credentials(self, additional_information):
+        config = current_app.config
+
+        return dict(
+            Api=config.get('PAYU_API', 'ONE_ZERO'),
+            Safekey=config.get('PAYU_SAFEKEY'),
+            AdditionalInformation=additional_information,
         )
-    )
-    return response
-
-def get_transaction(payUReference):
-    response = client.service.getTransaction(
-        Api=api,
-        Safekey=safekey,
-        AdditionalInformation={
-            'payUReference': payUReference
+
+    def set_transaction(self, currency_code, amount_in_cents, description, return_url, cancel_url,
+                        merchant_reference=None, notification_url=None):
+        additional_information = {
+            'supportedPaymentMethods': current_app.config.get('PAYU_PAYMENT_METHODS', 'CREDITCARD'),
+            'redirectChannel': 'responsive',
+            'returnUrl': return_url,
+            'cancelUrl': cancel_url,
         }
-    )
-    return response
+
+        if merchant_reference is not None:
+            additional_information['merchantReference'] = merchant_reference
+
+        if notification_url is not None:
+            additional_information['notificationUrl'] = notification_url
+
+        return self.result(self.submit(
+            'setTransaction',
+            TransactionType='PAYMENT',
+            Basket=dict(
+                amountInCents=amount_in_cents,
+                currencyCode=currency_code,
+                description=description,
+            ),
+            **self._credentials(additional_information)
+        ))
+
+    def get_transaction(self, reference):
+        return self.result(self.submit('getTransaction', **self._credentials({'payUReference': reference})))
+
+    def capture_url(self, reference):
+        """Where to send the customer to pay"""
+        return '%s?PayUReference=%s' % (current_app.config['PAYU_CAPTURE_URL'], reference)
+
+
+payu = PayU()
@@ -0,0 +1,259 @@
+"""
+Optional request instrumentation and an on-demand sampling profiler
+
+Nothing is hooked up unless PROFILING_ENABLED is set. Figures are kept per
+worker process.
+"""
+
+from __future__ import absolute_import
+
+import bisect
+import collections
+import datetime
+import os
+import sys
+import threading
+import time
+
+from flask import before_render_template, g, has_request_context, request, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Histogram(object):
+    """Counts of durations in milliseconds, by upper bound"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(BUCKETS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def to_dict(self):
+        buckets = [str(bound) for bound in BUCKETS] + ['+Inf']
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0,
+            'max': self.max,
+            'buckets': dict(zip(buckets, self.counts)),
+        }
+
+
+class EndpointStats(object):
+    def __init__(self):
+        self.time = Histogram()
+        self.query_time = Histogram()
+        self.template_time = Histogram()
+        self.queries = 0
+        self.max_queries = 0
+
+    def add(self, ms, queries, query_ms, template_ms):
+        self.time.add(ms)
+        self.query_time.add(query_ms)
+        self.template_time.add(template_ms)
+        self.queries += queries
+        self.max_queries = max(self.max_queries, queries)
+
+    def to_dict(self):
+        return {
+            'time': self.time.to_dict(),
+            'queries': {
+                'mean': self.queries / self.time.count if self.time.count else 0,
+                'max': self.max_queries,
+                'time': self.query_time.to_dict(),
+            },
+            'templates': self.template_time.to_dict(),
+        }
+
+
+class Sampler(object):
+    """
+    Samples the stacks of all other threads at an interval
+
+    Stacks are counted in the collapsed format (frames separated by
+    semicolons, then the count) read by flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.thread = None
+        self._mutex = threading.Lock()
+        self.running = False
+        self.started_at = None
+        self.stop_at = None
+
+    def start(self, seconds=None):
+        if self.running:
+            return
+
+        with self._mutex:
+            self.stacks.clear()
+
+        self.running = True
+        self.started_at = time.time()
+        self.stop_at = time.time() + seconds if seconds else None
+        self.thread = threading.Thread(target=self._run, name='profiling-sampler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def _run(self):
+        own = threading.current_thread().ident
+
+        while self.running:
+            if self.stop_at is not None and time.time() >= self.stop_at:
+                self.running = False
+                break
+
+            stacks = []
+
+            for (ident, frame) in sys._current_frames().items():
+                if ident == own:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%s)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+
+                stacks.append(';'.join(reversed(stack)))
+
+            with self._mutex:
+                self.stacks.update(stacks)
+
+            time.sleep(self.interval)
+
+    @property
+    def samples(self):
+        with self._mutex:
+            return sum(self.stacks.values())
+
+    def collapsed(self):
+        with self._mutex:
+            stacks = self.stacks.most_common()
+        return ''.join('%s %s\n' % (stack, count) for (stack, count) in stacks)
+
+    def save(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        filename = os.path.join(directory, 'profile-%s-%s.folded' % (
+            datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S'), os.getpid()))
+
+        with open(filename, 'w') as f:
+            f.write(self.collapsed())
+
+        return filename
+
+
+class Profiling(object):
+    def __init__(self, app=None):
+        self.enabled = False
+        self.directory = None
+        self.endpoints = collections.defaultdict(EndpointStats)
+        self.sampler = Sampler()
+        self._mutex = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['profiling'] = self
+
+        if not app.config.get('PROFILING_ENABLED'):
+            return
+
+        self.enabled = True
+        self.directory = app.config.get('PROFILING_DIR')
+
+        app.before_request(self._start_request)
+        app.teardown_request(self._finish_request)
+
+        before_render_template.connect(self._start_template, app)
+        template_rendered.connect(self._finish_template, app)
+
+        if not event.contains(Engine, 'before_cursor_execute', _start_query):
+            event.listen(Engine, 'before_cursor_execute', _start_query)
+            event.listen(Engine, 'after_cursor_execute', _finish_query)
+
+    def _start_request(self):
+        g._profile = {'start': time.time(), 'queries': 0, 'query_time': 0.0, 'template_time': 0.0, 'templates': []}
+
+    def _finish_request(self, exc=None):
+        profile = g.pop('_profile', None)
+
+        if profile is None:
+            return
+
+        ms = (time.time() - profile['start']) * 1000
+
+        with self._mutex:
+            self.endpoints[request.endpoint or request.url_rule or 'unknown'].add(
+                ms, profile['queries'], profile['query_time'] * 1000, profile['template_time'] * 1000)
+
+    def _start_template(self, sender, template, context, **extra):
+        profile = g.get('_profile')
+        if profile is not None:
+            profile['templates'].append(time.time())
+
+    def _finish_template(self, sender, template, context, **extra):
+        profile = g.get('_profile')
+        if profile is not None and profile['templates']:
+            profile['template_time'] += time.time() - profile['templates'].pop()
+
+    def stats(self):
+        with self._mutex:
+            endpoints = dict((str(endpoint), stats.to_dict()) for (endpoint, stats) in self.endpoints.items())
+
+        return {
+            'enabled': self.enabled,
+            'pid': os.getpid(),
+            'endpoints': endpoints,
+            'sampler': {
+                'running': self.sampler.running,
+                'started_at': self.sampler.started_at,
+                'samples': self.sampler.samples,
+            },
+        }
+
+    def reset(self):
+        with self._mutex:
+            self.endpoints.clear()
+
+    def start_sampler(self, seconds=None):
+        self.sampler.start(seconds)
+
+    def stop_sampler(self):
+        """Stop sampling, saving the stacks to PROFILING_DIR if it is set"""
+        self.sampler.stop()
+
+        if self.directory:
+            return self.sampler.save(self.directory)
+
+
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and '_profile' in g:
+        conn.info.setdefault('profiling_start', []).append(time.time())
+
+
+def _finish_query(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('profiling_start')
+
+    if starts and has_request_context() and '_profile' in g:
+        profile = g._profile
+        profile['queries'] += 1
+        profile['query_time'] += time.time() - starts.pop()
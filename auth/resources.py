@@ -4,20 +4,19 @@ import errno
 import flask
 import os
 
-from auth.models import Network, User, Gateway, Voucher, Category, Product, Country, Currency, db
+from auth.models import Network, User, Gateway, GatewayUsage, Voucher, Category, Product, Country, Currency, db
+from auth.services import coordination, logos
 from flask_potion import Api, fields, signals
 from flask_potion.routes import Relation, Route, ItemRoute
 from flask_potion.contrib.principals import PrincipalResource, PrincipalManager
 from flask_security import current_user
-from flask_uploads import UploadSet, IMAGES
-from PIL import Image
+from sqlalchemy import func
 
 super_admin_only = 'super-admin'
 network_or_above = ['super-admin', 'network-admin']
 gateway_or_above = ['super-admin', 'network-admin', 'gateway-admin']
 
 api = Api(prefix='/api')
-logos = UploadSet('logos', IMAGES)
 
 def mkdir_p(path):
     try:
@@ -34,17 +33,13 @@ class Manager(PrincipalManager):
         if current_user.has_role('network-admin') or current_user.has_role('gateway-admin'):
             if self.model == Network:
                 query = query.filter_by(id=current_user.network_id)
-            elif self.model in [ Gateway, User ]:
+            elif self.model in [ Gateway, GatewayUsage, User, Voucher ]:
                 query = query.filter_by(network_id=current_user.network_id)
 
-        if current_user.has_role('network-admin'):
-            if self.model == Voucher:
-                query = query.join(Voucher.gateway).join(Gateway.network).filter(Network.id == current_user.network_id)
-
         if current_user.has_role('gateway-admin'):
             if self.model == Gateway:
                 query = query.filter_by(id=current_user.gateway_id)
-            elif self.model in [ User, Voucher ]:
+            elif self.model in [ GatewayUsage, User, Voucher ]:
                 query = query.filter_by(gateway_id=current_user.gateway_id)
 
         return query
@@ -56,25 +51,24 @@ class VoucherManager(Manager):
         query = query.filter(Voucher.status != 'archived')
         return query
 
+    def transition(self, voucher, action, commit=True):
+        with coordination.lock('vouchers:%s' % voucher.id):
+            db.session.refresh(voucher)
+            getattr(voucher, action)()
+            if commit:
+                db.session.commit()
+
     def extend(self, voucher, commit=True):
-        voucher.extend()
-        if commit:
-            db.session.commit()
+        self.transition(voucher, 'extend', commit)
 
     def block(self, voucher, commit=True):
-        voucher.block()
-        if commit:
-            db.session.commit()
+        self.transition(voucher, 'block', commit)
 
     def unblock(self, voucher, commit=True):
-        voucher.unblock()
-        if commit:
-            db.session.commit()
+        self.transition(voucher, 'unblock', commit)
 
     def archive(self, voucher, commit=True):
-        voucher.archive()
-        if commit:
-            db.session.commit()
+        self.transition(voucher, 'archive', commit)
 
 class UserResource(PrincipalResource):
     class Meta:
@@ -146,6 +140,8 @@ class GatewayResource(PrincipalResource):
     @ItemRoute.POST
     def logo(self, gateway):
         if 'file' in flask.request.files:
+            from PIL import Image
+
             filename = logos.save(flask.request.files['file'])
 
             self.manager.update(gateway, {
@@ -191,7 +187,7 @@ class VoucherResource(PrincipalResource):
             'update': gateway_or_above,
             'delete': super_admin_only,
         }
-        read_only_fields = ('created_at', 'updated_at', 'available_actions', 'time_left')
+        read_only_fields = ('created_at', 'updated_at', 'available_actions', 'time_left', 'version')
 
     class Schema:
         network = fields.ToOne('networks')
@@ -292,6 +288,37 @@ class CurrencyResource(PrincipalResource):
     class Schema:
         id = fields.String(min_length=3, max_length=3)
 
+class GatewayUsageResource(PrincipalResource):
+    class Meta:
+        manager = Manager
+
+        model = GatewayUsage
+        name = 'usage'
+        include_id = True
+        permissions = {
+            'read': gateway_or_above,
+            'create': 'no',
+            'update': 'no',
+            'delete': 'no',
+        }
+
+    class Schema:
+        network = fields.ToOne('networks')
+        gateway = fields.ToOne('gateways')
+
+    @Route.GET
+    def networks(self):
+        """Daily totals per network, summed from the gateway totals"""
+        columns = ('vouchers_created', 'vouchers_started', 'vouchers_ended', 'incoming', 'outgoing')
+        query = self.manager.instances() \
+                    .with_entities(GatewayUsage.network_id, GatewayUsage.day,
+                                   *[func.sum(getattr(GatewayUsage, column)) for column in columns]) \
+                    .group_by(GatewayUsage.network_id, GatewayUsage.day) \
+                    .order_by(GatewayUsage.day, GatewayUsage.network_id)
+
+        return [dict(zip(('network', 'day') + columns, (row[0], row[1].isoformat()) + tuple(row[2:])))
+                for row in query]
+
 @signals.before_create.connect_via(GatewayResource)
 @signals.before_create.connect_via(UserResource)
 @signals.before_create.connect_via(VoucherResource)
@@ -312,3 +339,4 @@ api.add_resource(CategoryResource)
 api.add_resource(ProductResource)
 api.add_resource(CurrencyResource)
 api.add_resource(CountryResource)
+api.add_resource(GatewayUsageResource)
@@ -0,0 +1,184 @@
+"""
+Revoked vouchers, as a bitmap of voucher ids held in each process
+
+A voucher is revoked while it is archived, blocked, ended or expired, so
+auths for its signed tokens can be denied without loading it. The bitmap
+is built from the database at startup (before forking, when preloaded),
+and commits that move vouchers in or out of those statuses update it
+straight away.
+
+Other processes pick the changes up from the shared cache: each commit
+bumps a generation and leaves its changes under it for
+_REVOCATIONS_CACHE_TIMEOUT_ seconds. A process compares generations at
+most every _REVOCATIONS_SYNC_INTERVAL_ seconds and replays what it missed,
+or rebuilds from the database when the changes are gone.
+"""
+
+from __future__ import absolute_import
+
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import event, inspect
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+REVOKED_STATUSES = ('archived', 'blocked', 'ended', 'expired')
+
+# Beyond this many generations behind, rebuilding is cheaper than replaying
+MAX_REPLAY = 1000
+
+
+class Bitmap(object):
+    """A set of non-negative integers, one bit each"""
+
+    def __init__(self, ids=()):
+        ids = sorted(ids)
+        self.bits = bytearray(ids[-1] // 8 + 1 if ids else 0)
+        for id in ids:
+            self.add(id)
+
+    def add(self, id):
+        (index, bit) = divmod(id, 8)
+        if index >= len(self.bits):
+            # Grow geometrically, ids mostly arrive in order
+            self.bits.extend(bytearray(max(index + 1, 2 * len(self.bits)) - len(self.bits)))
+        self.bits[index] |= 1 << bit
+
+    def discard(self, id):
+        (index, bit) = divmod(id, 8)
+        if index < len(self.bits):
+            self.bits[index] &= ~(1 << bit) & 0xff
+
+    def __contains__(self, id):
+        (index, bit) = divmod(id, 8)
+        return index < len(self.bits) and bool(self.bits[index] >> bit & 1)
+
+    def __len__(self):
+        return sum(bin(byte).count('1') for byte in self.bits)
+
+
+class Revocations(object):
+    """Answers whether a voucher is revoked from the bitmap, keeping it in sync"""
+
+    def __init__(self, app=None):
+        self.bitmap = None
+        self.generation = 0
+        self.synced_at = 0
+        self.mutex = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['revocations'] = self
+
+        # Built again on first use in this app
+        self.bitmap = None
+
+    def rebuild(self):
+        """Build the bitmap from the vouchers currently revoked in the database"""
+        from auth.models import Voucher, db
+        from auth.services import coordination
+
+        # Read first, so changes committed during the query are replayed
+        generation = coordination.cache.get_counter('revocations:generation')
+        query = db.session.query(Voucher.id).filter(Voucher.status.in_(REVOKED_STATUSES))
+
+        self.bitmap = Bitmap(id for (id,) in query)
+        self.generation = generation
+        self.synced_at = time.time()
+
+    def sync(self):
+        """Replay the changes other processes have committed since the last sync"""
+        from auth.services import coordination
+
+        if time.time() - self.synced_at < current_app.config.get('REVOCATIONS_SYNC_INTERVAL', 1):
+            return
+
+        self.synced_at = time.time()
+        generation = coordination.cache.get_counter('revocations:generation')
+
+        if generation == self.generation:
+            return
+
+        if not self.generation < generation <= self.generation + MAX_REPLAY:
+            return self.rebuild()
+
+        for number in range(self.generation + 1, generation + 1):
+            changes = coordination.cache.get('revocations:%s' % number)
+            if changes is None:
+                return self.rebuild()
+            self.apply(changes)
+
+        self.generation = generation
+
+    def apply(self, changes):
+        if self.bitmap is not None:
+            for (voucher_id, revoked) in changes.items():
+                if revoked:
+                    self.bitmap.add(voucher_id)
+                else:
+                    self.bitmap.discard(voucher_id)
+
+    def publish(self, changes):
+        """Apply committed changes here, and leave them for other processes"""
+        from auth.services import coordination
+
+        with self.mutex:
+            self.apply(changes)
+
+        if coordination.backend is not None:
+            generation = coordination.cache.incr('revocations:generation')
+            timeout = current_app.config.get('REVOCATIONS_CACHE_TIMEOUT', 3600)
+            coordination.cache.set('revocations:%s' % generation, changes, timeout)
+
+    def is_revoked(self, voucher_id):
+        """
+        Whether the voucher is revoked, or None when that can't be told
+        without the database (the bitmap couldn't be built)
+        """
+        # Another thread syncing is as good as having synced
+        if self.mutex.acquire(False):
+            try:
+                if self.bitmap is None:
+                    self.rebuild()
+                else:
+                    self.sync()
+            except SQLAlchemyError:
+                current_app.logger.exception('Could not rebuild revoked vouchers')
+            finally:
+                self.mutex.release()
+
+        bitmap = self.bitmap
+
+        if bitmap is None:
+            return None
+
+        return voucher_id in bitmap
+
+
+@event.listens_for(Session, 'after_flush')
+def track_revocations(session, flush_context):
+    from auth.models import Voucher
+
+    changed = session.info.setdefault('changed_revocations', {})
+
+    for instance in session.dirty:
+        if isinstance(instance, Voucher) and inspect(instance).attrs.status.history.has_changes():
+            changed[instance.id] = instance.status in REVOKED_STATUSES
+
+
+@event.listens_for(Session, 'after_commit')
+def publish_revocations(session):
+    from auth.services import revocations
+
+    changed = session.info.pop('changed_revocations', None)
+
+    if changed:
+        revocations.publish(changed)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_revocations(session):
+    session.info.pop('changed_revocations', None)
@@ -1,16 +1,19 @@
 from __future__ import absolute_import
 
+from auth.coordination import Coordination
+from auth.counters import CounterBuffer
+from auth.profiling import Profiling
+from auth.revocations import Revocations
+from auth.tokens import SignedTokens
 from flask_login import LoginManager
-from flask_mail import Mail
-from flask_menu import Menu
 from flask_script import Manager
-from flask_security import Security
-from healthcheck import HealthCheck, EnvironmentDump
+from flask_uploads import UploadSet, IMAGES
 
-healthcheck = HealthCheck()
-environment_dump = EnvironmentDump()
+coordination = Coordination()
+counters = CounterBuffer()
 login_manager = LoginManager()
-mail = Mail()
+logos = UploadSet('logos', IMAGES)
 manager = Manager()
-menu = Menu()
-security = Security()
+profiling = Profiling()
+revocations = Revocations()
+tokens = SignedTokens()
@@ -0,0 +1,314 @@
+"""
+Generate large, realistic datasets for benchmarking
+
+Everything is drawn from one seeded random.Random, so the same options and
+end date always produce the same rows. Vouchers are walked through the
+transitions in graphs.states, and rows are built a batch at a time and
+written with bulk inserts, never as ORM objects.
+"""
+
+from __future__ import absolute_import
+
+import base64
+import bisect
+import datetime
+import json
+import random
+import struct
+
+from auth import constants
+from auth.graphs import states
+from auth.models import Auth, Change, Gateway, Network, Voucher, db
+from sqlalchemy import func
+
+# How often each transition is picked when it is available, against STAY
+EVENT_WEIGHTS = {
+    'login': 60,
+    'extend': 5,
+    'end': 80,
+    'expire': 10,
+    'block': 2,
+    'unblock': 40,
+    'archive': 4,
+}
+
+# Weight of leaving a voucher as it is
+STAY = 15
+
+MINUTES = (30, 60, 60, 60, 90, 120, 180, 1440)
+MEGABYTES = (None, None, None, 100, 250, 500, 1024)
+TIMEZONES = ('Africa/Johannesburg', 'Europe/London', 'America/New_York', 'Asia/Kolkata', None)
+USER_AGENT = 'WiFiDog 20131017'
+
+
+def weighted_choice(rng, items, weights):
+    totals = []
+    total = 0
+
+    for weight in weights:
+        total += weight
+        totals.append(total)
+
+    return items[bisect.bisect_right(totals, rng.random() * total)]
+
+
+def synthetic_code(rng, id):
+    """A code like the ones generated for vouchers, made unique by the (scrambled) id"""
+    prefix = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz0123456789') for _ in range(2))
+    encoded = base64.b32encode(struct.pack('>I', (id * 2654435761) & 0xffffffff) + prefix.encode()).decode()
+    return encoded.rstrip('=')
+
+
+def simulate(rng, created_at, minutes, maxage, until):
+    """
+    Walk a voucher through the state machine, from new until nothing more happens before until
+
+    Events only happen when the gateway would cause them: a login before the
+    voucher expires, the end when its minutes are up, an expiry when it was
+    never used. Returns the events as (event, source, destination, at) and
+    when the voucher was started.
+    """
+    status = 'new'
+    at = created_at
+    started_at = None
+    events = []
+
+    while True:
+        available = sorted(states.get(status, {}))
+        event = weighted_choice(rng, available + [None], [EVENT_WEIGHTS[e] for e in available] + [STAY])
+
+        if event is None:
+            break
+
+        if event == 'login':
+            next_at = created_at + datetime.timedelta(minutes=rng.uniform(0, maxage))
+        elif event == 'expire':
+            next_at = created_at + datetime.timedelta(minutes=maxage)
+        elif event == 'end':
+            next_at = max(at, started_at + datetime.timedelta(minutes=minutes))
+        elif event == 'archive':
+            next_at = at + datetime.timedelta(days=rng.uniform(1, 30))
+        else:
+            next_at = at + datetime.timedelta(minutes=rng.uniform(1, minutes))
+
+        if next_at < at or next_at >= until:
+            break
+
+        if event == 'login':
+            started_at = next_at
+        elif event == 'extend':
+            minutes += 30
+
+        destination = states[status][event]
+        events.append((event, status, destination, next_at))
+
+        status = destination
+        at = next_at
+
+    return status, minutes, started_at, events
+
+
+def generate_auths(rng, voucher, events, interval, until):
+    """A login, then counters every interval minutes until the voucher stops, all rising"""
+    started_at = voucher['started_at']
+
+    stopped_at = min(until, started_at + datetime.timedelta(minutes=voucher['minutes']))
+
+    for (event, source, destination, at) in events:
+        if destination in ('ended', 'blocked', 'archived') and started_at < at < stopped_at:
+            stopped_at = at
+            break
+
+    seconds = (stopped_at - started_at).total_seconds()
+    rate = rng.lognormvariate(9, 1.5)
+    incoming = int(rate * seconds)
+
+    if voucher['megabytes'] is not None:
+        incoming = min(incoming, voucher['megabytes'] * 1024 * 1024)
+
+    outgoing = int(incoming * rng.uniform(0.05, 0.3))
+
+    voucher['incoming'] = incoming
+    voucher['outgoing'] = outgoing
+
+    auth = {
+        'network_id': voucher['network_id'],
+        'gateway_id': voucher['gateway_id'],
+        'voucher_id': voucher['id'],
+        'user_agent': USER_AGENT,
+        'ip': voucher['ip'],
+        'mac': voucher['mac'],
+        'token': voucher['token'],
+        'messages': None,
+    }
+
+    auths = [dict(auth, stage=constants.STAGE_LOGIN, incoming=0, outgoing=0,
+                  status=constants.AUTH_ALLOWED, created_at=started_at)]
+
+    steps = max(1, int(seconds / (interval * 60)))
+    fractions = sorted(rng.random() for _ in range(steps - 1)) + [1.0]
+
+    for (step, fraction) in enumerate(fractions, 1):
+        at = min(started_at + datetime.timedelta(minutes=interval * step), stopped_at)
+        auths.append(dict(auth, stage=constants.STAGE_COUNTERS,
+                          incoming=int(incoming * fraction), outgoing=int(outgoing * fraction),
+                          status=constants.AUTH_ALLOWED, created_at=at))
+
+    if stopped_at < until:
+        auths.append(dict(auth, stage=constants.STAGE_COUNTERS, incoming=incoming, outgoing=outgoing,
+                          status=constants.AUTH_DENIED, messages='Token has ended: %s' % voucher['token'],
+                          created_at=stopped_at))
+
+    return auths
+
+
+def generate_vouchers(rng, start_id, count, gateways, since, until, maxage, auth_interval):
+    """Yield each voucher with its auths and changes, ids from start_id, created evenly over the period"""
+    gateway_ids = [gateway_id for (gateway_id, network_id) in gateways]
+    networks = dict(gateways)
+
+    # A few gateways are much busier than the rest
+    weights = [1.0 / (rank ** 0.8) for rank in range(1, len(gateway_ids) + 1)]
+
+    span = (until - since).total_seconds()
+
+    for i in range(count):
+        id = start_id + i
+        gateway_id = weighted_choice(rng, gateway_ids, weights)
+        created_at = since + datetime.timedelta(seconds=span * (i + rng.random()) / count)
+
+        (status, minutes, started_at, events) = simulate(rng, created_at, rng.choice(MINUTES), maxage, until)
+
+        voucher = {
+            'id': id,
+            'network_id': networks[gateway_id],
+            'gateway_id': gateway_id,
+            'code': synthetic_code(rng, id),
+            'minutes': minutes,
+            'megabytes': rng.choice(MEGABYTES),
+            'status': status,
+            'created_at': created_at,
+            'updated_at': events[-1][3] if events else created_at,
+            'started_at': started_at,
+            'gw_address': None,
+            'gw_port': None,
+            'url': None,
+            'name': None,
+            'email': None,
+            'token': None,
+            'mac': None,
+            'ip': None,
+            'incoming': 0,
+            'outgoing': 0,
+            'version': 1 + len(events),
+        }
+
+        auths = []
+
+        if started_at is not None:
+            voucher['token'] = '%032x' % rng.getrandbits(128)
+            voucher['mac'] = ':'.join('%02x' % rng.getrandbits(8) for _ in range(6))
+            voucher['ip'] = '10.%s.%s.%s' % (rng.randint(0, 255), rng.randint(0, 255), rng.randint(2, 254))
+
+            if rng.random() < 0.3:
+                voucher['name'] = u'Guest %s' % id
+                voucher['email'] = u'guest%s@example.com' % id
+
+            auths = generate_auths(rng, voucher, events, auth_interval, until)
+
+        changes = [{
+            'changed_type': 'Voucher',
+            'changed_id': id,
+            'event': event,
+            'source': source,
+            'destination': destination,
+            'args': json.dumps({}),
+            'user_id': None,
+            'created_at': at,
+        } for (event, source, destination, at) in events]
+
+        yield voucher, auths, changes
+
+
+def create_networks(rng, prefix, networks, gateways, since):
+    """Networks and their gateways, as (gateway_id, network_id) pairs"""
+    network_ids = [u'%s-%s' % (prefix, n) for n in range(networks)]
+
+    if Network.query.filter(Network.id.in_(network_ids)).count():
+        raise ValueError('Networks prefixed %s already exist' % prefix)
+
+    db.session.execute(Network.__table__.insert(), [{
+        'id': network_id,
+        'title': u'Synthetic Network #%s' % n,
+        'timezone': rng.choice(TIMEZONES),
+    } for (n, network_id) in enumerate(network_ids)])
+
+    pairs = [(u'%s-gw%s' % (prefix, n), network_ids[n % networks]) for n in range(gateways)]
+
+    db.session.execute(Gateway.__table__.insert(), [{
+        'id': gateway_id,
+        'network_id': network_id,
+        'title': u'Synthetic Gateway #%s' % n,
+        'created_at': since,
+        'updated_at': since,
+    } for (n, (gateway_id, network_id)) in enumerate(pairs)])
+
+    db.session.commit()
+
+    return pairs
+
+
+def generate_data(networks=2, gateways=100, vouchers=10000, days=30, seed=0, until=None, prefix=u'synthetic',
+                  batch_size=5000, auth_interval=15, maxage=60 * 24, progress=None):
+    """
+    Insert networks, gateways and vouchers with their auths and changes
+
+    Vouchers get explicit ids after the current highest one and are written
+    a batch at a time, each batch in one transaction. Returns the counts of
+    rows written by table.
+    """
+    if networks < 1 or gateways < networks:
+        raise ValueError('Every network needs at least one gateway')
+
+    rng = random.Random(seed)
+
+    if until is None:
+        until = datetime.datetime.combine(datetime.datetime.utcnow().date(), datetime.time())
+
+    since = until - datetime.timedelta(days=days)
+
+    pairs = create_networks(rng, prefix, networks, gateways, since)
+
+    start_id = (db.session.query(func.max(Voucher.id)).scalar() or 0) + 1
+
+    totals = {'networks': networks, 'gateways': gateways, 'vouchers': 0, 'auths': 0, 'changes': 0}
+    batch = {'vouchers': [], 'auths': [], 'changes': []}
+
+    def flush():
+        for (name, model) in (('vouchers', Voucher), ('auths', Auth), ('changes', Change)):
+            if batch[name]:
+                db.session.execute(model.__table__.insert(), batch[name])
+                totals[name] += len(batch[name])
+                batch[name] = []
+
+        db.session.commit()
+
+        if progress is not None:
+            progress(totals)
+
+    for (voucher, auths, changes) in generate_vouchers(rng, start_id, vouchers, pairs, since, until, maxage, auth_interval):
+        batch['vouchers'].append(voucher)
+        batch['auths'].extend(auths)
+        batch['changes'].extend(changes)
+
+        if len(batch['vouchers']) == batch_size:
+            flush()
+
+    flush()
+
+    # Explicit ids leave a sequence behind
+    if db.session.bind.dialect.name == 'postgresql':
+        db.session.execute("SELECT setval(pg_get_serial_sequence('vouchers', 'id'), (SELECT max(id) FROM vouchers))")
+        db.session.commit()
+
+    return totals
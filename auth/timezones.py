@@ -0,0 +1,149 @@
+"""
+Format UTC datetimes in the timezone of a gateway, its network or the server
+"""
+
+from __future__ import absolute_import
+
+import datetime
+
+import pytz
+
+from auth.services import coordination
+from dateutil.tz import tzlocal
+from flask import current_app, g
+
+_zones = {}
+_offsets = {}
+
+
+def get_zone(name=None):
+    """A tzinfo by name, the default zone for None, each built only once"""
+    name = name or current_app.config.get('TIMEZONE')
+
+    zone = _zones.get(name)
+
+    if zone is None:
+        try:
+            zone = tzlocal() if name is None else pytz.timezone(name)
+        except pytz.UnknownTimeZoneError:
+            zone = tzlocal()
+        _zones[name] = zone
+
+    return zone
+
+
+def gateway_zones():
+    """
+    Timezone names per gateway, falling back to the network's
+
+    Loaded in two small queries and kept until a gateway or network changes (using
+    the generations maintained for the cached options).
+    """
+    if '_gateway_zones' not in g:
+        from auth.models import Gateway, Network, db
+
+        cache = coordination.cache
+        generation = (cache.get_counter('options:gateways:generation'),
+                      cache.get_counter('options:networks:generation'))
+
+        state = current_app.extensions.setdefault('gateway_zones', [None, {}])
+
+        if state[0] != generation:
+            networks = dict(db.session.query(Network.id, Network.timezone))
+            gateways = dict((gateway_id, zone or networks.get(network_id)) for (gateway_id, network_id, zone) in
+                            db.session.query(Gateway.id, Gateway.network_id, Gateway.timezone))
+
+            zones = {'networks': networks, 'gateways': gateways}
+
+            state[:] = [generation, zones]
+
+        g._gateway_zones = state[1]
+
+    return g._gateway_zones
+
+
+def zone_for(gateway=None, network=None):
+    """The zone for a gateway or network id, or the default"""
+    name = None
+
+    if gateway is not None or network is not None:
+        zones = gateway_zones()
+        name = zones['gateways'].get(gateway) or zones['networks'].get(network)
+
+    return get_zone(name)
+
+
+def offset_at(zone, value):
+    return pytz.utc.localize(value).astimezone(zone).utcoffset()
+
+
+def utc_offset(zone, value):
+    """
+    The zone's UTC offset at a naive UTC datetime
+
+    Offsets are remembered per zone and quarter hour, so most values are
+    converted with one lookup and an addition. Quarters with a transition in
+    them are remembered as such, and their values converted exactly.
+    """
+    quarter = value.replace(minute=value.minute - value.minute % 15, second=0, microsecond=0)
+
+    # By name, the default tzlocal() can't be hashed
+    key = (getattr(zone, 'zone', 'local'), quarter)
+
+    offset = _offsets.get(key)
+
+    if offset is None:
+        if len(_offsets) > 10000:
+            _offsets.clear()
+
+        start = offset_at(zone, quarter)
+        end = offset_at(zone, quarter + datetime.timedelta(minutes=15, microseconds=-1))
+        offset = _offsets[key] = start if start == end else False
+
+    if offset is False:
+        return offset_at(zone, value)
+
+    return offset
+
+
+def local_datetime(value, format='%I:%M %p', gateway=None, network=None):
+    """Format a naive UTC datetime in the zone of a gateway, network or the server"""
+    if value is None:
+        return None
+
+    zone = zone_for(gateway, network)
+
+    return (value + utc_offset(zone, value)).strftime(format)
+
+
+def local_datetimes(rows, attributes, format='%I:%M %p'):
+    """
+    Format datetime attributes of a whole page of rows at once
+
+    Each row is formatted in the zone of its gateway (or network), and
+    returns a dict of the formatted attributes, in the same order as the rows.
+    """
+    zones = {}
+    formatted = []
+
+    for row in rows:
+        key = (getattr(row, 'gateway_id', None), getattr(row, 'network_id', None))
+
+        zone = zones.get(key)
+
+        if zone is None:
+            zone = zones[key] = zone_for(*key)
+
+        values = {}
+
+        for attribute in attributes:
+            value = getattr(row, attribute)
+
+            if isinstance(value, datetime.datetime):
+                value = (value + utc_offset(zone, value)).strftime(format)
+
+            values[attribute] = value
+
+        formatted.append(values)
+
+    return formatted
@@ -0,0 +1,134 @@
+"""
+Signed voucher session tokens, which gateways can be authorized from without the database
+
+A signed token carries the voucher id, gateway, MAC, start time, minutes
+and megabytes, with an HMAC over them. While it is within its minutes and
+megabytes, for the gateway and device it was issued to, and its voucher
+hasn't been revoked, auth requests are answered from the token alone. The
+usual processing then runs off the request, recording the auth and moving
+the voucher on; anything the token can't vouch for goes to the database
+as before.
+
+Revoked vouchers are told from a bitmap, see auth.revocations.
+"""
+
+from __future__ import absolute_import
+
+import base64
+import datetime
+import hashlib
+import hmac
+import struct
+
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+
+# Tells signed tokens from the random hex ones
+PREFIX = 's1.'
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def encode(data):
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode(data):
+    return base64.urlsafe_b64decode(str(data) + '=' * (-len(data) % 4))
+
+
+def signature(secret, payload):
+    return hmac.new(secret.encode('utf-8'), payload, hashlib.sha256).digest()[:20]
+
+
+def sign_token(secret, voucher_id, gateway_id, mac, started_at, minutes, megabytes=None):
+    """A token for a voucher session starting at started_at"""
+    started = int((started_at - EPOCH).total_seconds())
+    payload = struct.pack('>IIIq', voucher_id, started, minutes, -1 if megabytes is None else megabytes)
+    payload += u'\n'.join([gateway_id or u'', (mac or u'').lower()]).encode('utf-8')
+
+    return PREFIX + encode(payload) + '.' + encode(signature(secret, payload))
+
+
+def read_token(secret, token):
+    """The claims of a signed token, or None if it isn't one or the signature doesn't match"""
+    if not token or not token.startswith(PREFIX):
+        return None
+
+    try:
+        (payload, digest) = [decode(part) for part in token[len(PREFIX):].split('.')]
+    except (TypeError, ValueError):
+        return None
+
+    if len(payload) < 20 or not hmac.compare_digest(digest, signature(secret, payload)):
+        return None
+
+    (voucher_id, started, minutes, megabytes) = struct.unpack('>IIIq', payload[:20])
+    (gateway_id, mac) = payload[20:].decode('utf-8').split(u'\n')
+
+    return {
+        'voucher_id': voucher_id,
+        'gateway_id': gateway_id,
+        'mac': mac,
+        'started_at': EPOCH + datetime.timedelta(seconds=started),
+        'minutes': minutes,
+        'megabytes': None if megabytes < 0 else megabytes,
+    }
+
+
+class SignedTokens(object):
+    """Issues and reads signed tokens, and runs the processing of auths answered from them"""
+
+    def __init__(self, app=None):
+        self.executor = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['tokens'] = self
+
+        threads = app.config.get('SIGNED_TOKENS_THREADS', 2)
+
+        if app.config.get('SIGNED_TOKENS') and threads and self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=threads)
+
+        # Revocations reach other processes through the shared cache only
+        if app.config.get('SIGNED_TOKENS') and app.config.get('COORDINATION_URL', 'memory://').startswith('memory:'):
+            app.logger.warning('SIGNED_TOKENS with an in-process COORDINATION_URL: vouchers revoked in one '
+                               'process stay allowed in the others, run a single process or share a Redis server')
+
+    @property
+    def enabled(self):
+        return current_app.config.get('SIGNED_TOKENS', False)
+
+    @property
+    def secret(self):
+        return current_app.config.get('SIGNED_TOKENS_SECRET') or current_app.config['SECRET_KEY']
+
+    def sign(self, voucher, started_at):
+        return sign_token(self.secret, voucher.id, voucher.gateway_id, voucher.mac, started_at,
+                          voucher.minutes, voucher.megabytes)
+
+    def read(self, token):
+        return read_token(self.secret, token)
+
+    def defer(self, func, *args):
+        """Run func in an app context off the request, or straight away when SIGNED_TOKENS_THREADS is 0"""
+        app = current_app._get_current_object()
+
+        if not app.config.get('SIGNED_TOKENS_THREADS', 2) or self.executor is None:
+            func(*args)
+        else:
+            self.executor.submit(self._run, app, func, args)
+
+    def _run(self, app, func, args):
+        from auth.models import db
+
+        with app.app_context():
+            try:
+                func(*args)
+            except Exception:
+                app.logger.exception('Deferred auth processing failed')
+            finally:
+                db.session.remove()
+
@@ -2,7 +2,7 @@ from __future__ import absolute_import
 
 import flask
 
-from flask_security import current_user
+from flask_login import current_user
 
 def is_logged_out():
     return not current_user.is_authenticated
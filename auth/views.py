@@ -6,7 +6,6 @@ from __future__ import absolute_import
 from __future__ import division
 
 import os
-import uuid
 
 from auth import constants
 
@@ -15,31 +14,33 @@ from auth.forms import \
     CountryForm, \
     CurrencyForm, \
     GatewayForm, \
-    LoginVoucherForm, \
     MyUserForm, \
     NetworkForm, \
     NewVoucherForm, \
     ProductForm, \
     UserForm
 
-from auth.models import Auth, Category, Country, Currency, Gateway, Network, Product, User, Voucher, db
-# from auth.payu import get_transaction, set_transaction, capture
-from auth.resources import logos
-from auth.services import \
-        environment_dump, \
-        healthcheck as healthcheck_service
+from auth.exports import EXPORTS, FORMATS, export_filters, export_query, export_rows, gzip_chunks
+from auth.models import Auth, Category, Change, Country, Currency, Gateway, Network, Product, Transaction, User, Voucher, db
+from auth.orders import OrderError, create_order, orders, start_payment
+from auth.payu import PayUError, payu
+from auth.coordination import LockError
+from auth.admin_services import environment_dump, healthcheck as healthcheck_service
+from auth.services import coordination, logos, profiling
 from auth.utils import is_logged_in, has_role
 
 from flask import \
     Blueprint, \
+    Response, \
     abort, \
     current_app, \
     flash, \
+    jsonify, \
     redirect, \
     request, \
     render_template, \
     send_from_directory, \
-    session, \
+    stream_with_context, \
     url_for
 from flask_menu import register_menu
 from flask_potion.exceptions import ItemNotFound
@@ -48,13 +49,15 @@ from flask_security import \
     current_user, \
     login_required, \
     roles_accepted
-from PIL import Image
+from lxml import etree
 
 
 bp = Blueprint('auth', __name__)
 
 RESOURCE_MODELS = {
+    'auths': Auth,
     'categories': Category,
+    'changes': Change,
     'countries': Country,
     'currencies': Currency,
     'gateways': Gateway,
@@ -65,11 +68,6 @@ RESOURCE_MODELS = {
 }
 
 
-def generate_token():
-    """Generate token for the voucher session"""
-    return uuid.uuid4().hex
-
-
 def resource_query(resource):
     """Generate a filtered query for a resource"""
     model = RESOURCE_MODELS[resource]
@@ -78,17 +76,17 @@ def resource_query(resource):
     if current_user.has_role('network-admin') or current_user.has_role('gateway-admin'):
         if model == Network:
             query = query.filter_by(id=current_user.network_id)
-        elif model in [ Gateway, User ]:
+        elif model in [ Auth, Gateway, User, Voucher ]:
             query = query.filter_by(network_id=current_user.network_id)
-
-    if current_user.has_role('network-admin'):
-        if model == Voucher:
-            query = query.join(Voucher.gateway).join(Gateway.network).filter(Network.id == current_user.network_id)
+        elif model == Change:
+            vouchers = resource_query('vouchers').with_entities(Voucher.id).subquery()
+            query = query.filter(Change.changed_type == 'Voucher',
+                                 Change.changed_id.in_(vouchers.select()))
 
     if current_user.has_role('gateway-admin'):
         if model == Gateway:
             query = query.filter_by(id=current_user.gateway_id)
-        elif model in [ User, Voucher ]:
+        elif model in [ Auth, User, Voucher ]:
             query = query.filter_by(gateway_id=current_user.gateway_id)
 
     return query
@@ -159,9 +157,15 @@ def resource_action(resource, id, action):
     instance = resource_instance(resource, id)
     if request.method == 'POST':
         if action in constants.ACTIONS[resource]:
-            getattr(instance, action)()
-            db.session.commit()
-            flash('%s %s successful' % (instance, action))
+            try:
+                with coordination.lock('%s:%s' % (resource, instance.id)):
+                    db.session.refresh(instance)
+                    getattr(instance, action)()
+                    db.session.commit()
+            except LockError:
+                flash('%s is busy, please try again' % instance, 'error')
+            else:
+                flash('%s %s successful' % (instance, action))
             return redirect(url_for('.%s_index' % resource))
         else:
             abort(404)
@@ -286,6 +290,8 @@ def gateways_index():
 
 def handle_logo(form):
     if request.files['logo']:
+        from PIL import Image
+
         filename = form.logo.data = logos.save(request.files['logo'], name='%s.' % form.id.data)
         im = Image.open(logos.path(filename))
         im.thumbnail((300, 300), Image.ANTIALIAS)
@@ -436,6 +442,33 @@ def vouchers_action(id, action):
     return resource_action('vouchers', id, action)
 
 
+@bp.route('/export/<resource>.<format>')
+@login_required
+@roles_accepted('super-admin', 'network-admin', 'gateway-admin')
+def export(resource, format):
+    if resource not in EXPORTS or format not in FORMATS:
+        abort(404)
+
+    try:
+        filters = export_filters(request.args)
+    except ValueError:
+        abort(400)
+
+    rows = export_query(resource, resource_query(resource), **filters)
+    chunks = export_rows(resource, rows, format)
+
+    headers = {
+        'Content-Disposition': 'attachment; filename=%s.%s' % (resource, format),
+        'Vary': 'Accept-Encoding',
+    }
+
+    if 'gzip' in request.accept_encodings:
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+
+    return Response(stream_with_context(chunks), mimetype=FORMATS[format], headers=headers)
+
+
 @bp.route('/categories')
 @login_required
 @roles_accepted('super-admin', 'network-admin', 'gateway-admin')
@@ -648,147 +681,76 @@ def vouchers_new():
     return render_template('vouchers/new.html', form=form, defaults=defaults)
 
 
-@bp.route('/wifidog/login/', methods=['GET', 'POST'])
-def wifidog_login():
-    form = LoginVoucherForm(request.form)
-
-    if form.validate_on_submit():
-        voucher_code = form.voucher_code.data.upper()
-        voucher = Voucher.query.filter_by(code=voucher_code, status='new').first()
-
-        if voucher is None:
-            flash(
-                'Voucher not found, did you type the code correctly?',
-                'error'
-            )
-
-            return redirect(request.referrer)
-
-        form.populate_obj(voucher)
-        voucher.token = generate_token()
-        db.session.commit()
-
-        session['voucher_token'] = voucher.token
-
-        url = ('http://%s:%s/wifidog/auth?token=%s' %
-               (voucher.gw_address,
-                voucher.gw_port,
-                voucher.token))
-
-        return redirect(url)
-
-    if request.method == 'GET':
-        gateway_id = request.args.get('gw_id')
+@bp.route('/pay', methods=['GET', 'POST'])
+@login_required
+def pay():
+    product = resource_instance('products', request.values.get('product', type=int))
+    gateway = resource_instance('gateways', request.values.get('gateway') or product.gateway_id or current_user.gateway_id)
+
+    try:
+        order = create_order(current_user._get_current_object(),
+                             gateway,
+                             [(product, request.values.get('units', 1, type=int))])
+        transaction = start_payment(order,
+                                    url_for('.pay_return', _external=True),
+                                    url_for('.pay_cancel', _external=True),
+                                    url_for('.pay_notify', _external=True))
+    except (OrderError, PayUError) as e:
+        db.session.rollback()
+        flash('Payment could not be started: %s' % e, 'error')
+        return redirect(url_for('.home'))
+    return redirect(payu.capture_url(transaction.id))
+
+
+def pay_response(reference):
+    transaction = Transaction.query.filter_by(id=reference, user_id=current_user.id).first_or_404()
+    orders.queue(transaction.id)
+
+    # A worker may have settled it meanwhile
+    db.session.refresh(transaction)
+
+    if transaction.status == 'successful':
+        flash('Payment successful', 'success')
+    elif transaction.status == 'new':
+        flash('Payment is being processed, your vouchers will be issued shortly', 'info')
     else:
-        gateway_id = form.gateway_id.data
-
-    if gateway_id is None:
-        abort(404)
-
-    gateway = Gateway.query.filter_by(id=gateway_id).first_or_404()
-
-    return render_template('wifidog/login.html', form=form, gateway=gateway)
+        flash('Payment %s' % transaction.status, 'error')
 
+    return render_template('payu/transaction.html',
+                           transaction=transaction,
+                           order=transaction.order)
 
-@bp.route('/wifidog/ping/')
-def wifidog_ping():
-    return ('Pong', 200)
 
+@bp.route('/pay/return')
+@login_required
+def pay_return():
+    return pay_response(request.args.get('PayUReference'))
 
-@bp.route('/wifidog/auth/')
-def wifidog_auth():
-    auth = Auth(
-        user_agent=request.user_agent.string,
-        stage=request.args.get('stage'),
-        ip=request.args.get('ip'),
-        mac=request.args.get('mac'),
-        token=request.args.get('token'),
-        incoming=int(request.args.get('incoming')),
-        outgoing=int(request.args.get('outgoing')),
-        gateway_id=request.args.get('gw_id')
-    )
 
-    (auth.status, auth.messages) = auth.process_request()
-
-    db.session.add(auth)
-    db.session.commit()
-
-    def generate_point(measurement):
-        return {
-            "measurement": 'auth_%s' % measurement,
-            "tags": {
-                "source": "auth",
-                "network_id": auth.gateway.network_id,
-                "gateway_id": auth.gateway_id,
-                "user_agent": auth.user_agent,
-                "stage": auth.stage,
-                "ip": auth.ip,
-                "mac": auth.mac,
-                "token": auth.token,
-            },
-            "time": auth.created_at,
-            "fields": {
-                "value": getattr(auth, measurement),
-            }
-        }
+@bp.route('/pay/cancel')
+@login_required
+def pay_cancel():
+    return pay_response(request.args.get('PayUReference') or request.args.get('payUReference'))
 
-    # points = [generate_point(m) for m in [ 'incoming', 'outgoing' ]]
-    # influx_db.connection.write_points(points)
 
-    return ("Auth: %s\nMessages: %s\n" % (auth.status, auth.messages), 200)
+@bp.route('/pay/notify', methods=['POST'])
+def pay_notify():
+    """PayU's instant payment notification, answered before the transaction is checked"""
+    reference = request.values.get('PayUReference')
 
+    if reference is None and request.data:
+        try:
+            parser = etree.XMLParser(resolve_entities=False, no_network=True)
+            reference = etree.fromstring(request.data, parser).findtext('.//PayUReference')
+        except etree.XMLSyntaxError:
+            abort(400)
 
-@bp.route('/wifidog/portal/')
-def wifidog_portal():
-    voucher_token = session.get('voucher_token')
-    if voucher_token:
-        voucher = Voucher.query.filter_by(token=voucher_token).first()
-    else:
-        voucher = None
-    gateway_id = request.args.get('gw_id')
-    if gateway_id is None:
+    if Transaction.query.get(reference or '') is None:
         abort(404)
-    gateway = Gateway.query.filter_by(id=gateway_id).first_or_404()
-    logo_url = None
-    if gateway.logo:
-        logo_url = logos.url(gateway.logo)
-    return render_template('wifidog/portal.html',
-                           gateway=gateway,
-                           logo_url=logo_url,
-                           voucher=voucher)
-
-
-@bp.route('/pay')
-def pay():
-    return_url = url_for('.pay_return', _external=True)
-    cancel_url = url_for('.pay_cancel', _external=True)
-    response = set_transaction('ZAR',
-                               1000,
-                               'Something',
-                               return_url,
-                               cancel_url)
-    return redirect('%s?PayUReference=%s' % (capture, response.payUReference))
-
-
-@bp.route('/pay/return')
-def pay_return():
-    response = get_transaction(request.args.get('PayUReference'))
-    basketAmount = '{:.2f}'.format(int(response.basket.amountInCents) / 100)
-    category = 'success' if response.successful else 'error'
-    flash(response.displayMessage, category)
-    return render_template('payu/transaction.html',
-                           response=response,
-                           basketAmount=basketAmount)
 
+    orders.queue(reference)
 
-@bp.route('/pay/cancel')
-def pay_cancel():
-    response = get_transaction(request.args.get('payUReference'))
-    basketAmount = '{:.2f}'.format(int(response.basket.amountInCents) / 100)
-    flash(response.displayMessage, 'warning')
-    return render_template('payu/transaction.html',
-                           response=response,
-                           basketAmount=basketAmount)
+    return Response('OK', mimetype='text/plain')
 
 
 @bp.route('/favicon.ico')
@@ -817,6 +779,39 @@ def environment():
     return environment_dump.dump_environment()
 
 
+@bp.route('/profiling')
+@auth_token_required
+def profiling_stats():
+    return jsonify(profiling.stats())
+
+
+@bp.route('/profiling/<action>', methods=['POST'])
+@auth_token_required
+def profiling_action(action):
+    if not profiling.enabled:
+        abort(404)
+
+    if action == 'start':
+        profiling.start_sampler(request.args.get('seconds', type=int))
+        return jsonify(profiling.stats())
+
+    if action == 'stop':
+        filename = profiling.stop_sampler()
+        return jsonify(dict(profiling.stats(), filename=filename))
+
+    if action == 'reset':
+        profiling.reset()
+        return jsonify(profiling.stats())
+
+    abort(404)
+
+
+@bp.route('/profiling/samples')
+@auth_token_required
+def profiling_samples():
+    return Response(profiling.sampler.collapsed(), mimetype='text/plain')
+
+
 @bp.route('/')
 def home():
     return redirect(url_for('security.login'))
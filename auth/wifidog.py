@@ -0,0 +1,197 @@
+"""
+WifiDog gateway protocol views
+"""
+
+from __future__ import absolute_import
+
+import datetime
+import uuid
+
+from auth import constants
+from auth.catalog import catalog
+from auth.models import Auth, Gateway, Voucher, db
+from auth.services import counters, logos, tokens
+
+from flask import \
+    Blueprint, \
+    abort, \
+    current_app, \
+    flash, \
+    redirect, \
+    request, \
+    render_template, \
+    session
+from sqlalchemy.orm.exc import StaleDataError
+
+
+bp = Blueprint('wifidog', __name__)
+
+
+def generate_token():
+    """Generate token for the voucher session"""
+    return uuid.uuid4().hex
+
+
+@bp.route('/wifidog/login/', methods=['GET', 'POST'])
+def wifidog_login():
+    # WTForms is only loaded once someone logs in, not for auths and pings
+    from auth.forms import LoginVoucherForm
+
+    form = LoginVoucherForm(request.form)
+
+    if form.validate_on_submit():
+        voucher_code = form.voucher_code.data.upper()
+        voucher = Voucher.query.filter_by(code=voucher_code, status='new').first()
+
+        if voucher is None:
+            flash(
+                'Voucher not found, did you type the code correctly?',
+                'error'
+            )
+
+            return redirect(request.referrer)
+
+        form.populate_obj(voucher)
+
+        if tokens.enabled:
+            voucher.token = tokens.sign(voucher, datetime.datetime.utcnow())
+        else:
+            voucher.token = generate_token()
+
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+
+            flash(
+                'Voucher is already being used, please try again',
+                'error'
+            )
+
+            return redirect(request.referrer)
+
+        session['voucher_token'] = voucher.token
+
+        url = ('http://%s:%s/wifidog/auth?token=%s' %
+               (voucher.gw_address,
+                voucher.gw_port,
+                voucher.token))
+
+        return redirect(url)
+
+    if request.method == 'GET':
+        gateway_id = request.args.get('gw_id')
+    else:
+        gateway_id = form.gateway_id.data
+
+    if gateway_id is None:
+        abort(404)
+
+    gateway = Gateway.query.filter_by(id=gateway_id).first_or_404()
+
+    return render_template('wifidog/login.html', form=form, gateway=gateway)
+
+
+@bp.route('/wifidog/ping/')
+def wifidog_ping():
+    return ('Pong', 200)
+
+
+def process_auth(values):
+    """Process an auth request against the database and record it"""
+    auth = Auth(**values)
+
+    for attempt in range(current_app.config.get('AUTH_CONFLICT_RETRIES', 3)):
+        (auth.status, auth.messages) = auth.process_request()
+
+        db.session.add(auth)
+
+        try:
+            db.session.commit()
+            break
+        except StaleDataError:
+            # Voucher changed underneath us, process against the new state
+            db.session.rollback()
+    else:
+        (auth.status, auth.messages) = (constants.AUTH_ERROR, 'Token was updated concurrently: %s' % auth.token)
+
+        db.session.add(auth)
+        db.session.commit()
+
+    # This auth is committed, a failed flush only holds the counters for the next one
+    if counters.due():
+        counters.flush()
+
+    return auth
+
+
+@bp.route('/wifidog/auth/')
+def wifidog_auth():
+    values = dict(
+        user_agent=request.user_agent.string,
+        stage=request.args.get('stage'),
+        ip=request.args.get('ip'),
+        mac=request.args.get('mac'),
+        token=request.args.get('token'),
+        incoming=int(request.args.get('incoming')),
+        outgoing=int(request.args.get('outgoing')),
+        gateway_id=request.args.get('gw_id')
+    )
+
+    if tokens.enabled:
+        claims = tokens.read(values['token'])
+
+        if claims is not None:
+            answer = Auth(**values).process_token(claims)
+
+            if answer is not None:
+                # Record it and move the voucher on without keeping the gateway waiting
+                tokens.defer(process_auth, values)
+                return ("Auth: %s\nMessages: %s\n" % answer, 200)
+
+    auth = process_auth(values)
+
+    def generate_point(measurement):
+        return {
+            "measurement": 'auth_%s' % measurement,
+            "tags": {
+                "source": "auth",
+                "network_id": auth.network_id,
+                "gateway_id": auth.gateway_id,
+                "user_agent": auth.user_agent,
+                "stage": auth.stage,
+                "ip": auth.ip,
+                "mac": auth.mac,
+                "token": auth.token,
+            },
+            "time": auth.created_at,
+            "fields": {
+                "value": getattr(auth, measurement),
+            }
+        }
+
+    # points = [generate_point(m) for m in [ 'incoming', 'outgoing' ]]
+    # influx_db.connection.write_points(points)
+
+    return ("Auth: %s\nMessages: %s\n" % (auth.status, auth.messages), 200)
+
+
+@bp.route('/wifidog/portal/')
+def wifidog_portal():
+    voucher_token = session.get('voucher_token')
+    if voucher_token:
+        voucher = Voucher.query.filter_by(token=voucher_token).first()
+    else:
+        voucher = None
+    gateway_id = request.args.get('gw_id')
+    if gateway_id is None:
+        abort(404)
+    gateway = Gateway.query.filter_by(id=gateway_id).first_or_404()
+    logo_url = None
+    if gateway.logo:
+        logo_url = logos.url(gateway.logo)
+    return render_template('wifidog/portal.html',
+                           catalog=catalog(gateway.network_id, gateway.id),
+                           gateway=gateway,
+                           logo_url=logo_url,
+                           voucher=voucher)
@@ -18,25 +18,66 @@ if os.path.isfile(dotenv_path):
     with open(dotenv_path) as dotenv_file:
         load_env(read(dotenv_file))
 
+APP_MODE = os.environ.get('APP_MODE', 'full')
+AUTH_CONFLICT_RETRIES = 3
+AUTHS_ARCHIVE_DIR = os.path.join(BASE_DIR, 'data/archive')
+AUTHS_RETENTION_DAYS = int(os.environ.get('AUTHS_RETENTION_DAYS', 30))
+CATALOG_CACHE_TIMEOUT = int(os.environ.get('CATALOG_CACHE_TIMEOUT', 300))
+COORDINATION_URL = os.environ.get('COORDINATION_URL', 'memory://')
+COUNTERS_FLUSH_INTERVAL = int(os.environ.get('COUNTERS_FLUSH_INTERVAL', 0))
 DATABASE_CONNECTION_OPTIONS = {}
+FRAGMENT_CACHE_TIMEOUT = int(os.environ.get('FRAGMENT_CACHE_TIMEOUT', 300))
 GOOGLE_ANALYTICS_TRACKING_ID = os.environ.get('GOOGLE_ANALYTICS_TRACKING_ID')
 GTM_CONTAINER_ID = os.environ.get('GTM_CONTAINER_ID')
+HEALTHCHECK_MAIL = asbool(os.environ.get('HEALTHCHECK_MAIL', False))
+HEALTHCHECK_MIN_FREE_MB = int(os.environ.get('HEALTHCHECK_MIN_FREE_MB', 100))
+HEALTHCHECK_SCHEDULER = asbool(os.environ.get('HEALTHCHECK_SCHEDULER', False))
+HEALTHCHECK_TIMEOUT = 2
+HEALTHCHECK_TTL = int(os.environ.get('HEALTHCHECK_TTL', 10))
 HOST = os.environ.get('HOST', '127.0.0.1')
 MAIL_DEFAULT_SENDER = ['Datashaman Auth', 'no-reply@auth.datashaman.com']
+OPTIONS_CACHE_TIMEOUT = int(os.environ.get('OPTIONS_CACHE_TIMEOUT', 300))
+ORDER_MAXAGE = int(os.environ.get('ORDER_MAXAGE', 1440))
+ORDER_THREADS = int(os.environ.get('ORDER_THREADS', 2))
+PASSWORD_VERIFY_CONCURRENCY = int(os.environ.get('PASSWORD_VERIFY_CONCURRENCY', 0))
+PAYU_API = 'ONE_ZERO'
+PAYU_CACHE_DIR = os.path.join(BASE_DIR, 'data/payu')
+PAYU_CAPTURE_URL = os.environ.get('PAYU_CAPTURE_URL', 'https://staging.payu.co.za/rpp.do')
+PAYU_PASSWORD = os.environ.get('PAYU_PASSWORD')
+PAYU_PAYMENT_METHODS = os.environ.get('PAYU_PAYMENT_METHODS', 'CREDITCARD')
+PAYU_SAFEKEY = os.environ.get('PAYU_SAFEKEY')
+PAYU_THREADS = int(os.environ.get('PAYU_THREADS', 4))
+PAYU_TIMEOUT = int(os.environ.get('PAYU_TIMEOUT', 10))
+PAYU_USERNAME = os.environ.get('PAYU_USERNAME')
+PAYU_WSDL = os.environ.get('PAYU_WSDL', 'https://staging.payu.co.za/service/PayUAPI?wsdl')
+PAYU_WSDL_CACHE_DAYS = int(os.environ.get('PAYU_WSDL_CACHE_DAYS', 30))
 PORT = os.environ.get('PORT', 8080)
+PROFILING_DIR = os.path.join(BASE_DIR, 'data/profiles')
+PROFILING_ENABLED = asbool(os.environ.get('PROFILING_ENABLED', False))
 PUSH_ENABLED = False
+PUSH_REDIS_URL = os.environ.get('PUSH_REDIS_URL', 'redis://127.0.0.1:6379/13')
+REVOCATIONS_CACHE_TIMEOUT = int(os.environ.get('REVOCATIONS_CACHE_TIMEOUT', 3600))
+REVOCATIONS_SYNC_INTERVAL = int(os.environ.get('REVOCATIONS_SYNC_INTERVAL', 1))
 SECRET_KEY = os.environ.get('SECRET_KEY', 'secret')
+SCHEDULER_INTERVAL = int(os.environ.get('SCHEDULER_INTERVAL', 60))
 SECURITY_CONFIRMABLE = True
-SECURITY_PASSWORD_HASH = 'sha512_crypt'
+SECURITY_PASSWORD_HASH = os.environ.get('SECURITY_PASSWORD_HASH', 'sha512_crypt')
+SECURITY_PASSWORD_ROUNDS = int(os.environ.get('SECURITY_PASSWORD_ROUNDS', 0)) or None
 SECURITY_PASSWORD_SALT = os.environ.get('SECURITY_PASSWORD_SALT', 'secret')
 SECURITY_POST_LOGIN_VIEW = 'auth.vouchers_index'
 SECURITY_POST_LOGOUT_VIEW = 'login'
 SECURITY_RECOVERABLE = True
 SECURITY_REGISTERABLE = False
 SECURITY_REGISTER_EMAIL = False
+SIGNED_TOKENS = asbool(os.environ.get('SIGNED_TOKENS', False))
+SIGNED_TOKENS_SECRET = os.environ.get('SIGNED_TOKENS_SECRET')
+SIGNED_TOKENS_THREADS = int(os.environ.get('SIGNED_TOKENS_THREADS', 2))
 SQLALCHEMY_DATABASE_URI = os.environ.get('SQLALCHEMY_DATABASE_URI')
 SQLALCHEMY_TRACK_MODIFICATIONS = False
+TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR', os.path.join(BASE_DIR, 'data/templates'))
 THREADS_PER_PAGE = 8
+TIMEZONE = os.environ.get('TIMEZONE')
+TOKEN_CACHE_TIMEOUT = int(os.environ.get('TOKEN_CACHE_TIMEOUT', 60))
 UPLOADS_DEFAULT_DEST = os.path.join(BASE_DIR, 'auth/static/uploads')
 UPLOADS_DEFAULT_URL = '/static/uploads'
 VOUCHER_MAXAGE = 60 * 24
@@ -0,0 +1,25 @@
+"""
+Gunicorn settings for preforked workers sharing a preloaded app
+
+    gunicorn -c gunicorn.conf.py 'auth:create_app()'
+"""
+
+import os
+
+from auth import after_fork, before_exit, preload
+
+bind = os.environ.get('GUNICORN_BIND', '127.0.0.1:5000')
+workers = int(os.environ.get('GUNICORN_WORKERS', 4))
+preload_app = True
+
+
+def when_ready(server):
+    preload(server.app.wsgi())
+
+
+def post_fork(server, worker):
+    after_fork(worker.app.wsgi())
+
+
+def worker_exit(server, worker):
+    before_exit(worker.app.wsgi())
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import sys
+
 from auth import create_app
 from auth.models import db
 from auth.services import manager
@@ -8,7 +10,8 @@ from auth.services import manager
 import auth.commands
 
 if __name__ == '__main__':
-    app = create_app()
+    # Only the server needs the whole app, the other commands get the lean CLI app
+    app = create_app(mode=None if sys.argv[1:2] == ['runserver'] else 'cli')
     db.init_app(app)
     manager.app = app
     manager.run()
@@ -1,5 +1,9 @@
+import contextlib
+import datetime
+import json
 import os
-import tempfile
+import sqlite3
+import time
 import six
 import unittest
 
@@ -7,31 +11,127 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 os.sys.path.insert(0, BASE_DIR)
 
 from auth import create_app
-from auth.models import db, users, Role
+from auth.models import db, users, Auth, Gateway, Role, Voucher
+from auth.admin_services import probes
+from auth.services import coordination, revocations
 from flask_security.utils import encrypt_password
+from flask_sqlalchemy import SignallingSession
 from lxml import etree
+from sqlalchemy import event, orm
+
+BASELINES_FILE = BASE_DIR + '/tests/baselines.json'
+
+# A timing may be this many times its baseline before a test fails
+PERF_TOLERANCE = float(os.environ.get('PERF_TOLERANCE', 2.0))
+
+# Set to record the timings of this run as the new baselines
+PERF_UPDATE_BASELINES = bool(os.environ.get('PERF_UPDATE_BASELINES'))
+
+# Timings depend on the machine, so they are only checked when asked for
+PERF_TIMINGS = bool(os.environ.get('PERF_TIMINGS')) or PERF_UPDATE_BASELINES
+
+TEST_CONFIG = {
+    # One connection, shared by every thread, to a private in-memory database
+    'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+    # Probes check out the shared connection too, returning it must not roll back the test
+    'SQLALCHEMY_ENGINE_OPTIONS': {'pool_reset_on_return': None},
+    # The users in tests.db are hashed with as few rounds, keeping logins cheap
+    'SECURITY_PASSWORD_ROUNDS': 1000,
+    # Process payments in the request, inside the test's transaction
+    'ORDER_THREADS': 0,
+}
+
+_app = None
+
+
+def shared_app():
+    """
+    The app shared by every test in this process
+
+    Its in-memory database is loaded from tests/tests.db once. Processes
+    share nothing, so tests can be split across them.
+    """
+    global _app
+
+    if _app is None:
+        app = create_app(TEST_CONFIG)
+
+        with app.app_context():
+            engine = db.engine
+
+            # Let SQLAlchemy emit BEGIN, so that SAVEPOINT works with pysqlite
+            @event.listens_for(engine, 'begin')
+            def begin(conn):
+                conn.execute('BEGIN')
+
+            connection = engine.raw_connection()
+            connection.connection.isolation_level = None
+
+            # The dump is in table name order, so check foreign keys only once it is loaded
+            template = sqlite3.connect(BASE_DIR + '/tests/tests.db')
+            connection.connection.execute('PRAGMA foreign_keys=OFF')
+            connection.connection.executescript('\n'.join(template.iterdump()))
+            connection.connection.execute('PRAGMA foreign_keys=ON')
+            template.close()
+
+            connection.close()
+
+        _app = app
+
+    return _app
 
-with open(BASE_DIR + '/tests/tests.db', 'rb') as local_db:
-    content = local_db.read()
 
 class TestCase(unittest.TestCase):
+    """
+    Runs each test in a transaction on the shared app, rolled back afterwards
+
+    Sessions are bound to the test's connection and work in a savepoint, so
+    commits and rollbacks by the code under test stay inside the test.
+    """
+
     def __init__(self, *args, **kwargs):
         super(TestCase, self).__init__(*args, **kwargs)
 
     def setUp(self):
-        fd, self.filename = tempfile.mkstemp()
-        os.write(fd, content)
-        os.close(fd)
+        self.app = shared_app()
+        self.client = self.app.test_client()
 
-        config = {
-            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + self.filename,
-        }
+        # Start from empty caches, whatever earlier tests left behind
+        coordination.init_app(self.app)
+        probes.init_app(self.app)
+        revocations.init_app(self.app)
+        self.app.extensions.pop('gateway_zones', None)
+        self.app.extensions.pop('money', None)
 
-        self.app = create_app(config)
-        self.client = self.app.test_client()
+        self.connection = db.get_engine(self.app).connect()
+        self.transaction = self.connection.begin()
+
+        factory = orm.sessionmaker(class_=SignallingSession, db=db, bind=self.connection, binds={})
+
+        @event.listens_for(factory, 'after_transaction_end')
+        def restart_savepoint(session, transaction):
+            if transaction.nested and not transaction._parent.nested:
+                session.expire_all()
+                session.begin_nested()
+
+        def create_session():
+            session = factory()
+            session.begin_nested()
+            return session
+
+        self.session = db.session
+        db.session = orm.scoped_session(create_session, scopefunc=self.session.registry.scopefunc)
 
     def tearDown(self):
-        os.unlink(self.filename)
+        db.session.remove()
+        db.session = self.session
+
+        self.transaction.rollback()
+        self.connection.close()
+
+    def createApp(self, mode=None, **config):
+        """Another app, with the shared app's config and the test's database session"""
+        return create_app(dict(self.app.config, **config), mode)
 
     def get_html(self, response):
         data = response.get_data()
@@ -111,3 +211,106 @@ class TestCase(unittest.TestCase):
 
     def logout(self):
         return self.client.get('/logout')
+
+    @contextlib.contextmanager
+    def countQueries(self):
+        """Collect the SQL statements run inside the block"""
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        # Whichever app runs them, statements go through the test's connection
+        engine = self.connection.engine
+        event.listen(engine, 'after_cursor_execute', count)
+
+        try:
+            yield statements
+        finally:
+            event.remove(engine, 'after_cursor_execute', count)
+
+    def assertMaxQueries(self, maximum, url):
+        """Request a url, failing if it runs more than a number of queries"""
+        with self.countQueries() as statements:
+            response = self.client.get(url)
+
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(len(statements) <= maximum,
+                        '%s ran %s queries, the budget is %s:\n%s' % (url, len(statements), maximum, '\n'.join(statements)))
+
+        return len(statements)
+
+    def assertWithinBaseline(self, name, func, repeat=5):
+        """Time the best of a few runs of func against its recorded baseline"""
+        timings = []
+
+        for _ in range(repeat):
+            start = time.time()
+            func()
+            timings.append(time.time() - start)
+
+        best = min(timings)
+
+        baselines = {}
+
+        if os.path.isfile(BASELINES_FILE):
+            with open(BASELINES_FILE) as f:
+                baselines = json.load(f)
+
+        if PERF_UPDATE_BASELINES:
+            baselines[name] = best
+
+            with open(BASELINES_FILE, 'w') as f:
+                json.dump(baselines, f, indent=4, sort_keys=True)
+        elif name not in baselines:
+            self.fail('%s has no baseline, record one with PERF_UPDATE_BASELINES set' % name)
+        else:
+            self.assertTrue(best <= baselines[name] * PERF_TOLERANCE,
+                            '%s took %.4fs, the baseline is %.4fs' % (name, best, baselines[name]))
+
+        return best
+
+    def seed(self, gateways=0, vouchers=0, auths=0, network_id=u'main-network'):
+        """Bulk insert synthetic gateways, and vouchers and auths spread over the network's gateways"""
+        with self.app.app_context():
+            now = datetime.datetime.utcnow()
+            count = Gateway.query.count()
+
+            if gateways:
+                db.session.execute(Gateway.__table__.insert(), [{
+                    'id': u'seed-gateway%s' % (count + i),
+                    'network_id': network_id,
+                    'title': u'Seed Gateway #%s' % (count + i),
+                    'created_at': now,
+                } for i in range(gateways)])
+
+            gateway_ids = [id for (id,) in Gateway.query.filter_by(network_id=network_id).with_entities(Gateway.id)]
+            offset = Voucher.query.count()
+
+            if vouchers:
+                db.session.execute(Voucher.__table__.insert(), [{
+                    'network_id': network_id,
+                    'gateway_id': gateway_ids[i % len(gateway_ids)],
+                    'code': u'seed-%s' % (offset + i),
+                    'minutes': 60,
+                    'status': 'new',
+                    'incoming': 0,
+                    'outgoing': 0,
+                    'version': 1,
+                    'created_at': now,
+                    'updated_at': now,
+                } for i in range(vouchers)])
+
+            if auths:
+                db.session.execute(Auth.__table__.insert(), [{
+                    'network_id': network_id,
+                    'gateway_id': gateway_ids[i % len(gateway_ids)],
+                    'stage': 'counters',
+                    'token': u'seed-token-%s' % i,
+                    'incoming': i,
+                    'outgoing': i,
+                    'status': 0,
+                    'created_at': now,
+                } for i in range(auths)])
+
+            db.session.commit()
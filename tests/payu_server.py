@@ -0,0 +1,314 @@
+"""
+A local stand-in for PayU's SOAP API and payment page
+
+Serves a WSDL describing setTransaction and getTransaction, answers them
+from memory, and pays (or cancels) transactions from its /rpp.do page.
+"""
+
+import threading
+import time
+import uuid
+
+from xml.sax.saxutils import escape
+
+from lxml import etree
+from werkzeug.serving import make_server
+from werkzeug.utils import redirect
+from werkzeug.wrappers import Request, Response
+
+NS = 'http://soap.api.controller.web.payjar.com/'
+SOAP_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+
+WSDL = '''<?xml version="1.0" encoding="UTF-8"?>
+<definitions xmlns="http://schemas.xmlsoap.org/wsdl/" xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/"
+             xmlns:tns="%(ns)s" xmlns:xs="http://www.w3.org/2001/XMLSchema"
+             targetNamespace="%(ns)s" name="PayUAPI">
+  <types>
+    <xs:schema targetNamespace="%(ns)s" version="1.0">
+      <xs:element name="setTransaction" type="tns:setTransaction"/>
+      <xs:element name="setTransactionResponse" type="tns:setTransactionResponse"/>
+      <xs:element name="getTransaction" type="tns:getTransaction"/>
+      <xs:element name="getTransactionResponse" type="tns:getTransactionResponse"/>
+
+      <xs:complexType name="setTransaction">
+        <xs:sequence>
+          <xs:element name="Api" type="xs:string"/>
+          <xs:element name="Safekey" type="xs:string"/>
+          <xs:element name="TransactionType" type="xs:string"/>
+          <xs:element name="AdditionalInformation" type="tns:additionalInfo"/>
+          <xs:element name="Basket" type="tns:basket"/>
+        </xs:sequence>
+      </xs:complexType>
+
+      <xs:complexType name="getTransaction">
+        <xs:sequence>
+          <xs:element name="Api" type="xs:string"/>
+          <xs:element name="Safekey" type="xs:string"/>
+          <xs:element name="AdditionalInformation" type="tns:additionalInfo"/>
+        </xs:sequence>
+      </xs:complexType>
+
+      <xs:complexType name="additionalInfo">
+        <xs:sequence>
+          <xs:element name="cancelUrl" type="xs:string" minOccurs="0"/>
+          <xs:element name="merchantReference" type="xs:string" minOccurs="0"/>
+          <xs:element name="notificationUrl" type="xs:string" minOccurs="0"/>
+          <xs:element name="payUReference" type="xs:string" minOccurs="0"/>
+          <xs:element name="redirectChannel" type="xs:string" minOccurs="0"/>
+          <xs:element name="returnUrl" type="xs:string" minOccurs="0"/>
+          <xs:element name="supportedPaymentMethods" type="xs:string" minOccurs="0"/>
+        </xs:sequence>
+      </xs:complexType>
+
+      <xs:complexType name="basket">
+        <xs:sequence>
+          <xs:element name="amountInCents" type="xs:string"/>
+          <xs:element name="currencyCode" type="xs:string"/>
+          <xs:element name="description" type="xs:string"/>
+        </xs:sequence>
+      </xs:complexType>
+
+      <xs:complexType name="setTransactionResponse">
+        <xs:sequence>
+          <xs:element name="return" type="tns:setTransactionResponseMessage"/>
+        </xs:sequence>
+      </xs:complexType>
+
+      <xs:complexType name="setTransactionResponseMessage">
+        <xs:sequence>
+          <xs:element name="successful" type="xs:boolean"/>
+          <xs:element name="payUReference" type="xs:string" minOccurs="0"/>
+          <xs:element name="resultCode" type="xs:string" minOccurs="0"/>
+          <xs:element name="resultMessage" type="xs:string" minOccurs="0"/>
+        </xs:sequence>
+      </xs:complexType>
+
+      <xs:complexType name="getTransactionResponse">
+        <xs:sequence>
+          <xs:element name="return" type="tns:getTransactionResponseMessage"/>
+        </xs:sequence>
+      </xs:complexType>
+
+      <xs:complexType name="getTransactionResponseMessage">
+        <xs:sequence>
+          <xs:element name="successful" type="xs:boolean"/>
+          <xs:element name="payUReference" type="xs:string" minOccurs="0"/>
+          <xs:element name="merchantReference" type="xs:string" minOccurs="0"/>
+          <xs:element name="transactionState" type="xs:string" minOccurs="0"/>
+          <xs:element name="transactionType" type="xs:string" minOccurs="0"/>
+          <xs:element name="resultCode" type="xs:string" minOccurs="0"/>
+          <xs:element name="resultMessage" type="xs:string" minOccurs="0"/>
+          <xs:element name="displayMessage" type="xs:string" minOccurs="0"/>
+          <xs:element name="basket" type="tns:basket" minOccurs="0"/>
+        </xs:sequence>
+      </xs:complexType>
+    </xs:schema>
+  </types>
+
+  <message name="setTransaction"><part name="parameters" element="tns:setTransaction"/></message>
+  <message name="setTransactionResponse"><part name="parameters" element="tns:setTransactionResponse"/></message>
+  <message name="getTransaction"><part name="parameters" element="tns:getTransaction"/></message>
+  <message name="getTransactionResponse"><part name="parameters" element="tns:getTransactionResponse"/></message>
+
+  <portType name="EnterpriseAPISoap">
+    <operation name="setTransaction">
+      <input message="tns:setTransaction"/>
+      <output message="tns:setTransactionResponse"/>
+    </operation>
+    <operation name="getTransaction">
+      <input message="tns:getTransaction"/>
+      <output message="tns:getTransactionResponse"/>
+    </operation>
+  </portType>
+
+  <binding name="EnterpriseAPISoapServiceSoapBinding" type="tns:EnterpriseAPISoap">
+    <soap:binding style="document" transport="http://schemas.xmlsoap.org/soap/http"/>
+    <operation name="setTransaction">
+      <soap:operation soapAction=""/>
+      <input><soap:body use="literal"/></input>
+      <output><soap:body use="literal"/></output>
+    </operation>
+    <operation name="getTransaction">
+      <soap:operation soapAction=""/>
+      <input><soap:body use="literal"/></input>
+      <output><soap:body use="literal"/></output>
+    </operation>
+  </binding>
+
+  <service name="PayUAPI">
+    <port name="EnterpriseAPISoapPort" binding="tns:EnterpriseAPISoapServiceSoapBinding">
+      <soap:address location="%(url)s/service/PayUAPI"/>
+    </port>
+  </service>
+</definitions>
+'''
+
+ENVELOPE = '''<?xml version="1.0" encoding="UTF-8"?>
+<soap:Envelope xmlns:soap="%(soap_ns)s">
+  <soap:Body>
+    <ns2:%(operation)sResponse xmlns:ns2="%(ns)s"><return>%(fields)s</return></ns2:%(operation)sResponse>
+  </soap:Body>
+</soap:Envelope>
+'''
+
+DISPLAY_MESSAGES = {
+    'NEW': 'Transaction has not been paid',
+    'SUCCESSFUL': 'Successful',
+    'FAILED': 'Transaction failed',
+}
+
+
+def fields(values):
+    parts = []
+
+    for (key, value) in values:
+        if isinstance(value, (list, tuple)):
+            value = fields(value)
+        else:
+            value = escape(value)
+        parts.append('<%s>%s</%s>' % (key, value, key))
+
+    return ''.join(parts)
+
+
+class FakePayU(object):
+    def __init__(self, safekey='{FAKE-SAFEKEY}', delay=0):
+        self.safekey = safekey
+        self.delay = delay
+        self.transactions = {}
+        self.requests = []
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s' % self.server.server_port
+
+    @property
+    def wsdl_url(self):
+        return self.url + '/service/PayUAPI?wsdl'
+
+    @property
+    def capture_url(self):
+        return self.url + '/rpp.do'
+
+    def config(self):
+        """App config pointing at this server"""
+        return {
+            'PAYU_CAPTURE_URL': self.capture_url,
+            'PAYU_PASSWORD': 'password',
+            'PAYU_SAFEKEY': self.safekey,
+            'PAYU_USERNAME': 'username',
+            'PAYU_WSDL': self.wsdl_url,
+        }
+
+    def start(self):
+        self.server = make_server('127.0.0.1', 0, self, threaded=True)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.thread is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.thread = None
+
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        self.requests.append((request.method, request.path, request.query_string))
+
+        if request.path == '/rpp.do':
+            response = self.pay(request.args.get('PayUReference'), request.args.get('cancel'))
+        elif request.method == 'GET' and request.path == '/service/PayUAPI':
+            response = Response(WSDL % {'ns': NS, 'url': self.url}, mimetype='text/xml')
+        elif request.method == 'POST' and request.path == '/service/PayUAPI':
+            time.sleep(self.delay)
+            response = self.soap(request.get_data())
+        else:
+            response = Response('Not found', status=404)
+
+        return response(environ, start_response)
+
+    def pay(self, reference, cancel=False):
+        """The payment page: settles the transaction and sends the customer back"""
+        transaction = self.transactions.get(reference)
+
+        if transaction is None:
+            return Response('Unknown transaction', status=404)
+
+        if cancel:
+            transaction['transactionState'] = 'FAILED'
+            url = transaction['cancelUrl']
+        else:
+            transaction['transactionState'] = 'SUCCESSFUL'
+            url = transaction['returnUrl']
+
+        return redirect('%s?PayUReference=%s' % (url, reference))
+
+    def soap(self, data):
+        body = etree.fromstring(data).find('{%s}Body' % SOAP_NS)
+        operation = body[0]
+        name = etree.QName(operation).localname
+
+        def get(path):
+            return operation.findtext(path)
+
+        if get('Safekey') != self.safekey:
+            return self.fault('Invalid Safekey')
+
+        if name == 'setTransaction':
+            reference = uuid.uuid4().hex[:12]
+
+            self.transactions[reference] = {
+                'amountInCents': get('Basket/amountInCents'),
+                'currencyCode': get('Basket/currencyCode'),
+                'description': get('Basket/description'),
+                'merchantReference': get('AdditionalInformation/merchantReference') or '',
+                'returnUrl': get('AdditionalInformation/returnUrl'),
+                'cancelUrl': get('AdditionalInformation/cancelUrl'),
+                'transactionState': 'NEW',
+            }
+
+            values = [('successful', 'true'), ('payUReference', reference), ('resultCode', '00'),
+                      ('resultMessage', 'Successful')]
+        elif name == 'getTransaction':
+            reference = get('AdditionalInformation/payUReference')
+            transaction = self.transactions.get(reference)
+
+            if transaction is None:
+                return self.fault('Unknown PayUReference: %s' % reference)
+
+            state = transaction['transactionState']
+
+            values = [
+                ('successful', 'true' if state == 'SUCCESSFUL' else 'false'),
+                ('payUReference', reference),
+                ('merchantReference', transaction['merchantReference']),
+                ('transactionState', state),
+                ('transactionType', 'PAYMENT'),
+                ('resultCode', '00' if state == 'SUCCESSFUL' else '999'),
+                ('resultMessage', DISPLAY_MESSAGES[state]),
+                ('displayMessage', DISPLAY_MESSAGES[state]),
+                ('basket', (
+                    ('amountInCents', transaction['amountInCents']),
+                    ('currencyCode', transaction['currencyCode']),
+                    ('description', transaction['description']),
+                )),
+            ]
+        else:
+            return self.fault('Unknown operation: %s' % name)
+
+        envelope = ENVELOPE % {'soap_ns': SOAP_NS, 'ns': NS, 'operation': name, 'fields': fields(values)}
+
+        return Response(envelope, mimetype='text/xml')
+
+    def fault(self, message):
+        envelope = ('<?xml version="1.0" encoding="UTF-8"?>'
+                    '<soap:Envelope xmlns:soap="%s"><soap:Body><soap:Fault>'
+                    '<faultcode>soap:Server</faultcode><faultstring>%s</faultstring>'
+                    '</soap:Fault></soap:Body></soap:Envelope>') % (SOAP_NS, escape(message))
+
+        return Response(envelope, status=500, mimetype='text/xml')
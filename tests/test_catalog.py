@@ -0,0 +1,73 @@
+from auth.catalog import build_catalog, catalog
+from auth.models import Category, Product, db
+from tests import TestCase
+
+
+class TestCatalog(TestCase):
+    def setUp(self):
+        super(TestCatalog, self).setUp()
+
+        with self.app.app_context():
+            vouchers = Category(network_id=u'main-network', code=u'V', title=u'Vouchers')
+            daily = Category(network_id=u'main-network', code=u'D', title=u'Daily', sub_categories=vouchers)
+            local = Category(network_id=u'main-network', gateway_id=u'main-gateway2', code=u'L', title=u'Local',
+                             sub_categories=daily)
+
+            day = Product(network_id=u'main-network', code=u'1DAY', title=u'Day Pass', currency_id='ZAR',
+                          price=5000, minutes=1440, categories=[daily])
+            db.session.add_all([vouchers, daily, local, day])
+            db.session.commit()
+
+            self.daily_id = daily.id
+            self.day_id = day.id
+
+    def test_tree(self):
+        with self.app.app_context():
+            tree = build_catalog(u'main-network', u'main-gateway1')
+
+            self.assertEqual([u'Vouchers'], [category['title'] for category in tree['categories']])
+
+            vouchers = tree['categories'][0]
+            self.assertEqual([u'Daily'], [category['title'] for category in vouchers['children']])
+
+            daily = vouchers['children'][0]
+            self.assertEqual([], daily['children'])
+            self.assertEqual([u'Day Pass'], [product['title'] for product in daily['products']])
+            self.assertEqual(1440, daily['products'][0]['minutes'])
+
+            self.assertEqual([u'90 Minute Voucher'], [product['title'] for product in tree['products']])
+
+            # Each gateway also sees its own
+            tree = build_catalog(u'main-network', u'main-gateway2')
+            daily = tree['categories'][0]['children'][0]
+            self.assertEqual([u'Local'], [category['title'] for category in daily['children']])
+
+            self.assertEqual({'categories': [], 'products': []}, build_catalog(u'other-network'))
+
+    def test_cached_until_changed(self):
+        with self.app.app_context():
+            with self.countQueries() as statements:
+                catalog(u'main-network', u'main-gateway1')
+            self.assertTrue(statements)
+
+            with self.countQueries() as statements:
+                catalog(u'main-network', u'main-gateway1')
+            self.assertEqual(0, len(statements))
+
+            Product.query.get(self.day_id).title = u'Full Day Pass'
+            db.session.commit()
+
+            tree = catalog(u'main-network', u'main-gateway1')
+            daily = tree['categories'][0]['children'][0]
+            self.assertEqual([u'Full Day Pass'], [product['title'] for product in daily['products']])
+
+            Category.query.get(self.daily_id).network_id = u'other-network'
+            db.session.commit()
+
+            self.assertEqual([], catalog(u'main-network', u'main-gateway1')['categories'][0]['children'])
+
+    def test_portal(self):
+        html = self.assertOk('/wifidog/portal/?gw_id=main-gateway1')
+
+        titles = [span.text for span in html.findall('//div[@class="catalog"]//span[@class="title"]')]
+        self.assertEqual([u'Day Pass', u'90 Minute Voucher'], titles)
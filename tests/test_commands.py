@@ -0,0 +1,145 @@
+import datetime
+import os
+import random
+import shutil
+import tempfile
+
+from auth.commands import generate, import_users, prune_auths
+from auth.graphs import states
+from auth.models import Auth, AuthSummary, Change, GatewayUsage, User, Voucher
+from auth.synthetic import generate_vouchers
+from tests import TestCase
+
+
+class TestCommands(TestCase):
+    def test_prune_auths(self):
+        for incoming in (0, 10, 20):
+            self.client.get('/wifidog/auth/?stage=counters&gw_id=main-gateway1&incoming=%s&outgoing=0' % incoming)
+
+        archive_dir = tempfile.mkdtemp()
+
+        try:
+            with self.app.app_context():
+                prune_auths(days=-1, batch_size=2, archive_dir=archive_dir)
+
+                self.assertEqual(0, Auth.query.count())
+
+                summary = AuthSummary.query.one()
+                self.assertEqual('main-network', summary.network_id)
+                self.assertEqual('main-gateway1', summary.gateway_id)
+                self.assertEqual(3, summary.requests)
+                self.assertEqual(3, summary.denied)
+                self.assertEqual(20, summary.incoming)
+
+            self.assertEqual(2, len(os.listdir(archive_dir)))
+        finally:
+            shutil.rmtree(archive_dir)
+
+    def test_failing_jobs_dont_stop_the_scheduler(self):
+        import auth.commands
+        from auth.coordination import LockError
+        from auth.services import coordination
+
+        (process_vouchers, process_transactions) = (auth.commands.process_vouchers, auth.commands.process_transactions)
+        ran = []
+
+        def failing_process_vouchers():
+            ran.append('process_vouchers')
+            raise LockError('Lost lock: process_vouchers')
+
+        auth.commands.process_vouchers = failing_process_vouchers
+        auth.commands.process_transactions = lambda: ran.append('process_transactions')
+
+        try:
+            with self.app.app_context():
+                leader = coordination.leader('scheduler')
+                self.assertTrue(leader.is_leader())
+
+                auth.commands._run_jobs(leader)
+
+                self.assertEqual(['process_vouchers', 'process_transactions'], ran)
+
+                # Resigned, so another node can take over
+                self.assertTrue(coordination.leader('scheduler').is_leader())
+
+                # Rolled back, the session is still usable
+                self.assertTrue(Voucher.query.count() > 0)
+        finally:
+            auth.commands.process_vouchers = process_vouchers
+            auth.commands.process_transactions = process_transactions
+
+    def test_import_users(self):
+        fd, filename = tempfile.mkstemp(suffix='.csv')
+        os.write(fd, b'\n'.join([
+            b'imported1@example.com,secret,super-admin',
+            b'imported2@example.com,secret,network-admin,main-network',
+            b'imported3@example.com,secret,gateway-admin,main-network,main-gateway1',
+            b'imported4@example.com,secret,unknown-role',
+            b'main-network@example.com,secret,network-admin,main-network',
+            b'imported1@example.com,secret,super-admin',
+            b'imported5@example.com,secret,network-admin,no-such-network',
+            b'imported6@example.com,secret,gateway-admin,main-network,no-such-gateway',
+            b'imported7@example.com,secret,gateway-admin,main-network,other-gateway1',
+            b'imported8@example.com,secret,network-admin,other-network',
+        ]))
+        os.close(fd)
+
+        try:
+            with self.app.app_context():
+                (imported, errors) = import_users(filename, batch_size=2, processes=0, quiet=True)
+
+                self.assertEqual(4, imported)
+                self.assertEqual(6, errors)
+
+                self.assertEqual(0, User.query.filter(User.email.in_(
+                    ['imported5@example.com', 'imported6@example.com', 'imported7@example.com'])).count())
+
+                user = User.query.filter_by(email='imported3@example.com').one()
+                self.assertEqual('main-gateway1', user.gateway_id)
+                self.assertEqual(['gateway-admin'], [role.name for role in user.roles])
+                self.assertIsNotNone(user.confirmed_at)
+
+            response = self.login('imported3@example.com', 'secret')
+            self.assertEqual('http://localhost/vouchers', response.headers['Location'])
+        finally:
+            os.unlink(filename)
+
+    def test_generate(self):
+        with self.app.app_context():
+            totals = generate(networks=2, gateways=6, vouchers=300, days=7, seed=1, until='2017-07-01',
+                              batch_size=100, quiet=True)
+
+            vouchers = Voucher.query.filter(Voucher.network_id.like('synthetic-%')).all()
+            self.assertEqual(300, len(vouchers))
+            self.assertEqual(300, totals['vouchers'])
+            self.assertEqual(totals['changes'], Change.query.count())
+            self.assertTrue(GatewayUsage.query.count() > 0)
+
+            statuses = set(voucher.status for voucher in vouchers)
+            self.assertTrue(statuses <= set(states) | set(['archived']))
+            self.assertTrue(len(statuses) > 3)
+
+            until = datetime.datetime(2017, 7, 1)
+
+            for voucher in vouchers:
+                self.assertTrue(voucher.created_at < until)
+
+                auths = Auth.query.filter_by(voucher_id=voucher.id).order_by(Auth.id).all()
+
+                if voucher.started_at is None:
+                    self.assertEqual([], auths)
+                else:
+                    self.assertEqual('login', auths[0].stage)
+                    self.assertEqual(sorted(auth.incoming for auth in auths), [auth.incoming for auth in auths])
+                    self.assertEqual(voucher.incoming, auths[-1].incoming)
+
+    def test_generated_vouchers_follow_the_seed(self):
+        gateways = [(u'gateway1', u'network1'), (u'gateway2', u'network1')]
+        until = datetime.datetime(2017, 7, 1)
+        since = until - datetime.timedelta(days=7)
+
+        first = list(generate_vouchers(random.Random(1), 1, 100, gateways, since, until, 1440, 15))
+        second = list(generate_vouchers(random.Random(1), 1, 100, gateways, since, until, 1440, 15))
+
+        self.assertEqual(first, second)
+        self.assertEqual(100, len(set(voucher['code'] for (voucher, auths, changes) in first)))
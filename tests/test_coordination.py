@@ -0,0 +1,82 @@
+import time
+
+from auth.coordination import Leader, Lock, LockError, MemoryBackend
+from tests import TestCase
+
+
+class TestCoordination(TestCase):
+    def setUp(self):
+        super(TestCoordination, self).setUp()
+
+        self.backend = MemoryBackend()
+
+    def test_lock_is_held_by_one_owner(self):
+        first = Lock(self.backend, 'lock')
+        second = Lock(self.backend, 'lock')
+
+        self.assertTrue(first.acquire(blocking=False))
+        self.assertFalse(second.acquire(blocking=False))
+
+        # Only the holder's release frees it
+        second.release()
+        self.assertFalse(second.acquire(blocking=False))
+
+        first.release()
+        self.assertTrue(second.acquire(blocking=False))
+        self.assertFalse(first.extend())
+
+    def test_lock_expires(self):
+        first = Lock(self.backend, 'lock', timeout=0.05)
+        second = Lock(self.backend, 'lock', blocking_timeout=1, sleep=0.01)
+
+        self.assertTrue(first.acquire())
+        self.assertTrue(second.acquire())
+
+        # Released too late, it leaves the new holder's lock alone
+        first.release()
+        self.assertFalse(Lock(self.backend, 'lock').acquire(blocking=False))
+
+    def test_lock_context_manager(self):
+        with Lock(self.backend, 'lock'):
+            with self.assertRaises(LockError):
+                with Lock(self.backend, 'lock', blocking_timeout=0):
+                    pass
+
+        self.assertTrue(Lock(self.backend, 'lock').acquire(blocking=False))
+
+    def test_lock_renewal(self):
+        lock = Lock(self.backend, 'lock', timeout=0.1)
+        self.assertTrue(lock.acquire())
+
+        for _ in range(4):
+            time.sleep(0.06)
+            lock.renew()
+
+        self.assertFalse(Lock(self.backend, 'lock').acquire(blocking=False))
+
+        # Taken by another once expired, renewing it fails
+        time.sleep(0.15)
+        self.assertTrue(Lock(self.backend, 'lock').acquire(blocking=False))
+
+        with self.assertRaises(LockError):
+            lock.renew()
+
+    def test_leader_renews_its_lease(self):
+        first = Leader(self.backend, 'leader', ttl=0.1)
+        second = Leader(self.backend, 'leader', ttl=0.1)
+
+        self.assertTrue(first.is_leader())
+        self.assertFalse(second.is_leader())
+
+        for _ in range(4):
+            time.sleep(0.06)
+            self.assertTrue(first.is_leader())
+            self.assertFalse(second.is_leader())
+
+        # Once the leader stops renewing, another takes over
+        time.sleep(0.15)
+        self.assertTrue(second.is_leader())
+        self.assertFalse(first.is_leader())
+
+        second.resign()
+        self.assertTrue(first.is_leader())
@@ -0,0 +1,47 @@
+from auth.models import Currency, db
+from auth.money import format_cents, money, moneys
+from tests import TestCase
+
+
+class TestMoney(TestCase):
+    def test_format_cents(self):
+        self.assertEqual('0.00', format_cents(0))
+        self.assertEqual('0.05', format_cents(5))
+        self.assertEqual('30.00', format_cents(3000))
+        self.assertEqual('12,345,678.90', format_cents(1234567890))
+        self.assertEqual('-1.50', format_cents(-150))
+
+        # Beyond what a float holds exactly
+        self.assertEqual('90,071,992,547,409.93', format_cents(9007199254740993))
+
+    def test_money(self):
+        with self.app.test_request_context():
+            self.assertEqual(u'R 30.00', money(3000, 'ZAR'))
+            self.assertEqual(u'USD 1.00', money(100, 'USD'))
+            self.assertEqual(None, money(None, 'ZAR'))
+
+    def test_currencies_are_cached_until_changed(self):
+        with self.app.test_request_context():
+            money(3000, 'ZAR')
+
+        with self.app.test_request_context():
+            with self.countQueries() as statements:
+                rows = [{'price': cents, 'currency_id': 'ZAR'} for cents in range(100)]
+                formatted = moneys(rows, ['price'])
+
+            self.assertEqual(0, len(statements))
+            self.assertEqual(u'R 0.99', formatted[99]['price'])
+
+            currency = Currency.query.get('ZAR')
+            currency.prefix = None
+            currency.suffix = u'ZAR'
+            db.session.commit()
+
+        with self.app.test_request_context():
+            self.assertEqual(u'30.00 ZAR', money(3000, 'ZAR'))
+
+    def test_products_index(self):
+        self.login('super-admin@example.com', 'admin')
+
+        html = self.assertOk('/products')
+        self.assertEqual(u'R 30.00', html.find('//td[@class="price"]').text)
@@ -87,3 +87,16 @@ class TestNetworks(TestCase):
         self.login('super-admin@example.com', 'admin')
         response = self.client.post('/networks/main-network', data={'id': 'network', 'title': 'Network'}, follow_redirects=True)
         self.assertEqual(200, response.status_code)
+
+    def test_network_options_are_refreshed_on_create(self):
+        self.login('super-admin@example.com', 'admin')
+
+        html = self.assertOk('/users/new')
+        self.assertEqual(3, len(html.findall('//select[@id="network"]/option')))
+
+        self.client.post('/networks/new', data={'id': 'third-network', 'title': 'Third Network'})
+
+        html = self.assertOk('/users/new')
+        options = html.findall('//select[@id="network"]/option')
+        self.assertEqual(4, len(options))
+        self.assertIn('third-network', [option.get('value') for option in options])
@@ -0,0 +1,218 @@
+import shutil
+import tempfile
+
+from auth.commands import process_transactions
+from auth.models import GatewayUsage, Order, Transaction, Voucher, db
+from tests import TestCase
+from tests.payu_server import FakePayU
+
+
+class TestOrders(TestCase):
+    def setUp(self):
+        super(TestOrders, self).setUp()
+
+        self.server = FakePayU().start()
+        self.cache_dir = tempfile.mkdtemp()
+
+        self.app = self.createApp(PAYU_CACHE_DIR=self.cache_dir, PAYU_TIMEOUT=1, **self.server.config())
+        self.client = self.app.test_client()
+
+        self.login('main-gateway1@example.com', 'admin')
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.cache_dir)
+
+        super(TestOrders, self).tearDown()
+
+    def start(self, units=1):
+        response = self.client.get('/pay?product=1&units=%s' % units)
+        self.assertEqual(302, response.status_code)
+        return response.headers['Location'].split('=')[1]
+
+    def vouchers(self, reference):
+        with self.app.app_context():
+            transaction = Transaction.query.get(reference)
+            return transaction.status, transaction.order.status, transaction.order.vouchers.all()
+
+    def test_paid_orders_issue_vouchers(self):
+        reference = self.start(units=3)
+
+        with self.app.app_context():
+            order = Transaction.query.get(reference).order
+            self.assertEqual('pending', order.status)
+            self.assertEqual(9000, order.price)
+            self.assertEqual('main-gateway1', order.gateway_id)
+
+            created = db.session.query(db.func.sum(GatewayUsage.vouchers_created)).scalar() or 0
+
+        self.server.pay(reference)
+
+        html = self.assertOk('/pay/return?PayUReference=%s' % reference)
+        self.assertEqual('successful', html.find('//th[.="Transaction State"]/../td').text)
+        self.assertEqual(3, len(html.findall('//table[@class="pure-table pure-table-horizontal vouchers"]/tbody/tr')))
+
+        (status, order_status, vouchers) = self.vouchers(reference)
+        self.assertEqual('successful', status)
+        self.assertEqual('paid', order_status)
+        self.assertEqual(3, len(vouchers))
+        self.assertEqual(3, len(set(voucher.code for voucher in vouchers)))
+
+        for voucher in vouchers:
+            self.assertEqual('main-gateway1', voucher.gateway_id)
+            self.assertEqual('main-network', voucher.network_id)
+            self.assertEqual(90, voucher.minutes)
+            self.assertEqual('new', voucher.status)
+
+        with self.app.app_context():
+            self.assertEqual(created + 3, db.session.query(db.func.sum(GatewayUsage.vouchers_created)).scalar())
+
+    def test_processing_is_idempotent(self):
+        reference = self.start(units=2)
+        self.server.pay(reference)
+
+        self.assertOk('/pay/return?PayUReference=%s' % reference)
+        self.assertOk('/pay/return?PayUReference=%s' % reference)
+
+        response = self.client.post('/pay/notify', data=dict(PayUReference=reference))
+        self.assertEqual(200, response.status_code)
+
+        with self.app.app_context():
+            self.assertEqual({}, process_transactions())
+
+        (status, order_status, vouchers) = self.vouchers(reference)
+        self.assertEqual('successful', status)
+        self.assertEqual(2, len(vouchers))
+
+    def test_codes_taken_meanwhile_are_drawn_again(self):
+        import auth.orders
+
+        reference = self.start(units=2)
+        self.server.pay(reference)
+
+        unique_codes = auth.orders.unique_codes
+        draws = []
+
+        def racing_unique_codes(gateway_id, count):
+            codes = unique_codes(gateway_id, count)
+            if not draws:
+                # As if main-1-1 had been created at the gateway since it was checked
+                codes[0] = u'main-1-1'
+            draws.append(codes)
+            return codes
+
+        auth.orders.unique_codes = racing_unique_codes
+
+        try:
+            self.assertOk('/pay/return?PayUReference=%s' % reference)
+        finally:
+            auth.orders.unique_codes = unique_codes
+
+        self.assertEqual(2, len(draws))
+
+        (status, order_status, vouchers) = self.vouchers(reference)
+        self.assertEqual('successful', status)
+        self.assertEqual(sorted(draws[1]), sorted(voucher.code for voucher in vouchers))
+
+    def test_failing_transactions_do_not_hold_up_others(self):
+        import auth.orders
+
+        references = [self.start(), self.start()]
+        for reference in references:
+            self.server.pay(reference)
+
+        issue_vouchers = auth.orders.issue_vouchers
+        calls = []
+
+        def failing_issue_vouchers(order):
+            calls.append(order.id)
+            if len(calls) == 1:
+                raise RuntimeError('Failed')
+            return issue_vouchers(order)
+
+        auth.orders.issue_vouchers = failing_issue_vouchers
+
+        try:
+            with self.app.app_context():
+                self.assertEqual({'error': 1, 'successful': 1}, process_transactions())
+        finally:
+            auth.orders.issue_vouchers = issue_vouchers
+
+        statuses = sorted(self.vouchers(reference)[0] for reference in references)
+        self.assertEqual(['new', 'successful'], statuses)
+
+        with self.app.app_context():
+            self.assertEqual({'successful': 1}, process_transactions())
+
+    def test_unpaid_orders_wait(self):
+        reference = self.start()
+
+        html = self.assertOk('/pay/return?PayUReference=%s' % reference)
+        self.assertEqual('new', html.find('//th[.="Transaction State"]/../td').text)
+        self.assertEqual([], self.vouchers(reference)[2])
+
+        self.server.pay(reference)
+
+        with self.app.app_context():
+            self.assertEqual({'successful': 1}, process_transactions())
+
+        self.assertEqual(1, len(self.vouchers(reference)[2]))
+
+    def test_cancelled_orders_issue_nothing(self):
+        reference = self.start()
+        self.server.pay(reference, cancel=True)
+
+        html = self.assertOk('/pay/cancel?payUReference=%s' % reference)
+        self.assertEqual('failed', html.find('//th[.="Transaction State"]/../td').text)
+
+        (status, order_status, vouchers) = self.vouchers(reference)
+        self.assertEqual('failed', status)
+        self.assertEqual('cancelled', order_status)
+        self.assertEqual([], vouchers)
+
+    def test_underpaid_orders_issue_nothing(self):
+        reference = self.start()
+        self.server.transactions[reference]['amountInCents'] = '100'
+        self.server.pay(reference)
+
+        self.assertOk('/pay/return?PayUReference=%s' % reference)
+
+        (status, order_status, vouchers) = self.vouchers(reference)
+        self.assertEqual('failed', status)
+        self.assertEqual([], vouchers)
+
+    def test_notifications(self):
+        reference = self.start()
+        self.server.pay(reference)
+
+        data = '<PaymentNotification><PayUReference>%s</PayUReference></PaymentNotification>' % reference
+        response = self.client.post('/pay/notify', data=data, content_type='text/xml')
+        self.assertEqual(200, response.status_code)
+
+        self.assertEqual(1, len(self.vouchers(reference)[2]))
+
+        response = self.client.post('/pay/notify', data=dict(PayUReference='unknown'))
+        self.assertEqual(404, response.status_code)
+
+    def test_products_of_other_networks_cannot_be_ordered(self):
+        self.logout()
+        self.login('other-gateway1@example.com', 'admin')
+
+        response = self.client.get('/pay?product=1')
+        self.assertEqual(302, response.status_code)
+        self.assertEqual('http://localhost/', response.headers['Location'])
+
+        with self.app.app_context():
+            self.assertEqual(0, Order.query.count())
+
+    def test_transactions_of_other_users_are_hidden(self):
+        reference = self.start()
+
+        self.logout()
+        self.login('main-gateway2@example.com', 'admin')
+
+        response = self.client.get('/pay/return?PayUReference=%s' % reference)
+        self.assertEqual(404, response.status_code)
+
+        with self.app.app_context():
+            self.assertEqual(0, Voucher.query.filter(Voucher.order_id != None).count())
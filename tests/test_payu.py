@@ -0,0 +1,104 @@
+import shutil
+import tempfile
+import time
+
+from auth.payu import PayUError, payu
+from tests import TestCase
+from tests.payu_server import FakePayU
+
+
+class TestPayU(TestCase):
+    def setUp(self):
+        super(TestPayU, self).setUp()
+
+        self.server = FakePayU().start()
+        self.cache_dir = tempfile.mkdtemp()
+
+        self.app = self.createApp(PAYU_CACHE_DIR=self.cache_dir, PAYU_TIMEOUT=1, **self.server.config())
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.cache_dir)
+
+        super(TestPayU, self).tearDown()
+
+    def wsdl_requests(self):
+        return len([r for r in self.server.requests if r[0] == 'GET' and r[1] == '/service/PayUAPI'])
+
+    def test_set_and_get_transaction(self):
+        with self.app.test_request_context():
+            response = payu.set_transaction('ZAR', 1000, 'Voucher', 'http://localhost/pay/return',
+                                            'http://localhost/pay/cancel', merchant_reference='order-1')
+            self.assertTrue(response.successful)
+
+            reference = response.payUReference
+
+            response = payu.get_transaction(reference)
+            self.assertFalse(response.successful)
+            self.assertEqual('NEW', response.transactionState)
+
+            self.server.pay(reference)
+
+            response = payu.get_transaction(reference)
+            self.assertTrue(response.successful)
+            self.assertEqual('order-1', response.merchantReference)
+            self.assertEqual('1000', response.basket.amountInCents)
+
+    def test_wsdl_is_loaded_once(self):
+        with self.app.test_request_context():
+            for _ in range(3):
+                payu.set_transaction('ZAR', 1000, 'Voucher', 'http://localhost/return', 'http://localhost/cancel')
+
+        self.assertEqual(1, self.wsdl_requests())
+
+        # Another app (a new worker, say) reads it from the cache
+        app = self.createApp(PAYU_CACHE_DIR=self.cache_dir, **self.server.config())
+
+        with app.test_request_context():
+            payu.set_transaction('ZAR', 1000, 'Voucher', 'http://localhost/return', 'http://localhost/cancel')
+
+        self.assertEqual(1, self.wsdl_requests())
+
+    def test_calls_time_out(self):
+        with self.app.test_request_context():
+            # Load the WSDL before PayU slows down
+            payu.set_transaction('ZAR', 1000, 'Voucher', 'http://localhost/return', 'http://localhost/cancel')
+
+            self.server.delay = 3
+            start = time.time()
+
+            with self.assertRaises(PayUError):
+                payu.set_transaction('ZAR', 1000, 'Voucher', 'http://localhost/return', 'http://localhost/cancel')
+
+            self.assertTrue(time.time() - start < 2)
+
+        self.server.delay = 0
+
+    def test_faults_raise_payu_errors(self):
+        with self.app.test_request_context():
+            with self.assertRaises(PayUError):
+                payu.get_transaction('unknown')
+
+    def test_pay(self):
+        self.login('main-gateway1@example.com', 'admin')
+
+        response = self.client.get('/pay?product=1')
+        self.assertEqual(302, response.status_code)
+
+        location = response.headers['Location']
+        self.assertTrue(location.startswith(self.server.capture_url + '?PayUReference='))
+
+        reference = location.split('=')[1]
+        self.server.pay(reference)
+
+        html = self.assertOk('/pay/return?PayUReference=%s' % reference)
+        self.assertEqual('successful', html.find('//th[.="Transaction State"]/../td').text)
+
+    def test_pay_when_payu_is_down(self):
+        self.server.stop()
+        self.login('main-gateway1@example.com', 'admin')
+
+        response = self.client.get('/pay?product=1')
+        self.assertEqual(302, response.status_code)
+        self.assertEqual('http://localhost/', response.headers['Location'])
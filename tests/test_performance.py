@@ -0,0 +1,74 @@
+import datetime
+import unittest
+
+from auth.models import Voucher, db
+from tests import PERF_TIMINGS, TestCase
+
+AUTH_URL = '/wifidog/auth/?stage=%s&gw_id=main-gateway1&token=token-1&incoming=%s&outgoing=%s'
+
+
+class TestPerformance(TestCase):
+    """
+    Query budgets and timings of the busiest endpoints
+
+    Query counts must not grow with the number of rows, and timings are
+    compared against tests/baselines.json with PERF_TIMINGS set (see the
+    README).
+    """
+
+    def assertConstantQueries(self, budget, url, **seed):
+        # The first request warms caches (options, templates, zones)
+        self.assertOk(url)
+
+        before = self.assertMaxQueries(budget, url)
+        self.seed(**seed)
+        after = self.assertMaxQueries(budget, url)
+
+        self.assertEqual(before, after, '%s ran %s queries before seeding and %s after' % (url, before, after))
+
+    def start_voucher(self):
+        """Log in a fresh voucher, so that counters are answered on the allowed path"""
+        with self.app.app_context():
+            voucher = Voucher.query.filter_by(code='main-1-1').first()
+            voucher.token = 'token-1'
+            voucher.created_at = datetime.datetime.utcnow()
+            db.session.commit()
+
+        self.assertIn('Auth: 1', self.client.get(AUTH_URL % ('login', 0, 0)).get_data(True))
+
+    def test_vouchers_index_queries(self):
+        self.login('super-admin@example.com', 'admin')
+        self.assertConstantQueries(25, '/vouchers', gateways=5, vouchers=500)
+
+    def test_vouchers_export_queries(self):
+        self.login('super-admin@example.com', 'admin')
+        self.assertConstantQueries(15, '/export/vouchers.csv', gateways=5, vouchers=2000)
+
+    def test_portal_queries(self):
+        self.assertConstantQueries(10, '/wifidog/portal/?gw_id=main-gateway1', gateways=20, vouchers=500)
+
+    def test_auth_queries(self):
+        self.start_voucher()
+        self.assertConstantQueries(15, AUTH_URL % ('counters', 100, 200), gateways=20, vouchers=2000, auths=2000)
+        self.assertIn('Auth: 1', self.client.get(AUTH_URL % ('counters', 100, 200)).get_data(True))
+
+    @unittest.skipUnless(PERF_TIMINGS, 'Timings are checked with PERF_TIMINGS set')
+    def test_auth_timing(self):
+        self.start_voucher()
+        self.seed(gateways=20, vouchers=2000, auths=2000)
+
+        self.assertWithinBaseline('wifidog_auth', lambda: self.client.get(AUTH_URL % ('counters', 100, 200)), repeat=20)
+
+    @unittest.skipUnless(PERF_TIMINGS, 'Timings are checked with PERF_TIMINGS set')
+    def test_vouchers_index_timing(self):
+        self.seed(gateways=5, vouchers=1000)
+        self.login('super-admin@example.com', 'admin')
+
+        self.assertWithinBaseline('vouchers_index', lambda: self.client.get('/vouchers'))
+
+    @unittest.skipUnless(PERF_TIMINGS, 'Timings are checked with PERF_TIMINGS set')
+    def test_vouchers_export_timing(self):
+        self.seed(gateways=5, vouchers=5000)
+        self.login('super-admin@example.com', 'admin')
+
+        self.assertWithinBaseline('vouchers_export', lambda: self.client.get('/export/vouchers.csv').data)
@@ -0,0 +1,98 @@
+from auth.models import Voucher, db
+from auth.revocations import Bitmap
+from auth.services import coordination, revocations
+from tests import TestCase
+
+
+class TestRevocations(TestCase):
+    def setUp(self):
+        super(TestRevocations, self).setUp()
+
+        self.app = self.createApp(SIGNED_TOKENS=True, REVOCATIONS_SYNC_INTERVAL=0)
+
+        with self.app.app_context():
+            self.voucher_ids = [voucher.id for voucher in Voucher.query.order_by(Voucher.id)]
+
+    def block(self, voucher_id):
+        with self.app.app_context():
+            Voucher.query.get(voucher_id).block()
+            db.session.commit()
+
+    def test_bitmap(self):
+        bitmap = Bitmap([3, 17])
+
+        self.assertIn(3, bitmap)
+        self.assertIn(17, bitmap)
+        self.assertNotIn(4, bitmap)
+        self.assertNotIn(100000, bitmap)
+
+        bitmap.add(100000)
+        bitmap.discard(3)
+        bitmap.discard(200000)
+
+        self.assertIn(100000, bitmap)
+        self.assertNotIn(3, bitmap)
+        self.assertEqual(2, len(bitmap))
+
+    def test_rebuilt_from_the_database(self):
+        (blocked, other) = self.voucher_ids[:2]
+        self.block(blocked)
+
+        with self.app.test_request_context():
+            revocations.rebuild()
+
+            with self.countQueries() as statements:
+                self.assertTrue(revocations.is_revoked(blocked))
+                self.assertFalse(revocations.is_revoked(other))
+
+        self.assertEqual([], statements)
+
+    def test_commits_update_the_bitmap(self):
+        voucher_id = self.voucher_ids[0]
+
+        with self.app.test_request_context():
+            revocations.rebuild()
+
+        self.block(voucher_id)
+
+        with self.app.test_request_context():
+            self.assertTrue(revocations.is_revoked(voucher_id))
+
+            Voucher.query.get(voucher_id).unblock()
+            db.session.commit()
+
+            self.assertFalse(revocations.is_revoked(voucher_id))
+
+    def test_changes_from_other_processes_are_replayed(self):
+        (first, second) = self.voucher_ids[:2]
+
+        with self.app.test_request_context():
+            revocations.rebuild()
+
+            # As committed by another process
+            generation = coordination.cache.incr('revocations:generation')
+            coordination.cache.set('revocations:%s' % generation, {first: True, second: True})
+            generation = coordination.cache.incr('revocations:generation')
+            coordination.cache.set('revocations:%s' % generation, {second: False})
+
+            with self.countQueries() as statements:
+                self.assertTrue(revocations.is_revoked(first))
+                self.assertFalse(revocations.is_revoked(second))
+
+            self.assertEqual([], statements)
+
+    def test_missed_changes_rebuild_from_the_database(self):
+        voucher_id = self.voucher_ids[0]
+
+        with self.app.test_request_context():
+            revocations.rebuild()
+
+        self.block(voucher_id)
+
+        with self.app.test_request_context():
+            # The bitmap here never saw it, and the change is gone from the cache
+            revocations.bitmap.discard(voucher_id)
+            generation = coordination.cache.incr('revocations:generation')
+
+            self.assertTrue(revocations.is_revoked(voucher_id))
+            self.assertEqual(generation, revocations.generation)
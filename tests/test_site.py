@@ -1,3 +1,6 @@
+import json
+
+from auth import after_fork, preload
 from tests import TestCase
 
 
@@ -14,3 +17,130 @@ class TestSite(TestCase):
         self.assertEqual(302, response.status_code)
         self.assertEqual('http://localhost/vouchers', response.headers['Location'])
 
+    def test_preloaded_app_serves_requests(self):
+        # Disposing of the shared app's engine would lose the in-memory database
+        self.app = self.createApp()
+        self.client = self.app.test_client()
+
+        preload(self.app)
+        after_fork(self.app)
+
+        html = self.assertOk('/login')
+        self.assertTitle(html, 'Login')
+
+    def test_login_upgrades_password_rounds(self):
+        from auth.models import User
+
+        self.app = self.createApp(SECURITY_PASSWORD_ROUNDS=6000)
+        self.client = self.app.test_client()
+
+        response = self.login('main-gateway1@example.com', 'admin')
+        self.assertEqual(302, response.status_code)
+
+        with self.app.app_context():
+            user = User.query.filter_by(email='main-gateway1@example.com').first()
+            self.assertIn('rounds=6000$', user.password)
+
+    def test_login_with_bounded_password_verification(self):
+        from auth.passwords import BoundedCryptContext
+
+        self.app = self.createApp(PASSWORD_VERIFY_CONCURRENCY=1)
+        self.client = self.app.test_client()
+
+        self.assertIsInstance(self.app.extensions['security'].pwd_context, BoundedCryptContext)
+
+        response = self.login('main-gateway1@example.com', 'admin')
+        self.assertEqual(302, response.status_code)
+        self.assertEqual('http://localhost/vouchers', response.headers['Location'])
+
+    def test_menu_is_cached_per_role(self):
+        self.login('main-gateway1@example.com', 'admin')
+        html = self.assertOk('/vouchers')
+        self.assertIsNone(html.find('//div[@id="menu"]//a[@href="/networks"]'))
+        self.logout()
+
+        self.login('super-admin@example.com', 'admin')
+        html = self.assertOk('/vouchers')
+        self.assertIsNotNone(html.find('//div[@id="menu"]//a[@href="/networks"]'))
+
+    def test_local_datetime_uses_gateway_and_network_timezones(self):
+        import datetime
+
+        from auth.models import Gateway, Network, db
+        from auth.timezones import local_datetime, local_datetimes
+
+        with self.app.app_context():
+            Network.query.get('main-network').timezone = 'Africa/Johannesburg'
+            Gateway.query.get('main-gateway2').timezone = 'America/New_York'
+            db.session.commit()
+
+        value = datetime.datetime(2017, 7, 1, 12, 0)
+
+        with self.app.test_request_context():
+            self.assertEqual('14:00', local_datetime(value, '%H:%M', 'main-gateway1'))
+            self.assertEqual('08:00', local_datetime(value, '%H:%M', 'main-gateway2'))
+            self.assertEqual('14:00', local_datetime(value, '%H:%M', network='main-network'))
+
+            class Row(object):
+                def __init__(self, gateway_id, created_at):
+                    self.gateway_id = gateway_id
+                    self.created_at = created_at
+
+            rows = [Row('main-gateway1', value), Row('main-gateway2', value), Row('main-gateway2', None)]
+
+            self.assertEqual([{'created_at': '14:00'}, {'created_at': '08:00'}, {'created_at': None}],
+                             local_datetimes(rows, ['created_at'], '%H:%M'))
+
+    def test_local_datetime_offsets(self):
+        import datetime
+
+        from auth.timezones import get_zone, local_datetime, utc_offset
+
+        # Johannesburg left local mean time at 20:45:52 UTC, within a quarter hour
+        zone = get_zone('Africa/Johannesburg')
+        self.assertEqual(datetime.timedelta(minutes=112), utc_offset(zone, datetime.datetime(1901, 12, 13, 20, 45)))
+        self.assertEqual(datetime.timedelta(minutes=90), utc_offset(zone, datetime.datetime(1901, 12, 13, 20, 46)))
+
+        # The server's zone when none is configured
+        with self.app.test_request_context():
+            self.assertTrue(local_datetime(datetime.datetime(2017, 7, 1, 12, 0)))
+            self.assertTrue(local_datetime(datetime.datetime(2017, 7, 1, 12, 0)))
+
+    def test_profiling(self):
+        self.app = self.createApp(PROFILING_ENABLED=True, PROFILING_DIR=None)
+        self.client = self.app.test_client()
+
+        self.login('super-admin@example.com', 'admin')
+        self.assertOk('/vouchers')
+
+        token = self.client.get('/auth-token').get_data(as_text=True)
+
+        response = self.client.get('/profiling?auth_token=%s' % token)
+        self.assertEqual(200, response.status_code)
+
+        stats = json.loads(response.get_data(as_text=True))['endpoints']['auth.vouchers_index']
+        self.assertEqual(1, stats['time']['count'])
+        self.assertTrue(stats['queries']['max'] > 0)
+        self.assertEqual(1, stats['templates']['count'])
+
+        response = self.client.post('/profiling/start?auth_token=%s' % token)
+        self.assertTrue(json.loads(response.get_data(as_text=True))['sampler']['running'])
+
+        response = self.client.post('/profiling/stop?auth_token=%s' % token)
+        self.assertFalse(json.loads(response.get_data(as_text=True))['sampler']['running'])
+
+    def test_healthcheck_probes_are_cached(self):
+        self.login('super-admin@example.com', 'admin')
+        token = self.client.get('/auth-token').get_data(as_text=True)
+
+        response = self.client.get('/healthcheck?auth_token=%s' % token)
+        self.assertEqual(200, response.status_code)
+
+        results = json.loads(response.get_data(as_text=True))['results']
+        self.assertEqual(['database', 'disk', 'mail', 'push', 'scheduler'], sorted(r['checker'] for r in results))
+        self.assertTrue(all(r['passed'] for r in results))
+
+        expires = self.app.extensions['probes']['expires']
+
+        self.assertEqual(200, self.client.get('/healthcheck?auth_token=%s' % token).status_code)
+        self.assertEqual(expires, self.app.extensions['probes']['expires'])
@@ -0,0 +1,153 @@
+import datetime
+
+from auth.models import Auth, Voucher, db
+from auth.services import tokens
+from auth.tokens import read_token, sign_token
+from six.moves.urllib.parse import parse_qs, urlparse
+from tests import TestCase
+
+MAC = '00:11:22:aa:bb:cc'
+
+
+class TestTokens(TestCase):
+    def setUp(self):
+        super(TestTokens, self).setUp()
+
+        self.app = self.createApp(SIGNED_TOKENS=True, SIGNED_TOKENS_THREADS=0)
+        self.client = self.app.test_client()
+
+        # Hold back the processing that would run off the request
+        self.deferred = []
+        tokens.defer = lambda func, *args: self.deferred.append((func, args))
+
+        with self.app.app_context():
+            voucher = Voucher.query.filter_by(code='main-1-1').first()
+            voucher.code = 'SIGNED'
+            voucher.megabytes = 1
+            voucher.created_at = datetime.datetime.utcnow()
+            db.session.commit()
+            self.voucher_id = voucher.id
+
+    def tearDown(self):
+        del tokens.defer
+
+        super(TestTokens, self).tearDown()
+
+    def run_deferred(self):
+        with self.app.app_context():
+            for (func, args) in self.deferred:
+                func(*args)
+        self.deferred = []
+
+    def login_voucher(self):
+        response = self.client.post('/wifidog/login/', data={
+            'voucher_code': 'signed',
+            'gw_address': '10.0.0.1',
+            'gw_port': '2060',
+            'gateway_id': 'main-gateway1',
+            'mac': MAC,
+        })
+        self.assertEqual(302, response.status_code)
+        return parse_qs(urlparse(response.headers['Location']).query)['token'][0]
+
+    def auth(self, token, stage='login', incoming=0, outgoing=0, mac=MAC):
+        url = '/wifidog/auth/?stage=%s&gw_id=main-gateway1&mac=%s&token=%s&incoming=%s&outgoing=%s'
+        return self.client.get(url % (stage, mac, token, incoming, outgoing)).get_data(True)
+
+    def test_sign_and_read(self):
+        started_at = datetime.datetime(2017, 12, 1, 8, 30)
+        token = sign_token('secret', 42, u'main-gateway1', MAC.upper(), started_at, 90, 500)
+
+        self.assertEqual({
+            'voucher_id': 42,
+            'gateway_id': u'main-gateway1',
+            'mac': MAC,
+            'started_at': started_at,
+            'minutes': 90,
+            'megabytes': 500,
+        }, read_token('secret', token))
+
+        self.assertEqual(None, read_token('other-secret', token))
+        self.assertEqual(None, read_token('secret', token[:-2] + ('AA' if token[-2:] != 'AA' else 'BB')))
+        self.assertEqual(None, read_token('secret', 's1.garbage'))
+        self.assertEqual(None, read_token('secret', 'a3f9c2d1e0b8a7f6'))
+
+        self.assertEqual(None, read_token('secret', sign_token('secret', 42, u'gw', None, started_at, 90))['megabytes'])
+
+    def test_login_issues_signed_tokens(self):
+        token = self.login_voucher()
+
+        with self.app.app_context():
+            claims = tokens.read(token)
+
+        self.assertEqual(self.voucher_id, claims['voucher_id'])
+        self.assertEqual(u'main-gateway1', claims['gateway_id'])
+        self.assertEqual(MAC, claims['mac'])
+        self.assertEqual(1, claims['megabytes'])
+
+    def test_auths_are_answered_from_the_token(self):
+        token = self.login_voucher()
+
+        with self.countQueries() as statements:
+            self.assertIn('Auth: 1', self.auth(token))
+            self.assertIn('Auth: 1', self.auth(token, 'counters', 100, 200))
+
+        self.assertEqual([], statements)
+        self.assertEqual(2, len(self.deferred))
+
+        self.run_deferred()
+
+        with self.app.app_context():
+            voucher = Voucher.query.get(self.voucher_id)
+            self.assertEqual('active', voucher.status)
+            self.assertEqual(100, voucher.incoming)
+            self.assertEqual(2, Auth.query.filter_by(voucher_id=self.voucher_id).count())
+
+    def test_what_the_token_cannot_vouch_for_goes_to_the_database(self):
+        token = self.login_voucher()
+
+        self.auth(token)
+        self.run_deferred()
+
+        # Another device
+        self.auth(token, 'counters', 100, 200, mac='00:00:00:00:00:01')
+        self.assertEqual([], self.deferred)
+
+        # Megabytes used up
+        self.assertIn('Auth: 0', self.auth(token, 'counters', 100, 1024 * 1024))
+        self.assertEqual([], self.deferred)
+
+        with self.app.app_context():
+            self.assertEqual('ended', Voucher.query.get(self.voucher_id).status)
+
+        # From now on, without the database
+        with self.countQueries() as statements:
+            self.assertIn('Auth: 0', self.auth(token, 'counters', 100, 200))
+        self.assertEqual([], statements)
+
+    def test_blocked_vouchers_are_revoked(self):
+        token = self.login_voucher()
+
+        self.auth(token)
+        self.run_deferred()
+
+        with self.app.app_context():
+            Voucher.query.get(self.voucher_id).block()
+            db.session.commit()
+
+        self.assertIn('Auth: 0', self.auth(token, 'counters', 100, 200))
+
+        with self.app.app_context():
+            Voucher.query.get(self.voucher_id).unblock()
+            db.session.commit()
+
+        self.assertIn('Auth: 1', self.auth(token, 'counters', 100, 200))
+
+    def test_random_tokens_still_work(self):
+        with self.app.app_context():
+            voucher = Voucher.query.get(self.voucher_id)
+            voucher.token = 'token-1'
+            db.session.commit()
+
+        self.assertIn('Auth: 1', self.auth('token-1'))
+        self.assertEqual([], self.deferred)
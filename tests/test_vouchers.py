@@ -1,3 +1,5 @@
+import six
+
 from flask import url_for
 from tests import TestCase
 
@@ -131,3 +133,32 @@ class TestVouchers(TestCase):
 
         response = self.client.post(form.get('action'), follow_redirects=True)
         assert '%s archive successful' % code in str(response.get_data())
+
+    def test_voucher_export_as_gateway(self):
+        self.login('main-gateway1@example.com', 'admin')
+
+        response = self.client.get('/export/vouchers.csv')
+        self.assertEqual(200, response.status_code)
+
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertTrue(lines[0].startswith('id,created_at,updated_at'))
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(3, len(lines))
+        self.assertTrue(all('main-gateway1' in line for line in lines[1:]))
+
+    def test_voucher_export_gzip_as_super(self):
+        import gzip
+        import json
+
+        self.login('super-admin@example.com', 'admin')
+
+        response = self.client.get('/export/vouchers.ndjson?network=other-network',
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+
+        data = gzip.GzipFile(fileobj=six.BytesIO(response.get_data())).read()
+        vouchers = [json.loads(line) for line in data.decode('utf-8').splitlines()]
+
+        self.assertEqual(4, len(vouchers))
+        self.assertEqual(set(['other-network']), set(voucher['network_id'] for voucher in vouchers))
@@ -1,3 +1,9 @@
+import datetime
+import time
+
+from auth import before_exit
+from auth.models import Auth, Voucher, db
+from auth.services import counters
 from tests import TestCase
 
 
@@ -25,3 +31,277 @@ class TestWifidog(TestCase):
     def test_portal_with_valid_gw(self):
         response = self.client.get('/wifidog/portal/?gw_id=main-gateway1')
         self.assertEqual(200, response.status_code)
+
+    def test_auth_records_network_id(self):
+        response = self.client.get('/wifidog/auth/?stage=login&gw_id=main-gateway1&incoming=0&outgoing=0')
+        self.assertEqual(200, response.status_code)
+
+        with self.app.app_context():
+            auth = Auth.query.order_by(Auth.id.desc()).first()
+            self.assertEqual('main-network', auth.network_id)
+
+    def test_auth_counters_are_monotonic(self):
+        with self.app.app_context():
+            voucher = Voucher.query.filter_by(code='main-1-1').first()
+            voucher.token = 'token-1'
+            # Young enough not to expire
+            voucher.created_at = datetime.datetime.utcnow()
+            db.session.commit()
+
+        url = '/wifidog/auth/?stage=%s&gw_id=main-gateway1&token=token-1&incoming=%s&outgoing=%s'
+
+        self.assertEqual(200, self.client.get(url % ('login', 0, 0)).status_code)
+        self.assertEqual(200, self.client.get(url % ('counters', 100, 200)).status_code)
+        self.assertEqual(200, self.client.get(url % ('counters', 50, 300)).status_code)
+
+        with self.app.app_context():
+            voucher = Voucher.query.filter_by(code='main-1-1').first()
+            self.assertEqual('active', voucher.status)
+            self.assertEqual(100, voucher.incoming)
+            self.assertEqual(300, voucher.outgoing)
+            self.assertEqual(3, voucher.version)
+
+    def test_auth_counters_are_coalesced(self):
+        with self.app.app_context():
+            voucher = Voucher.query.filter_by(code='main-1-1').first()
+            voucher.token = 'token-1'
+            voucher.megabytes = 1
+            voucher.created_at = datetime.datetime.utcnow()
+            db.session.commit()
+
+        url = '/wifidog/auth/?stage=%s&gw_id=main-gateway1&token=token-1&incoming=%s&outgoing=%s'
+
+        self.assertEqual(200, self.client.get(url % ('login', 0, 0)).status_code)
+
+        counters.window = 3600
+
+        try:
+            self.assertEqual(200, self.client.get(url % ('counters', 100, 200)).status_code)
+
+            with self.app.app_context():
+                voucher = Voucher.query.filter_by(code='main-1-1').first()
+                self.assertEqual(0, voucher.incoming)
+                self.assertEqual(0, voucher.outgoing)
+
+            # Quota is enforced from the buffered values, which are flushed when the voucher ends
+            response = self.client.get(url % ('counters', 100, 1024 * 1024))
+            self.assertIn('Auth: 0', response.get_data(True))
+
+            with self.app.app_context():
+                voucher = Voucher.query.filter_by(code='main-1-1').first()
+                self.assertEqual('ended', voucher.status)
+                self.assertEqual(100, voucher.incoming)
+                self.assertEqual(1024 * 1024, voucher.outgoing)
+        finally:
+            counters.drain()
+            counters.window = 0
+
+    def test_failed_counter_flushes_are_retried(self):
+        with self.app.app_context():
+            voucher = Voucher.query.filter_by(code='main-1-1').first()
+            voucher.token = 'token-1'
+            voucher.created_at = datetime.datetime.utcnow()
+            db.session.commit()
+
+        url = '/wifidog/auth/?stage=%s&gw_id=main-gateway1&token=token-1&incoming=%s&outgoing=%s'
+
+        self.assertEqual(200, self.client.get(url % ('login', 0, 0)).status_code)
+
+        counters.window = 3600
+        write_counters = Voucher.__dict__['write_counters']
+
+        def fail(pending):
+            raise RuntimeError('database is gone')
+
+        try:
+            self.client.get(url % ('counters', 100, 200))
+
+            counters.window = 0.001
+            Voucher.write_counters = staticmethod(fail)
+
+            # Another voucher's flush failing doesn't fail this auth
+            response = self.client.get('/wifidog/auth/?stage=login&gw_id=main-gateway1&incoming=0&outgoing=0')
+            self.assertEqual(200, response.status_code)
+
+            Voucher.write_counters = write_counters
+            self.client.get('/wifidog/auth/?stage=login&gw_id=main-gateway1&incoming=0&outgoing=0')
+
+            with self.app.app_context():
+                voucher = Voucher.query.filter_by(code='main-1-1').first()
+                self.assertEqual(100, voucher.incoming)
+                self.assertEqual(200, voucher.outgoing)
+        finally:
+            Voucher.write_counters = write_counters
+            counters.drain()
+            counters.window = 0
+
+    def test_idle_counters_are_flushed(self):
+        with self.app.app_context():
+            voucher = Voucher.query.filter_by(code='main-1-1').first()
+            voucher.token = 'token-1'
+            voucher.created_at = datetime.datetime.utcnow()
+            db.session.commit()
+
+        url = '/wifidog/auth/?stage=%s&gw_id=main-gateway1&token=token-1&incoming=%s&outgoing=%s'
+
+        self.assertEqual(200, self.client.get(url % ('login', 0, 0)).status_code)
+
+        counters.window = 3600
+
+        try:
+            self.client.get(url % ('counters', 100, 200))
+
+            # No more auths come in, the flush thread writes them once the interval is up
+            counters.window = 0.01
+            deadline = time.time() + 5
+
+            while True:
+                with self.app.app_context():
+                    voucher = Voucher.query.filter_by(code='main-1-1').first()
+                    if (voucher.incoming, voucher.outgoing) == (100, 200):
+                        break
+
+                self.assertTrue(time.time() < deadline, 'Counters were not flushed')
+                time.sleep(0.05)
+        finally:
+            counters.drain()
+            counters.window = 0
+
+    def test_counters_are_flushed_before_exit(self):
+        with self.app.app_context():
+            voucher = Voucher.query.filter_by(code='main-1-1').first()
+            voucher.token = 'token-1'
+            voucher.created_at = datetime.datetime.utcnow()
+            db.session.commit()
+
+        url = '/wifidog/auth/?stage=%s&gw_id=main-gateway1&token=token-1&incoming=%s&outgoing=%s'
+
+        self.assertEqual(200, self.client.get(url % ('login', 0, 0)).status_code)
+
+        counters.window = 3600
+
+        try:
+            self.client.get(url % ('counters', 100, 200))
+
+            before_exit(self.app)
+
+            with self.app.app_context():
+                voucher = Voucher.query.filter_by(code='main-1-1').first()
+                self.assertEqual(100, voucher.incoming)
+                self.assertEqual(200, voucher.outgoing)
+        finally:
+            counters.drain()
+            counters.window = 0
+
+    def test_gateway_mode_serves_only_the_protocol(self):
+        app = self.createApp('gateway')
+        client = app.test_client()
+
+        self.assertEqual(200, client.get('/wifidog/login/?gw_id=main-gateway1').status_code)
+        self.assertEqual(200, client.get('/wifidog/portal/?gw_id=main-gateway1').status_code)
+        self.assertEqual(404, client.get('/vouchers').status_code)
+        self.assertEqual(404, client.get('/api/networks').status_code)
+
+        with app.app_context():
+            voucher = Voucher.query.filter_by(code='main-1-1').first()
+            voucher.code = 'GATEWAY'
+            voucher.created_at = datetime.datetime.utcnow()
+            db.session.commit()
+
+        response = client.post('/wifidog/login/', data={
+            'voucher_code': 'gateway',
+            'gateway_id': 'main-gateway1',
+            'gw_address': '10.0.0.1',
+            'gw_port': '2060',
+        })
+        self.assertEqual(302, response.status_code)
+
+        token = response.headers['Location'].split('token=')[1]
+        response = client.get('/wifidog/auth/?stage=login&gw_id=main-gateway1&token=%s&incoming=0&outgoing=0' % token)
+        self.assertIn('Auth: 1', response.get_data(True))
+
+    def test_gateway_mode_leaves_admin_modules_unloaded(self):
+        import subprocess
+        import sys
+
+        from tests import BASE_DIR
+
+        script = ("import sys; from auth import create_app; create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'}, 'gateway'); "
+                  "print(' '.join(sorted(sys.modules)))")
+        modules = subprocess.check_output([sys.executable, '-c', script], cwd=BASE_DIR).decode().split()
+
+        for module in ('flask_mail', 'flask_menu', 'flask_principal', 'flask_potion', 'flask_security', 'flask_wtf',
+                       'healthcheck', 'passlib', 'PIL', 'suds', 'wtforms'):
+            self.assertNotIn(module, modules)
+
+    def test_auth_updates_gateway_usage(self):
+        from auth.commands import rebuild_usage
+        from auth.models import GatewayUsage
+
+        with self.app.app_context():
+            voucher = Voucher.query.filter_by(code='main-1-1').first()
+            voucher.token = 'token-1'
+            voucher.created_at = datetime.datetime.utcnow()
+            db.session.commit()
+
+        url = '/wifidog/auth/?stage=%s&gw_id=main-gateway1&token=token-1&incoming=%s&outgoing=%s'
+
+        self.client.get(url % ('login', 0, 0))
+        self.client.get(url % ('counters', 100, 200))
+        self.client.get(url % ('counters', 150, 100))
+
+        def usage():
+            row = GatewayUsage.query.filter_by(gateway_id='main-gateway1').order_by(GatewayUsage.day.desc()).first()
+            return (row.network_id, row.vouchers_started, row.incoming, row.outgoing)
+
+        with self.app.app_context():
+            self.assertEqual(('main-network', 1, 150, 200), usage())
+
+            rebuild_usage()
+            self.assertEqual(('main-network', 1, 150, 200), usage())
+            self.assertEqual(8, db.session.query(db.func.sum(GatewayUsage.vouchers_created)).scalar())
+
+    def test_gateway_usage_rows_started_concurrently(self):
+        from auth.models import GatewayUsage, record_usage
+        from sqlalchemy import event
+
+        day = datetime.date(2030, 1, 1)
+
+        competed = []
+
+        def compete(conn, cursor, statement, parameters, context, executemany):
+            # Another transaction inserts the day's row between our update and insert
+            if statement.startswith('UPDATE gateway_usage') and not competed:
+                competed.append(statement)
+                conn.connection.cursor().execute(
+                    'INSERT INTO gateway_usage (gateway_id, network_id, day, vouchers_created, vouchers_started, '
+                    "vouchers_ended, incoming, outgoing) VALUES ('main-gateway1', 'main-network', '2030-01-01', "
+                    '0, 1, 0, 0, 0)')
+
+        event.listen(self.connection.engine, 'after_cursor_execute', compete)
+
+        try:
+            with self.app.app_context():
+                record_usage(db.session, 'main-gateway1', 'main-network', day, vouchers_started=1)
+                db.session.commit()
+        finally:
+            event.remove(self.connection.engine, 'after_cursor_execute', compete)
+
+        with self.app.app_context():
+            row = GatewayUsage.query.filter_by(gateway_id='main-gateway1', day=day).one()
+            self.assertEqual(2, row.vouchers_started)
+
+    def test_portal_fragments_follow_gateway_changes(self):
+        from auth.models import Gateway
+
+        response = self.client.get('/wifidog/portal/?gw_id=main-gateway1')
+        self.assertIn(b'Main Gateway #1', response.get_data())
+
+        with self.app.app_context():
+            gateway = Gateway.query.get('main-gateway1')
+            gateway.title = u'Renamed Gateway'
+            db.session.commit()
+
+        response = self.client.get('/wifidog/portal/?gw_id=main-gateway1')
+        self.assertIn(b'Renamed Gateway', response.get_data())
+        self.assertNotIn(b'Main Gateway #1', response.get_data())